@@ -1,11 +1,12 @@
 from flask import Flask, render_template, request, redirect, url_for, session, flash
 from functools import wraps
 from passlib.context import CryptContext
-import psycopg2
 import os
 import requests
 from dotenv import load_dotenv
 import config
+from db_pool import get_db_conn, release_request_conn, pool_stats
+from ollama_client import client_stats
 
 load_dotenv()
 
@@ -22,10 +23,8 @@ app = Flask(__name__, static_folder=STATIC_DIR, template_folder=TEMPLATE_DIR)
 app.secret_key = config.SECRET_KEY
 
 
-def get_db_conn():
-    return psycopg2.connect(config.DATABASE_URL)
-
 app.get_db_conn = get_db_conn
+app.teardown_appcontext(release_request_conn)
 app.pwd_context = pwd_context
 
 
@@ -129,6 +128,20 @@ def refresh_session_endpoint():
         return {'status': 'error', 'message': str(e)}, 500
 
 
+@app.route('/admin/db_pool', methods=['GET'])
+@admin_required
+def db_pool_stats():
+    """Connection pool counters (waits, saturation) for sizing DB_POOL_MAX_SIZE."""
+    return pool_stats(), 200
+
+
+@app.route('/admin/ollama', methods=['GET'])
+@admin_required
+def ollama_client_stats():
+    """Request/retry/failure counters and circuit breaker state per Ollama base URL."""
+    return {'clients': client_stats()}, 200
+
+
 @app.route('/api/session-check', methods=['GET'])
 def session_check():
     """Check if the current session is valid."""
@@ -151,6 +164,13 @@ app.register_blueprint(users_bp)
 from apps.documents import documents_bp
 app.register_blueprint(documents_bp)
 
+# Apply pending schema migrations once per startup instead of per request
+from schema import bootstrap_schema
+try:
+    bootstrap_schema()
+except Exception:
+    app.logger.exception('Schema bootstrap failed; run it again once the database is reachable')
+
 if __name__ == '__main__':
     app.run(host=config.APP_HOST, port=config.APP_PORT, debug=config.FLASK_DEBUG)
 
@@ -3,4 +3,7 @@ from flask import Blueprint
 # Serve blueprint static files under /static/chat
 chat_bp = Blueprint('chat', __name__, template_folder='templates', static_folder='static', static_url_path='/static/chat')
 
-from . import routes
+from . import routes, model_list
+
+# Warm the model list cache so the first /chat/models request does not wait on Ollama
+chat_bp.record_once(lambda state: model_list.prefetch())
@@ -0,0 +1,255 @@
+"""
+Per-model admission control for chat completions.
+
+Each chat model gets ``CHAT_MODEL_CONCURRENCY`` completion slots (override
+per model with ``CHAT_MODEL_CONCURRENCY_OVERRIDES``). A request that finds
+every slot busy waits in that model's queue. Waiting requests are grouped
+per user and served round-robin, so one user sending a burst cannot starve
+everyone else. The queue is bounded (``CHAT_QUEUE_MAX`` per model,
+``CHAT_QUEUE_MAX_PER_USER`` per user) and waiting is capped at
+``CHAT_QUEUE_TIMEOUT``. Beyond that, ``AdmissionRejected`` is raised with a
+``retry_after`` estimate so the route can answer 429 immediately.
+
+Limits are per process: with N gunicorn workers, Ollama sees at most
+N x limit concurrent completions per model.
+
+Both the WSGI routes (``admit``) and the asyncio path (``admit_async``)
+share the same gates.
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+import config
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, model: str, reason: str, retry_after: int):
+        super().__init__(f"{model} is busy ({reason}); retry in {retry_after}s")
+        self.model = model
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ('user', 'enqueued_at', 'granted', '_event', '_loop', '_future')
+
+    def __init__(self, user, loop=None):
+        self.user = user
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self._loop = loop
+        if loop is None:
+            self._event = threading.Event()
+            self._future = None
+        else:
+            self._event = None
+            self._future = loop.create_future()
+
+    def wake(self):
+        if self._event is not None:
+            self._event.set()
+        else:
+            self._loop.call_soon_threadsafe(lambda: self._future.done() or self._future.set_result(True))
+
+
+class _ModelGate:
+    def __init__(self, model: str, limit: int):
+        self.model = model
+        self.limit = max(1, limit)
+        self.active = 0
+        self.queues = OrderedDict()  # user -> deque[_Waiter], in round-robin order
+        self.waiting = 0
+        self.lock = threading.Lock()
+        self.admitted = 0
+        self.queued_total = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.service_time_total = 0.0
+        self.completed = 0
+
+    def _retry_after(self) -> int:
+        avg_service = self.service_time_total / self.completed if self.completed else config.CHAT_REQUEST_TIMEOUT / 4
+        return max(1, int(avg_service * (self.waiting + 1) / self.limit))
+
+    def try_enter(self, user, loop=None):
+        """Take a slot now (returns None) or enqueue and return the waiter. Caller holds no lock."""
+        with self.lock:
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                self.admitted += 1
+                return None
+            queue = self.queues.get(user)
+            if self.waiting >= config.CHAT_QUEUE_MAX:
+                self.rejected += 1
+                raise AdmissionRejected(self.model, 'queue full', self._retry_after())
+            if queue is not None and len(queue) >= config.CHAT_QUEUE_MAX_PER_USER:
+                self.rejected += 1
+                raise AdmissionRejected(self.model, 'too many queued requests for this user', self._retry_after())
+            waiter = _Waiter(user, loop)
+            if queue is None:
+                queue = self.queues[user] = deque()
+            queue.append(waiter)
+            self.waiting += 1
+            self.queued_total += 1
+            return waiter
+
+    def abandon(self, waiter) -> bool:
+        """Drop a waiter that timed out. Returns False if it was granted a slot meanwhile."""
+        with self.lock:
+            if waiter.granted:
+                return False
+            queue = self.queues.get(waiter.user)
+            if queue is not None and waiter in queue:
+                queue.remove(waiter)
+                self.waiting -= 1
+                if not queue:
+                    del self.queues[waiter.user]
+            self.timeouts += 1
+            return True
+
+    def granted(self, waiter):
+        waited = time.monotonic() - waiter.enqueued_at
+        with self.lock:
+            self.admitted += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+
+    def leave(self, service_time: float):
+        """Release a slot; hand it to the next user in round-robin order if anyone waits."""
+        with self.lock:
+            self.completed += 1
+            self.service_time_total += service_time
+            if not self.queues:
+                self.active -= 1
+                return
+            user, queue = next(iter(self.queues.items()))
+            waiter = queue.popleft()
+            self.waiting -= 1
+            del self.queues[user]
+            if queue:
+                # user goes to the back of the rotation
+                self.queues[user] = queue
+            waiter.granted = True
+        waiter.wake()
+
+    def stats(self) -> dict:
+        with self.lock:
+            admitted_after_wait = self.queued_total - self.timeouts - self.waiting
+            return {
+                'limit': self.limit,
+                'active': self.active,
+                'queue_depth': self.waiting,
+                'queued_users': len(self.queues),
+                'admitted': self.admitted,
+                'queued_total': self.queued_total,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'wait_time_avg': round(self.wait_time_total / admitted_after_wait, 4) if admitted_after_wait > 0 else 0.0,
+                'wait_time_max': round(self.wait_time_max, 4),
+                'service_time_avg': round(self.service_time_total / self.completed, 4) if self.completed else None,
+            }
+
+
+class _NullGateType:
+    def leave(self, service_time):
+        pass
+
+
+# Stands in for a gate when admission control is disabled
+_NullGate = _NullGateType()
+
+
+_gates = {}
+_gates_lock = threading.Lock()
+
+
+def _gate(model: str) -> _ModelGate:
+    with _gates_lock:
+        gate = _gates.get(model)
+        if gate is None:
+            limit = config.CHAT_MODEL_CONCURRENCY_OVERRIDES.get(model, config.CHAT_MODEL_CONCURRENCY)
+            gate = _gates[model] = _ModelGate(model, limit)
+        return gate
+
+
+class Ticket:
+    """A held completion slot; ``release()`` is idempotent."""
+
+    def __init__(self, gate: _ModelGate):
+        self._gate = gate
+        self._started = time.monotonic()
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._gate.leave(time.monotonic() - self._started)
+
+
+def acquire(model: str, user: str, timeout: float = None) -> Ticket:
+    """Block until a slot for ``model`` is free; raises ``AdmissionRejected``."""
+    if not config.CHAT_ADMISSION_ENABLED:
+        return Ticket(_NullGate)
+    gate = _gate(model)
+    waiter = gate.try_enter(user)
+    if waiter is not None:
+        timeout = config.CHAT_QUEUE_TIMEOUT if timeout is None else timeout
+        if not waiter._event.wait(timeout) and gate.abandon(waiter):
+            raise AdmissionRejected(model, 'timed out waiting in queue', gate._retry_after())
+        gate.granted(waiter)
+    return Ticket(gate)
+
+
+async def acquire_async(model: str, user: str, timeout: float = None) -> Ticket:
+    """``acquire`` for the asyncio path; waits without blocking the event loop."""
+    if not config.CHAT_ADMISSION_ENABLED:
+        return Ticket(_NullGate)
+    gate = _gate(model)
+    waiter = gate.try_enter(user, loop=asyncio.get_running_loop())
+    if waiter is not None:
+        timeout = config.CHAT_QUEUE_TIMEOUT if timeout is None else timeout
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter._future), timeout)
+        except asyncio.TimeoutError:
+            if gate.abandon(waiter):
+                raise AdmissionRejected(model, 'timed out waiting in queue', gate._retry_after())
+        except asyncio.CancelledError:
+            # Client went away: leave the queue, or pass on a slot granted in the meantime
+            if not gate.abandon(waiter):
+                gate.granted(waiter)
+                Ticket(gate).release()
+            raise
+        gate.granted(waiter)
+    return Ticket(gate)
+
+
+@contextmanager
+def admit(model: str, user: str):
+    ticket = acquire(model, user)
+    try:
+        yield ticket
+    finally:
+        ticket.release()
+
+
+@asynccontextmanager
+async def admit_async(model: str, user: str):
+    ticket = await acquire_async(model, user)
+    try:
+        yield ticket
+    finally:
+        ticket.release()
+
+
+def stats() -> dict:
+    with _gates_lock:
+        gates = dict(_gates)
+    return {model: gate.stats() for model, gate in sorted(gates.items())}
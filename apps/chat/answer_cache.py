@@ -0,0 +1,170 @@
+"""
+Semantic answer cache for ``/chat/message``.
+
+A first-turn question (no prior history) from a user with enabled
+documents is embedded anyway for retrieval; before retrieving, that vector
+is compared with the same user's earlier questions to the same chat model
+over the same set of enabled document versions. If one
+is at least ``CHAT_ANSWER_CACHE_THRESHOLD`` cosine-similar, its stored answer
+is returned without retrieval or a completion.
+
+Entries are grouped into buckets keyed by ``(username, chat model,
+embedding model, documents fingerprint, strict flag)``, so an answer, which
+may echo private details of the question, is never served to another user. The fingerprint covers the id and
+``embedded_at`` of every enabled document of the user, so re-embedding,
+disabling or deleting a document moves the user to a new bucket and the
+old answers are never served again; they age out through
+``CHAT_ANSWER_CACHE_TTL`` and LRU eviction at ``CHAT_ANSWER_CACHE_SIZE``.
+
+The cache is per process, like the query embedding cache.
+"""
+import itertools
+import math
+import threading
+import time
+from collections import OrderedDict
+
+import config
+
+
+class _Entry:
+    __slots__ = ('bucket', 'vector', 'question', 'answer', 'expires_at')
+
+    def __init__(self, bucket, vector, question, answer, expires_at):
+        self.bucket = bucket
+        self.vector = vector
+        self.question = question
+        self.answer = answer
+        self.expires_at = expires_at
+
+
+def _normalize(vec) -> tuple:
+    norm = math.sqrt(sum(x * x for x in vec))
+    return tuple(x / norm for x in vec) if norm else None
+
+
+class SemanticAnswerCache:
+    def __init__(self, maxsize: int, ttl: float, threshold: float, bucket_size: int):
+        self.maxsize = max(0, int(maxsize))
+        self.ttl = ttl
+        self.threshold = threshold
+        self.bucket_size = max(1, int(bucket_size))
+        self._entries = OrderedDict()  # entry id -> _Entry, least recently used first
+        self._buckets = {}  # bucket -> [entry id]
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.hit_similarity_total = 0.0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _drop(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        ids = self._buckets.get(entry.bucket)
+        if ids is not None:
+            ids.remove(entry_id)
+            if not ids:
+                del self._buckets[entry.bucket]
+
+    def _nearest(self, bucket, vector, now):
+        """(entry id, similarity) of the closest live entry in ``bucket``; expired ones are dropped."""
+        best_id, best_sim = None, -1.0
+        for entry_id in list(self._buckets.get(bucket, ())):
+            entry = self._entries[entry_id]
+            if entry.expires_at <= now:
+                self._drop(entry_id)
+                self.expirations += 1
+                continue
+            sim = sum(a * b for a, b in zip(vector, entry.vector))
+            if sim > best_sim:
+                best_id, best_sim = entry_id, sim
+        return best_id, best_sim
+
+    def lookup(self, bucket, vector):
+        """Return ``(answer, similarity)`` of a close enough earlier question, or ``None``."""
+        vector = _normalize(vector) if vector else None
+        if vector is None or self.maxsize == 0:
+            return None
+        with self._lock:
+            entry_id, sim = self._nearest(bucket, vector, time.monotonic())
+            if entry_id is None or sim < self.threshold:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            self.hit_similarity_total += sim
+            return self._entries[entry_id].answer, sim
+
+    def store(self, bucket, vector, question: str, answer: str):
+        vector = _normalize(vector) if vector else None
+        if vector is None or not answer or self.maxsize == 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            entry_id, sim = self._nearest(bucket, vector, now)
+            if entry_id is not None and sim >= self.threshold:
+                # Same question again (e.g. two concurrent misses): keep one entry
+                self._drop(entry_id)
+            ids = self._buckets.setdefault(bucket, [])
+            if len(ids) >= self.bucket_size:
+                self._drop(ids[0])
+                self.evictions += 1
+                ids = self._buckets.setdefault(bucket, [])
+            entry_id = next(self._ids)
+            self._entries[entry_id] = _Entry(bucket, vector, question, answer, now + self.ttl)
+            ids.append(entry_id)
+            self.stores += 1
+            while len(self._entries) > self.maxsize:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': config.CHAT_ANSWER_CACHE_ENABLED,
+                'size': len(self._entries),
+                'buckets': len(self._buckets),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'threshold': self.threshold,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'hit_similarity_avg': round(self.hit_similarity_total / self.hits, 4) if self.hits else None,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+cache = SemanticAnswerCache(config.CHAT_ANSWER_CACHE_SIZE, config.CHAT_ANSWER_CACHE_TTL,
+                           config.CHAT_ANSWER_CACHE_THRESHOLD, config.CHAT_ANSWER_CACHE_BUCKET_SIZE)
+
+
+def cacheable(message: str, history, summary, image_b64) -> bool:
+    """Only standalone questions: an answer that depends on earlier turns must not be reused."""
+    return config.CHAT_ANSWER_CACHE_ENABLED and bool(message) and not history and not summary and not image_b64
+
+
+def bucket(username: str, model: str, emb_model: str, fingerprint: str, strict_flag: str) -> tuple:
+    """Answers are only ever shared between questions of the same user."""
+    return (username, model, emb_model, fingerprint, strict_flag != 'false')
+
+
+def completion(model: str, content: str) -> dict:
+    """OpenAI-style completion body for a cached answer."""
+    return {
+        'object': 'chat.completion',
+        'model': model,
+        'created': int(time.time()),
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+        'cached': True,
+    }
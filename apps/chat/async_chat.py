@@ -0,0 +1,371 @@
+"""
+Asyncio serving path for ``POST /chat/message``.
+
+The WSGI route holds a worker thread for the whole request: embedding
+calls, pgvector queries and a completion that can take a minute. Served
+from ``asgi.py`` (``uvicorn asgi:app``), this handler does the same work
+with ``httpx.AsyncClient`` and an ``asyncpg`` pool, so one process can keep
+hundreds of chats in flight while they wait on Ollama. Everything else in
+the app is still the Flask/WSGI application, mounted behind it.
+
+Behaviour matches the WSGI route: same session cookie, same retrieval
+fan-out and deadline, same prompt assembly (``messages``), same query
+embedding cache and the same JSON / SSE responses.
+"""
+import asyncio
+import logging
+import time
+
+import asyncpg
+import httpx
+from starlette.background import BackgroundTask
+from starlette.responses import JSONResponse, Response, StreamingResponse
+
+import config
+import embedding_registry
+from ollama_client import get_router, OllamaError, OllamaCircuitOpen
+from apps.documents.embedding_cache import text_hash
+from . import admission, answer_cache, history as chat_history
+from .messages import build_messages, format_context, sse_event, completion_delta
+from .retrieval import (normalize_query, query_cache, merge_results, search_sql, search_settings_sql, split_legs,
+                        ENABLED_DOCUMENTS_SQL)
+
+logger = logging.getLogger(__name__)
+
+_state = {'db': None, 'http': None, 'sessions': None, 'max_age': None, 'cookie': None}
+
+
+def init_sessions(flask_app):
+    """Read Flask's signed session cookie with the Flask app's own serializer."""
+    _state['sessions'] = flask_app.session_interface.get_signing_serializer(flask_app)
+    _state['max_age'] = int(flask_app.permanent_session_lifetime.total_seconds())
+    _state['cookie'] = flask_app.config.get('SESSION_COOKIE_NAME', 'session')
+
+
+async def startup():
+    _state['db'] = await asyncpg.create_pool(
+        config.DATABASE_URL,
+        min_size=config.DB_POOL_MIN_SIZE,
+        max_size=config.ASYNC_DB_POOL_MAX_SIZE,
+    )
+    # Requests use absolute URLs: each call goes to the backend picked by the router
+    _state['http'] = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=config.ASYNC_HTTP_MAX_CONNECTIONS,
+                            max_keepalive_connections=config.ASYNC_HTTP_MAX_CONNECTIONS),
+        timeout=httpx.Timeout(config.CHAT_REQUEST_TIMEOUT, connect=config.MODELS_REQUEST_TIMEOUT),
+    )
+    logger.info(f"Async chat ready: db pool <= {config.ASYNC_DB_POOL_MAX_SIZE}, "
+                f"http connections <= {config.ASYNC_HTTP_MAX_CONNECTIONS}")
+
+
+async def shutdown():
+    if _state['http'] is not None:
+        await _state['http'].aclose()
+    if _state['db'] is not None:
+        await _state['db'].close()
+
+
+def _load_session(request) -> dict:
+    cookie = request.cookies.get(_state['cookie'])
+    if not cookie or _state['sessions'] is None:
+        return {}
+    try:
+        return _state['sessions'].loads(cookie, max_age=_state['max_age'])
+    except Exception:
+        return {}
+
+
+def _pick_backend(model: str):
+    """Best backend for ``model`` (same ranking as the sync router) whose breaker admits a call."""
+    router = get_router()
+    for backend in router.ordered(model, 'chat'):
+        if backend.client.breaker.allow():
+            router.enter(backend)
+            return backend
+    raise OllamaCircuitOpen("No Ollama backend is available")
+
+
+def _finish(backend, status_code: int = None):
+    # Shares the sync client's breaker so both paths back off from a failing node together
+    get_router().leave(backend)
+    if status_code is None or status_code >= 500:
+        backend.client.breaker.record_failure()
+    else:
+        backend.client.breaker.record_success()
+
+
+async def _ollama_post(model: str, path: str, **kwargs):
+    backend = _pick_backend(model)
+    try:
+        resp = await _state['http'].post(f"{backend.url}{path}", **kwargs)
+    except httpx.TransportError:
+        _finish(backend)
+        raise
+    except BaseException:
+        get_router().leave(backend)
+        raise
+    _finish(backend, resp.status_code)
+    resp.raise_for_status()
+    return resp
+
+
+async def _embed_query(emb_model: str, query: str, timeout: float):
+    resp = await _ollama_post(emb_model, '/v1/embeddings', json={'model': emb_model, 'input': query}, timeout=timeout)
+    edata = resp.json()
+    if isinstance(edata, dict) and 'data' in edata and isinstance(edata['data'], list):
+        return edata['data'][0].get('embedding')
+    return None
+
+
+async def _query_embedding(emb_model: str, message: str, timeout: float):
+    """Same tiers as ``retrieval._cached_query_embedding``: local cache, shared table, Ollama."""
+    query = normalize_query(message)
+    key = (emb_model, query)
+    vec = query_cache.get(key)
+    if vec is not None:
+        return vec
+
+    qhash = text_hash(query)
+    if config.QUERY_EMBEDDING_CACHE_SHARED:
+        try:
+            async with _state['db'].acquire() as conn:
+                cached = await conn.fetchval(
+                    "SELECT embedding::text FROM embedding_cache WHERE embedding_model = $1 AND text_hash = $2",
+                    emb_model, qhash)
+            if cached:
+                vec = [float(x) for x in cached.strip('[]').split(',')]
+                query_cache.set(key, vec)
+                return vec
+        except Exception as e:
+            logger.warning(f"Shared query embedding lookup failed for {emb_model}: {e}")
+
+    # No connection is held while Ollama embeds
+    vec = await _embed_query(emb_model, message, timeout)
+    if vec:
+        query_cache.set(key, vec)
+        if config.QUERY_EMBEDDING_CACHE_SHARED:
+            try:
+                async with _state['db'].acquire() as conn:
+                    await conn.execute(
+                        "INSERT INTO embedding_cache (embedding_model, text_hash, embedding) VALUES ($1, $2, $3::text::vector) "
+                        "ON CONFLICT (embedding_model, text_hash) DO NOTHING",
+                        emb_model, qhash, '[' + ','.join(str(float(x)) for x in vec) + ']')
+            except Exception as e:
+                logger.warning(f"Failed to store query embedding for {emb_model}: {e}")
+    return vec
+
+
+async def _embed_for_search(emb_model: str, message: str, deadline: float):
+    timeout = max(0.1, min(config.RAG_MODEL_TIMEOUT, deadline - time.monotonic()))
+    return await _query_embedding(emb_model, message, timeout)
+
+
+async def _existing_tables(tables: list) -> dict:
+    registry, generation = embedding_registry.snapshot()
+    if registry is None:
+        async with _state['db'].acquire() as conn:
+            rows = await conn.fetch(embedding_registry.REGISTRY_SQL)
+        registry = embedding_registry.fill([tuple(r) for r in rows], generation)
+    return {t: registry[t] for t in tables if t in registry}
+
+
+async def retrieve(mappings: list, message: str, username: str) -> list:
+    """Async twin of ``retrieval.retrieve``: concurrent query embeddings, then one search statement."""
+    deadline = time.monotonic() + config.RAG_RETRIEVAL_DEADLINE
+    entries = [(entry.get('table'), entry.get('embedding_model')) for entry in mappings if entry.get('table')]
+    tables = await _existing_tables(sorted({table_name for table_name, _ in entries}))
+    entries = [(table_name, emb_model) for table_name, emb_model in entries if table_name in tables]
+    text_search = config.RAG_HYBRID_ENABLED
+    # Without any embedding table only the full-text leg runs
+    if not entries and not text_search:
+        return []
+
+    tasks = {asyncio.ensure_future(_embed_for_search(emb_model, message, deadline)): emb_model
+             for emb_model in sorted({emb_model for _, emb_model in entries})}
+    # asyncio.wait rejects an empty set
+    done, not_done = await asyncio.wait(tasks, timeout=max(0.0, deadline - time.monotonic())) if tasks else (set(), set())
+    for task in not_done:
+        task.cancel()
+        logger.warning(f"Dropping retrieval for {tasks[task]}: missed the {config.RAG_RETRIEVAL_DEADLINE}s deadline")
+    vectors = {}
+    for task in done:
+        try:
+            vectors[tasks[task]] = task.result()
+        except Exception:
+            logger.exception(f'Failed to embed query with model {tasks[task]}')
+
+    legs = [(table_name, emb_model, vectors[emb_model], tables[table_name].get('distance_metric'))
+            for table_name, emb_model in entries if vectors.get(emb_model)]
+    if not legs and not text_search:
+        return []
+    sql, params = search_sql(legs, text_search, message, username, lambda i: f"${i}")
+    settings_sql, settings_params = search_settings_sql(deadline, lambda i: f"${i}")
+    async with _state['db'].acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(settings_sql, *settings_params)
+            rows = await conn.fetch(sql, *params)
+    return merge_results(*split_legs([tuple(r) for r in rows]))
+
+
+async def _save_chat_messages(session_id, username, message, model, assistant_reply):
+    if not session_id:
+        return
+    try:
+        async with _state['db'].acquire() as conn:
+            async with conn.transaction():
+                owner = await conn.fetchval("SELECT username FROM chat_sessions WHERE session_id = $1", session_id)
+                if owner is None:
+                    await conn.execute("INSERT INTO chat_sessions (session_id, username, title) VALUES ($1, $2, $3)",
+                                       session_id, username, 'New Chat')
+                elif owner != username:
+                    raise Exception("Session does not belong to current user")
+                await conn.execute("INSERT INTO chat_messages (session_id, role, content, model) VALUES ($1, $2, $3, $4)",
+                                   session_id, 'user', message, model)
+                if assistant_reply:
+                    await conn.execute("INSERT INTO chat_messages (session_id, role, content, model) VALUES ($1, $2, $3, $4)",
+                                       session_id, 'assistant', assistant_reply, model)
+    except Exception:
+        # Don't fail the request if saving fails
+        logger.exception('Error saving chat messages to database')
+
+
+async def _stream_completion(payload, session_id, username, message, model, ticket, on_reply=None):
+    parts = []
+    complete = False
+    try:
+        backend = _pick_backend(model)
+        status_code = None
+        try:
+            async with _state['http'].stream('POST', f"{backend.url}/v1/chat/completions", json=dict(payload, stream=True),
+                                             timeout=httpx.Timeout(config.CHAT_STREAM_IDLE_TIMEOUT, connect=config.MODELS_REQUEST_TIMEOUT)) as resp:
+                status_code = resp.status_code
+                resp.raise_for_status()
+                async for line in resp.aiter_lines():
+                    delta = completion_delta(line)
+                    if delta is None:
+                        break
+                    if delta:
+                        parts.append(delta)
+                        yield sse_event({'delta': delta})
+        finally:
+            _finish(backend, status_code)
+        complete = True
+        yield sse_event({'content': ''.join(parts), 'model': model}, event='done')
+    except (httpx.HTTPError, OllamaError) as e:
+        logger.exception('Error streaming from Ollama /v1/chat/completions')
+        yield sse_event({'error': str(e)}, event='error')
+    finally:
+        ticket.release()
+        # Shielded so a client disconnect (task cancellation) still records the reply
+        await asyncio.shield(_save_chat_messages(session_id, username, message, model, ''.join(parts)))
+        if on_reply is not None:
+            on_reply(''.join(parts), complete)
+
+
+async def _cached_answer(model, answer, session_id, username, message, stream=False):
+    await _save_chat_messages(session_id, username, message, model, answer)
+    if not stream:
+        return JSONResponse(answer_cache.completion(model, answer))
+    body = sse_event({'delta': answer}) + sse_event({'content': answer, 'model': model, 'cached': True}, event='done')
+    return Response(body, media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+async def chat_message(request):
+    username = _load_session(request).get('nimbus_user')
+    if not username:
+        return JSONResponse({'error': 'unauthenticated'}, status_code=401)
+
+    if 'application/json' in request.headers.get('content-type', ''):
+        body = await request.json()
+    else:
+        body = dict(await request.form())
+
+    strict_flag = str(body.get('strict', 'true')).lower()
+    model = body.get('model')
+    message = body.get('message')
+    image_b64 = body.get('image')
+    session_id = body.get('session_id')
+    stream = config.CHAT_STREAM_ENABLED and (str(body.get('stream', 'false')).lower() == 'true'
+                                             or 'text/event-stream' in request.headers.get('accept', ''))
+
+    if not model or not message:
+        return JSONResponse({'error': 'model and message required'}, status_code=400)
+    if image_b64:
+        message = f"{message}\n\n[IMAGE_BASE64]\n{image_b64}"
+
+    summary, history, compact = None, [], False
+    if session_id:
+        try:
+            async with _state['db'].acquire() as conn:
+                summary, history, compact = await chat_history.load_history_async(conn, session_id, username, model)
+        except Exception:
+            logger.exception('Failed to load chat history')
+    else:
+        history = chat_history.client_history(body.get('history'), model)
+
+    system_context = None
+    cache_slot = None
+    try:
+        mappings = config.MODEL_EMBEDDING_TABLE_MAP.get(model) or []
+        async with _state['db'].acquire() as conn:
+            doc_count, fingerprint = await conn.fetchrow(ENABLED_DOCUMENTS_SQL.format(user='$1'), username)
+        if doc_count and answer_cache.cacheable(message, history, summary, image_b64):
+            emb_model = mappings[0].get('embedding_model') if mappings else config.DEFAULT_EMBEDDING_MODEL
+            qvec = await _embed_for_search(emb_model, message, time.monotonic() + config.RAG_MODEL_TIMEOUT)
+            if qvec:
+                cache_slot = (answer_cache.bucket(username, model, emb_model, fingerprint, strict_flag), qvec)
+                hit = answer_cache.cache.lookup(*cache_slot)
+                if hit:
+                    return await _cached_answer(model, hit[0], session_id, username, message, stream)
+        if doc_count:
+            system_context = format_context(await retrieve(mappings, message, username), model)
+    except Exception:
+        # don't fail chat if retrieval fails; just continue without context
+        logger.exception('Failed to compute embeddings or retrieve documents')
+
+    payload = {'model': model, 'messages': build_messages(history, message, system_context, strict_flag, summary)}
+
+    def after_reply(reply, complete):
+        if compact:
+            chat_history.schedule_compaction(session_id, username, model)
+        if complete and cache_slot:
+            answer_cache.cache.store(cache_slot[0], cache_slot[1], message, reply)
+
+    try:
+        ticket = await admission.acquire_async(model, username)
+    except admission.AdmissionRejected as e:
+        logger.warning(f'Chat admission rejected: {e}')
+        return JSONResponse({'error': str(e), 'retry_after': e.retry_after}, status_code=429,
+                            headers={'Retry-After': str(e.retry_after)})
+
+    if stream:
+        # The generator's finally never runs if the client leaves before the first chunk;
+        # the background task releases the slot then (release() is idempotent)
+        return StreamingResponse(_stream_completion(payload, session_id, username, message, model, ticket, after_reply),
+                                 media_type='text/event-stream',
+                                 headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+                                 background=BackgroundTask(ticket.release))
+
+    try:
+        try:
+            resp = await _ollama_post(model, '/v1/chat/completions', json=payload)
+        finally:
+            ticket.release()
+        result = resp.json()
+    except OllamaCircuitOpen as e:
+        return JSONResponse({'error': str(e), 'detail': None}, status_code=503,
+                            headers={'Retry-After': str(int(config.OLLAMA_BREAKER_RESET_SECONDS))})
+    except httpx.TimeoutException as e:
+        logger.exception('Timed out waiting for Ollama /v1/chat/completions')
+        return JSONResponse({'error': str(e), 'detail': None}, status_code=504)
+    except httpx.HTTPError as e:
+        logger.exception('Error proxying to Ollama /v1/chat/completions')
+        detail = e.response.text if isinstance(e, httpx.HTTPStatusError) else None
+        return JSONResponse({'error': str(e), 'detail': detail}, status_code=502)
+
+    assistant_reply = ''
+    if result.get('choices') and result['choices'][0].get('message'):
+        assistant_reply = result['choices'][0]['message'].get('content', '')
+    await _save_chat_messages(session_id, username, message, model, assistant_reply)
+    after_reply(assistant_reply, True)
+    return JSONResponse(result)
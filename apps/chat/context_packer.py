@@ -0,0 +1,158 @@
+"""
+Token-budgeted packing of retrieved chunks into the RAG system context.
+
+Ranked chunks from ``retrieval.merge_results`` are packed greedily, best
+first, into the chat model's context budget (``RAG_CONTEXT_TOKEN_BUDGET``,
+per-model overrides) instead of cutting every chunk to a fixed number of
+characters:
+
+- near-duplicates are dropped: two chunks whose stored embeddings from the
+  same model are at least ``RAG_DEDUP_THRESHOLD`` cosine-similar, or whose
+  normalised text is identical when no model returned both;
+- a chunk that does not fit is skipped so a shorter one further down can
+  use the room, except that the space left at the end is filled with the
+  head of the next chunk (cut at a sentence or word boundary) if at least
+  ``RAG_CONTEXT_MIN_CHUNK_TOKENS`` remain;
+- selected chunks that are neighbours in the same document are merged into
+  one block, with the splitter overlap between them removed.
+
+Blocks are ordered by the rank of their best chunk. Tokens are estimated
+like the chat history (``history.estimate_tokens``). With a budget of 0 the
+old behaviour applies: the top ``RAG_TOP_K_OVERALL`` chunks, each cut to
+``RAG_SNIPPET_MAX_CHARS``.
+"""
+import math
+
+import config
+from .history import estimate_tokens
+
+# Characters of the next chunk used to find the splitter overlap with the previous one
+_OVERLAP_PROBE = 16
+
+
+def token_budget(model) -> int:
+    return config.RAG_CONTEXT_TOKEN_BUDGET_OVERRIDES.get(model, config.RAG_CONTEXT_TOKEN_BUDGET)
+
+
+def _unit(vec):
+    norm = math.sqrt(sum(x * x for x in vec))
+    return [x / norm for x in vec] if norm else None
+
+
+def _normalize_text(text: str) -> str:
+    return ' '.join(text.split()).casefold()
+
+
+def dedupe(results: list) -> list:
+    """Drop results that near-duplicate a better-ranked one."""
+    threshold = config.RAG_DEDUP_THRESHOLD
+    kept = []  # (result, {model: unit vector}, normalised text)
+    for result in results:
+        vectors = {}
+        if threshold > 0:
+            for emb_model, vec in (result[6] or {}).items():
+                unit = _unit(vec)
+                if unit is not None:
+                    vectors[emb_model] = unit
+        text = _normalize_text(result[1])
+        duplicate = False
+        for _, other_vectors, other_text in kept:
+            shared = vectors.keys() & other_vectors.keys()
+            if shared:
+                # Vectors from different models live in different spaces; only compare within one model
+                duplicate = any(sum(a * b for a, b in zip(vectors[m], other_vectors[m])) >= threshold for m in shared)
+            else:
+                duplicate = text == other_text
+            if duplicate:
+                break
+        if not duplicate:
+            kept.append((result, vectors, text))
+    return [result for result, _, _ in kept]
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    """Head of ``text`` within ``max_tokens``, cut at a sentence or word boundary where possible."""
+    limit = max(0, (max_tokens - 4) * config.CHAT_CHARS_PER_TOKEN)
+    if len(text) <= limit:
+        return text
+    head = text[:limit]
+    for sep in ('\n', '. ', ' '):
+        cut = head.rfind(sep)
+        # Only back off if that keeps most of the room
+        if cut >= limit // 2:
+            return head[:cut + 1].rstrip() + ' …'
+    return head + ' …'
+
+
+def _overlap(a: str, b: str) -> int:
+    """Length of the longest suffix of ``a`` that is a prefix of ``b`` (the splitter overlap)."""
+    probe = b[:_OVERLAP_PROBE]
+    if len(probe) < _OVERLAP_PROBE:
+        return 0
+    i = a.find(probe, max(0, len(a) - len(b)))
+    while i != -1:
+        if b.startswith(a[i:]):
+            return len(a) - i
+        i = a.find(probe, i + 1)
+    return 0
+
+
+def _join(a: str, b: str) -> str:
+    overlap = _overlap(a, b)
+    return a + b[overlap:] if overlap else a + '\n' + b
+
+
+def _select(results: list, budget: int) -> list:
+    """Greedy fill: ``[(rank, result, text, truncated)]`` within ``budget`` tokens."""
+    selected = []
+    used = 0
+    for rank, result in enumerate(results):
+        fn, txt = result[0], result[1]
+        cost = estimate_tokens(f"[Source: {fn}]\n{txt}")
+        remaining = budget - used
+        if cost <= remaining:
+            selected.append((rank, result, txt, False))
+            used += cost
+        elif remaining >= config.RAG_CONTEXT_MIN_CHUNK_TOKENS:
+            header = estimate_tokens(f"[Source: {fn}]\n")
+            selected.append((rank, result, _truncate(txt, remaining - header), True))
+            used = budget
+        if budget - used < config.RAG_CONTEXT_MIN_CHUNK_TOKENS:
+            break
+    return selected
+
+
+def _merge_adjacent(selected: list) -> list:
+    """Merge neighbouring chunks of one document into ``[rank, filename, text, members]`` blocks."""
+    blocks = []
+    by_document = {}
+    for item in selected:
+        document_id = item[1][4]
+        if document_id is None or item[1][5] is None:
+            blocks.append([item[0], item[1][0], item[2], [item[1]]])
+        else:
+            by_document.setdefault(document_id, []).append(item)
+    for items in by_document.values():
+        items.sort(key=lambda item: item[1][5])
+        block, last_ordinal, last_truncated = None, None, False
+        for rank, result, text, truncated in items:
+            if block is not None and result[5] == last_ordinal + 1 and not last_truncated:
+                block[0] = min(block[0], rank)
+                block[2] = _join(block[2], text)
+                block[3].append(result)
+            else:
+                block = [rank, result[0], text, [result]]
+                blocks.append(block)
+            last_ordinal, last_truncated = result[5], truncated
+    return sorted(blocks, key=lambda block: block[0])
+
+
+def pack(results: list, budget: int) -> list:
+    """Pack ranked ``results`` into ``[(filename, text, members)]`` blocks, best first.
+
+    ``members`` are the ``merge_results`` tuples that went into a block.
+    """
+    if budget <= 0:
+        return [(r[0], r[1][:config.RAG_SNIPPET_MAX_CHARS], [r]) for r in results[:config.RAG_TOP_K_OVERALL]]
+    candidates = dedupe(results)[:config.RAG_TOP_K_OVERALL]
+    return [(fn, text, members) for _, fn, text, members in _merge_adjacent(_select(candidates, budget))]
@@ -0,0 +1,275 @@
+"""
+Server-side conversation history for ``/chat/message``.
+
+The prompt history is rebuilt from ``chat_messages`` for the session rather
+than taken from the client. The newest turns that fit the model's token
+budget (``CHAT_HISTORY_TOKEN_BUDGET``, per-model overrides) are sent
+verbatim. Everything older is folded into a rolling summary stored on
+``chat_sessions`` (``summary``, ``summary_through_id``). Compaction runs in
+the background after a reply and summarises down to half the budget, so a
+long session triggers it every few turns rather than every turn. Until it
+catches up, turns that do not fit are simply left out.
+
+Tokens are estimated as ``len(text) / CHAT_CHARS_PER_TOKEN``; no tokenizer
+is loaded.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from db_pool import get_db_conn
+from ollama_client import get_client, OllamaError
+from . import admission
+
+logger = logging.getLogger(__name__)
+
+# Rows read per session beyond the summary; older rows are never needed verbatim
+_MAX_ROWS = 500
+_IMAGE_MARKER = '\n\n[IMAGE_BASE64]\n'
+
+_SUMMARY_INSTRUCTION = (
+    "You maintain a running summary of a conversation between a user and an assistant. "
+    "Update the summary with the new turns below. Keep facts, names, numbers, decisions and open "
+    "questions; drop greetings and repetition. Write plain prose, at most {words} words. "
+    "Reply with the summary only."
+)
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text or '') // max(1, config.CHAT_CHARS_PER_TOKEN) + 4  # + per-message overhead
+
+
+def token_budget(model: str) -> int:
+    return config.CHAT_HISTORY_TOKEN_BUDGET_OVERRIDES.get(model, config.CHAT_HISTORY_TOKEN_BUDGET)
+
+
+def fit_turns(turns: list, budget: int) -> tuple:
+    """Split chronological ``turns`` into ``(older, recent)`` where ``recent`` is the newest suffix within ``budget``."""
+    used = 0
+    start = len(turns)
+    while start > 0:
+        cost = estimate_tokens(turns[start - 1]['content'])
+        if used + cost > budget:
+            break
+        used += cost
+        start -= 1
+    # Never open the window on an assistant reply without the question before it
+    if start < len(turns) and turns[start]['role'] == 'assistant':
+        start += 1
+    return turns[:start], turns[start:]
+
+
+def client_history(history, model) -> list:
+    """Sanitise a client-sent ``history`` (requests without a ``session_id``) and trim it to the budget.
+
+    The client's last entry is the message being sent, so it is dropped.
+    """
+    turns = []
+    for msg in (history or [])[:-1]:
+        if isinstance(msg, dict) and msg.get('role') in ('user', 'assistant') and isinstance(msg.get('content'), str):
+            turns.append({'role': msg['role'], 'content': msg['content']})
+    return fit_turns(turns, token_budget(model))[1]
+
+
+def _turns(rows) -> list:
+    """Chronological user/assistant turns from ``(id, role, content)`` rows, without inline images."""
+    turns = []
+    for msg_id, role, content in rows:
+        if role not in ('user', 'assistant'):
+            continue
+        if _IMAGE_MARKER in content:
+            # Images were appended to the stored message as base64; never resend them as history
+            content = content.split(_IMAGE_MARKER, 1)[0] + ' [image]'
+        turns.append({'id': msg_id, 'role': role, 'content': content})
+    return turns
+
+
+def _split(summary, rows, model):
+    turns = _turns(reversed(rows))
+    budget = token_budget(model) - (estimate_tokens(summary) if summary else 0)
+    older, recent = fit_turns(turns, max(0, budget))
+    return older, recent
+
+
+def _strip(turns):
+    return [{'role': t['role'], 'content': t['content']} for t in turns]
+
+
+def load_history(conn, session_id, username, model) -> tuple:
+    """Return ``(summary, turns, needs_compaction)`` for a session owned by ``username``."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT username, summary, summary_through_id FROM chat_sessions WHERE session_id = %s", (session_id,))
+        row = cur.fetchone()
+        if not row or row[0] != username:
+            return None, [], False
+        _, summary, through = row
+        cur.execute("""
+            SELECT id, role, content FROM chat_messages
+            WHERE session_id = %s AND id > %s
+            ORDER BY id DESC
+            LIMIT %s
+        """, (session_id, through or 0, _MAX_ROWS))
+        rows = cur.fetchall()
+    older, recent = _split(summary, rows, model)
+    return summary, _strip(recent), bool(older)
+
+
+async def load_history_async(conn, session_id, username, model) -> tuple:
+    """``load_history`` for an asyncpg connection."""
+    row = await conn.fetchrow("SELECT username, summary, summary_through_id FROM chat_sessions WHERE session_id = $1::uuid",
+                              session_id)
+    if not row or row['username'] != username:
+        return None, [], False
+    rows = await conn.fetch("""
+        SELECT id, role, content FROM chat_messages
+        WHERE session_id = $1::uuid AND id > $2
+        ORDER BY id DESC
+        LIMIT $3
+    """, session_id, row['summary_through_id'] or 0, _MAX_ROWS)
+    older, recent = _split(row['summary'], [tuple(r) for r in rows], model)
+    return row['summary'], _strip(recent), bool(older)
+
+
+def _summarize(model, summary, turns) -> str:
+    words = max(50, config.CHAT_SUMMARY_MAX_TOKENS * 3 // 4)
+    transcript = "\n\n".join(f"{t['role'].upper()}: {t['content']}" for t in turns)
+    prompt = f"Current summary:\n{summary or '(none)'}\n\nNew turns:\n{transcript}"
+    messages = [
+        {'role': 'system', 'content': _SUMMARY_INSTRUCTION.format(words=words)},
+        {'role': 'user', 'content': prompt},
+    ]
+    result = get_client().chat_completion(model, messages, timeout=config.CHAT_REQUEST_TIMEOUT)
+    choices = result.get('choices') or []
+    content = ((choices[0].get('message') or {}).get('content') or '') if choices else ''
+    # Hard cap so a rambling model cannot blow the budget
+    return content.strip()[:config.CHAT_SUMMARY_MAX_TOKENS * config.CHAT_CHARS_PER_TOKEN]
+
+
+def _compact_step(summary_model, session_id, username, summary, through, keep_from, budget):
+    """Summarise the oldest unsummarised turns before ``keep_from``; ``(summary, through)`` after it, or None."""
+    conn = get_db_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT id, role, content FROM chat_messages
+                WHERE session_id = %s AND id > %s AND id < %s
+                ORDER BY id
+                LIMIT %s
+            """, (session_id, through or 0, keep_from, _MAX_ROWS))
+            rows = cur.fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        return None
+    older = _turns(rows)
+    # Bound the summarisation prompt
+    used = 0
+    for count, turn in enumerate(older):
+        used += estimate_tokens(turn['content'])
+        if count and used > budget * 2:
+            older = older[:count]
+            break
+    if older:
+        with admission.admit(summary_model, f"summary:{username}"):
+            new_summary = _summarize(summary_model, summary, older)
+        if not new_summary:
+            return None
+        new_through = older[-1]['id']
+    else:
+        # Only non-chat rows in this range; move past them
+        new_summary, new_through = summary, rows[-1][0]
+    conn = get_db_conn()
+    try:
+        with conn.cursor() as cur:
+            # Only apply if nobody compacted the same range meanwhile
+            cur.execute("""
+                UPDATE chat_sessions SET summary = %s, summary_through_id = %s, summary_updated_at = CURRENT_TIMESTAMP
+                WHERE session_id = %s AND COALESCE(summary_through_id, 0) = %s
+            """, (new_summary, new_through, session_id, through or 0))
+            updated = cur.rowcount == 1
+        conn.commit()
+    finally:
+        conn.close()
+    if not updated:
+        return None
+    logger.info(f"Compacted {len(older)} messages of chat session {session_id} into its summary")
+    return new_summary, new_through
+
+
+def compact(session_id, username, model) -> bool:
+    """Fold turns older than half the budget into the session summary. Returns True if it was updated.
+
+    Reads are bounded like ``load_history``: the newest ``_MAX_ROWS`` rows
+    locate the turns to keep verbatim, and the backlog before them is
+    summarised in chunks of at most ``_MAX_ROWS`` rows, oldest first. No
+    connection is held while a summary is generated.
+    """
+    summary_model = config.CHAT_SUMMARY_MODEL or model
+    conn = get_db_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT username, summary, summary_through_id FROM chat_sessions WHERE session_id = %s", (session_id,))
+            row = cur.fetchone()
+            if not row or row[0] != username:
+                return False
+            _, summary, through = row
+            cur.execute("""
+                SELECT id, role, content FROM chat_messages
+                WHERE session_id = %s AND id > %s
+                ORDER BY id DESC
+                LIMIT %s
+            """, (session_id, through or 0, _MAX_ROWS))
+            rows = cur.fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        return False
+    # Leave headroom (next to a full-size summary) so the next few turns fit without another compaction
+    budget = token_budget(model)
+    older, recent = fit_turns(_turns(reversed(rows)), max(0, (budget - config.CHAT_SUMMARY_MAX_TOKENS) // 2))
+    if not older and len(rows) < _MAX_ROWS:
+        return False
+    # Everything before the first turn kept verbatim gets summarised
+    keep_from = recent[0]['id'] if recent else rows[0][0] + 1
+    updated = False
+    while True:
+        step = _compact_step(summary_model, session_id, username, summary, through, keep_from, budget)
+        if step is None:
+            return updated
+        updated = updated or step[1] != through
+        summary, through = step
+
+
+def _run_compaction(session_id, username, model):
+    try:
+        compact(session_id, username, model)
+    except admission.AdmissionRejected as e:
+        logger.info(f"Skipped history compaction for {session_id}: {e}")
+    except OllamaError as e:
+        logger.warning(f"History compaction for {session_id} failed: {e}")
+    except Exception:
+        logger.exception(f"History compaction for {session_id} failed")
+    finally:
+        with _pending_lock:
+            _pending.discard(session_id)
+
+
+def schedule_compaction(session_id, username, model):
+    """Compact a session's history in the background; at most one run per session at a time."""
+    global _executor
+    if not session_id or not config.CHAT_SUMMARY_ENABLED:
+        return
+    with _pending_lock:
+        if session_id in _pending:
+            return
+        _pending.add(session_id)
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=config.CHAT_SUMMARY_WORKERS, thread_name_prefix='chat-summary')
+    _executor.submit(_run_compaction, session_id, username, model)
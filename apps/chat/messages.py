@@ -0,0 +1,89 @@
+"""
+Prompt assembly and SSE framing shared by the WSGI chat routes and the
+asyncio chat path (``apps/chat/async_chat.py``).
+"""
+import json
+import logging
+
+import config
+from . import context_packer
+
+logger = logging.getLogger(__name__)
+
+
+def describe_distance(dist) -> str:
+    return f"distance: {dist:.4f}" if dist is not None else "full-text match"
+
+
+def format_context(all_results: list, model=None):
+    """Pack ranked retrieval results into the RAG system context for ``model``.
+
+    Results arrive best first (``retrieval.merge_results``) and are packed
+    into the model's token budget (``apps/chat/context_packer.py``).
+    Returns ``None`` when there is nothing to add.
+    """
+    if not all_results:
+        return None
+    budget = context_packer.token_budget(model)
+    blocks = context_packer.pack(all_results, budget)
+    snippets = []
+    chunks = sum(len(members) for _, _, members in blocks)
+    logger.debug(f"Packed {chunks} of {len(all_results)} chunks into {len(blocks)} blocks (budget: {budget or 'off'})")
+    for fn, text, members in blocks:
+        # Don't include model metadata in LLM context - just the content
+        snippets.append(f"[Source: {fn}]\n{text}")
+        # But log it for debugging
+        for _, _, dist, emb_model, _, ordinal, _ in members:
+            logger.debug(f"  - {fn} #{ordinal} ({describe_distance(dist)}, model: {emb_model})")
+    return "\n\n--- Retrieved documents:\n" + "\n\n".join(snippets)
+
+
+def build_messages(history, message, system_context=None, strict_flag='true', summary=None):
+    """Assemble the prompt: system instructions and context, the history summary, prior turns, then ``message``.
+
+    ``history`` holds the prior turns only (see ``apps/chat/history.py``).
+    """
+    messages = []
+
+    # Add system context if documents are enabled
+    if system_context:
+        # if strict flag isn't explicitly 'false', prepend a strict system instruction
+        if strict_flag != 'false':
+            messages.append({'role': 'system', 'content': config.STRICT_DOCS_INSTRUCTION})
+        messages.append({'role': 'system', 'content': system_context})
+
+    # Older turns that no longer fit the history budget
+    if summary:
+        messages.append({'role': 'system', 'content': f"Summary of the earlier conversation:\n{summary}"})
+
+    # Add conversation history
+    for msg in history or []:
+        messages.append({'role': msg.get('role'), 'content': msg.get('content')})
+
+    # Add current user message
+    messages.append({'role': 'user', 'content': message})
+    return messages
+
+
+def sse_event(data: dict, event: str = None) -> str:
+    prefix = f"event: {event}\n" if event else ''
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+def completion_delta(line: str):
+    """Parse one line of an OpenAI-style streamed completion.
+
+    Returns the content delta (possibly ``''``), ``None`` for the ``[DONE]``
+    sentinel, or ``''`` for lines that carry no content.
+    """
+    if not line or not line.startswith('data:'):
+        return ''
+    data = line[len('data:'):].strip()
+    if data == '[DONE]':
+        return None
+    try:
+        chunk = json.loads(data)
+    except ValueError:
+        return ''
+    choices = chunk.get('choices') or []
+    return ((choices[0].get('delta') or {}).get('content') or '') if choices else ''
@@ -0,0 +1,179 @@
+"""
+Cached model listing for the chat dropdown.
+
+``/v1/models`` can stall for seconds while Ollama loads a model, so the
+listing is cached per process and served with stale-while-revalidate: a
+fresh entry (younger than ``MODELS_CACHE_TTL``) is returned as is; a stale
+one (up to ``MODELS_CACHE_STALE_TTL``) is returned immediately while a
+single background thread refreshes it. The cache is warmed when the chat
+blueprint is registered, so only a hopelessly stale cache (or one whose
+warm-up failed) waits on Ollama; concurrent callers share that one fetch,
+and if it fails the last good listing is still served.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+
+import config
+from ollama_client import get_client
+
+logger = logging.getLogger(__name__)
+
+
+def is_chat_model(model_name: str) -> bool:
+    """Check if a model is suitable for chat (not an embedding-only model)."""
+    model_lower = model_name.lower()
+    # Filter out known embedding models
+    for emb in config.EMBEDDING_MODELS:
+        if emb in model_lower:
+            return False
+    # Additional heuristics: embedding models often have 'embed' in the name
+    if 'embed' in model_lower and 'llama' not in model_lower:
+        return False
+    return True
+
+
+class _Listing:
+    __slots__ = ('body', 'etag', 'fetched_at')
+
+    def __init__(self, body: dict):
+        self.body = body
+        self.etag = hashlib.sha256(json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+        self.fetched_at = time.monotonic()
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+
+_listing = None
+_lock = threading.Lock()
+_refreshing = False
+# Held for every fetch so concurrent cold callers share one request to Ollama
+_fetch_lock = threading.Lock()
+_attempts = 0
+_last_error = None
+_stats = {'fresh': 0, 'stale': 0, 'fetches': 0, 'background_refreshes': 0, 'errors': 0, 'served_after_error': 0}
+
+
+def _fetch() -> _Listing:
+    models = get_client().list_models(timeout=config.MODELS_REQUEST_TIMEOUT)
+    ids = None
+    try:
+        if isinstance(models, dict) and 'data' in models and isinstance(models['data'], list):
+            # Filter out embedding-only models
+            all_ids = [(m.get('id') or m.get('name')) for m in models['data']]
+            ids = [mid for mid in all_ids if mid and is_chat_model(mid)]
+    except Exception:
+        ids = None
+    body = {'models': models}
+    if ids is not None:
+        body['ids'] = ids
+    return _Listing(body)
+
+
+def _count(key: str):
+    with _lock:
+        _stats[key] += 1
+
+
+def _store(listing: _Listing):
+    global _listing
+    with _lock:
+        _listing = listing
+        _stats['fetches'] += 1
+
+
+def _fetch_and_store() -> _Listing:
+    """Fetch and cache the listing; a caller that waited on another fetch gets its outcome."""
+    global _attempts, _last_error
+    attempt = _attempts
+    with _fetch_lock:
+        if _attempts != attempt:
+            if _last_error is not None:
+                raise _last_error
+            if _listing is not None:
+                return _listing
+        try:
+            listing = _fetch()
+        except Exception as e:
+            _last_error = e
+            raise
+        finally:
+            _attempts += 1
+        _last_error = None
+        _store(listing)
+        return listing
+
+
+def _refresh_in_background():
+    global _refreshing
+    try:
+        _fetch_and_store()
+        _count('background_refreshes')
+    except Exception as e:
+        _count('errors')
+        logger.warning(f"Background model list refresh failed: {e}")
+    finally:
+        with _lock:
+            _refreshing = False
+
+
+def _schedule_refresh():
+    global _refreshing
+    with _lock:
+        if _refreshing:
+            return
+        _refreshing = True
+    threading.Thread(target=_refresh_in_background, name='model-list-refresh', daemon=True).start()
+
+
+def get_listing() -> _Listing:
+    """Return the cached listing, refreshing it as needed.
+
+    Raises the underlying ``OllamaError`` only when nothing usable is cached.
+    """
+    listing = _listing
+    if listing is not None and listing.age < config.MODELS_CACHE_TTL:
+        _count('fresh')
+        return listing
+    if listing is not None and listing.age < config.MODELS_CACHE_STALE_TTL:
+        _count('stale')
+        _schedule_refresh()
+        return listing
+    try:
+        return _fetch_and_store()
+    except Exception:
+        _count('errors')
+        if _listing is None:
+            raise
+        _count('served_after_error')
+        return _listing
+
+
+def invalidate():
+    """Drop the cached listing, e.g. after a model was pulled or removed."""
+    global _listing
+    with _lock:
+        _listing = None
+
+
+def prefetch():
+    """Warm the cache without blocking the caller."""
+    if config.MODELS_CACHE_TTL > 0:
+        _schedule_refresh()
+
+
+def stats() -> dict:
+    with _lock:
+        data = dict(_stats)
+        listing = _listing
+        data['refreshing'] = _refreshing
+    data['ttl'] = config.MODELS_CACHE_TTL
+    data['stale_ttl'] = config.MODELS_CACHE_STALE_TTL
+    data['cached'] = listing is not None
+    data['age'] = round(listing.age, 1) if listing is not None else None
+    data['etag'] = listing.etag if listing is not None else None
+    return data
@@ -0,0 +1,358 @@
+"""
+Multi-model document retrieval for chat.
+
+Each entry in ``MODEL_EMBEDDING_TABLE_MAP`` needs its own query embedding.
+Those embedding calls run concurrently on a bounded thread pool: every
+model gets ``RAG_MODEL_TIMEOUT`` seconds and the whole fan-out is cut off at
+``RAG_RETRIEVAL_DEADLINE``; models that miss it are dropped so a slow
+embedding model cannot stall the answer. The searches themselves then go
+to Postgres as a single ``UNION ALL`` statement (one top-k subquery per
+table), against the in-memory copy of the ``embedding_tables`` registry
+(``embedding_registry``), so the database sees one round-trip per message
+however many models are mapped.
+
+With ``RAG_HYBRID_ENABLED`` the same statement carries a full-text leg over
+``document_chunks`` (served by its GIN index), and every leg's ranking is combined
+with reciprocal-rank fusion: ``score = sum(weight / (RAG_RRF_K + rank))``.
+Ranks, unlike raw distances, are comparable across embedding models and
+the text leg.
+
+Query embeddings are cached per ``(embedding model, normalised query)`` in
+an in-process LRU/TTL cache and, with ``QUERY_EMBEDDING_CACHE_SHARED``, in
+the ``embedding_cache`` table so every gunicorn worker benefits.
+"""
+import logging
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import config
+import embedding_registry
+import schema
+import vector_index
+from ollama_client import get_client
+from ttl_cache import TTLCache
+from apps.documents import embedding_cache
+
+logger = logging.getLogger(__name__)
+
+# Leg name recorded for chunks found only by full-text search
+TEXT_LEG = 'fts'
+
+_executor = ThreadPoolExecutor(max_workers=config.RAG_RETRIEVAL_MAX_WORKERS, thread_name_prefix='rag-retrieval')
+
+query_cache = TTLCache(maxsize=config.QUERY_EMBEDDING_CACHE_SIZE, ttl=config.QUERY_EMBEDDING_CACHE_TTL)
+_shared_lock = threading.Lock()
+_shared_stats = {'hits': 0, 'misses': 0, 'errors': 0}
+
+
+def normalize_query(message: str) -> str:
+    """Canonical form of a query, used as its cache key; the message itself is what gets embedded."""
+    text = unicodedata.normalize('NFKC', message or '')
+    text = ' '.join(text.split())
+    if config.QUERY_EMBEDDING_CACHE_CASEFOLD:
+        text = text.casefold()
+    return text
+
+
+def query_cache_stats() -> dict:
+    with _shared_lock:
+        shared = dict(_shared_stats)
+    shared['enabled'] = config.QUERY_EMBEDDING_CACHE_SHARED
+    return {'local': query_cache.stats(), 'shared': shared}
+
+
+def _count_shared(key: str):
+    with _shared_lock:
+        _shared_stats[key] += 1
+
+
+def _embed_query(emb_model: str, message: str, timeout: float):
+    # No retries: the retrieval deadline leaves no room for backoff
+    return get_client().embeddings(emb_model, message, timeout=timeout, retries=0)[0]
+
+
+def _shared_lookup(flask_app, emb_model: str, qhash: str):
+    with flask_app.app_context():
+        conn = flask_app.get_db_conn()
+        try:
+            return embedding_cache.lookup(conn, emb_model, [qhash]).get(qhash)
+        finally:
+            conn.close()
+
+
+def _shared_store(flask_app, emb_model: str, qhash: str, vec):
+    with flask_app.app_context():
+        conn = flask_app.get_db_conn()
+        try:
+            embedding_cache.store(conn, emb_model, {qhash: vec})
+        finally:
+            conn.close()
+
+
+def _cached_query_embedding(flask_app, emb_model: str, message: str, timeout: float):
+    """Query embedding from the local cache, then the shared tier, then Ollama.
+
+    The shared tier checks out a connection for the lookup and again for the
+    store, never across the embedding call.
+    """
+    query = normalize_query(message)
+    key = (emb_model, query)
+    vec = query_cache.get(key)
+    if vec is not None:
+        return vec
+
+    qhash = embedding_cache.text_hash(query)
+    if config.QUERY_EMBEDDING_CACHE_SHARED:
+        try:
+            vec = _shared_lookup(flask_app, emb_model, qhash)
+        except Exception as e:
+            logger.warning(f"Shared query embedding lookup failed for {emb_model}: {e}")
+            _count_shared('errors')
+        if vec is not None:
+            _count_shared('hits')
+            query_cache.set(key, vec)
+            return vec
+        _count_shared('misses')
+
+    vec = _embed_query(emb_model, message, timeout)
+    if vec:
+        query_cache.set(key, vec)
+        if config.QUERY_EMBEDDING_CACHE_SHARED:
+            try:
+                _shared_store(flask_app, emb_model, qhash, vec)
+            except Exception as e:
+                logger.warning(f"Failed to store query embedding for {emb_model}: {e}")
+                _count_shared('errors')
+    return vec
+
+
+def _embed_for_search(flask_app, emb_model: str, message: str, deadline: float):
+    """Query embedding for one model, within its share of the deadline."""
+    timeout = max(0.1, min(config.RAG_MODEL_TIMEOUT, deadline - time.monotonic()))
+    return _cached_query_embedding(flask_app, emb_model, message, timeout)
+
+
+def existing_tables(flask_app, tables: list) -> dict:
+    """``{table_name: registry row}`` for the subset of ``tables`` in the embedding table registry."""
+    registry = embedding_registry.snapshot()[0]
+    if registry is None:
+        with flask_app.app_context():
+            conn = flask_app.get_db_conn()
+            try:
+                registry = embedding_registry.tables(conn)
+                conn.rollback()
+            finally:
+                conn.close()
+    return {t: registry[t] for t in tables if t in registry}
+
+
+def search_settings_sql(deadline: float, param) -> tuple:
+    """One ``SELECT set_config(...)`` for the statement timeout and ANN search breadth (transaction-local)."""
+    remaining_ms = int(max(0.1, deadline - time.monotonic()) * 1000)
+    settings = [('statement_timeout', str(remaining_ms))] + list(vector_index.search_params())
+    params = []
+    calls = []
+    for name, value in settings:
+        params.extend([name, value])
+        calls.append(f"set_config({param(len(params) - 1)}, {param(len(params))}, true)")
+    return "SELECT " + ", ".join(calls), params
+
+
+def search_sql(legs: list, text_search: bool, message: str, username: str, param) -> tuple:
+    """Every retrieval leg as one ``UNION ALL`` statement.
+
+    ``legs`` holds ``(table, embedding_model, vector, distance_metric)``,
+    each leg ranked with the operator of its table's metric; with ``text_search``
+    the full-text leg runs over ``document_chunks``. Rows are limited to
+    ``username``'s enabled documents by joining ``documents`` on its primary
+    key, so toggling a document is a single-row update and the filter needs
+    no per-query file list. Chunk text comes from ``document_chunks``;
+    embedding rows written before that table existed still carry their own.
+    ``param(i)`` renders the i-th placeholder (``%s`` for psycopg2, ``$i``
+    for asyncpg). Rows are ``(leg, filename, text, score, document_id,
+    ordinal, vector)`` where score is a distance for vector legs and
+    ``ts_rank_cd`` for the text leg, and vector is the chunk embedding as
+    text (``NULL`` for the text leg or when ``RAG_DEDUP_THRESHOLD`` is 0);
+    rows are not ordered across legs.
+    """
+    params = []
+
+    def bind(value):
+        params.append(value)
+        return param(len(params))
+
+    parts = []
+    # Chunk vectors come back only when the context packer needs them for near-duplicate removal
+    vector_column = "e.embedding::text" if config.RAG_DEDUP_THRESHOLD > 0 else "NULL::text"
+    for table_name, emb_model, vec, metric in legs:
+        # Match the metric the table's index was built for, or it is not used
+        operator = vector_index.distance_operator(metric)
+        vector_str = '[' + ','.join([str(float(x)) for x in vec]) + ']'
+        parts.append(
+            f"(SELECT {bind(emb_model)}::text AS leg, e.filename, coalesce(c.text, e.text) AS text, "
+            f"e.embedding {operator} {bind(vector_str)}::text::vector AS score, "
+            f"e.document_id, e.ordinal, {vector_column} AS vec "
+            f"FROM {table_name} e JOIN documents d ON d.id = e.document_id "
+            f"LEFT JOIN document_chunks c ON c.id = e.chunk_id "
+            f"WHERE d.uploader = {bind(username)}::text AND d.enabled "
+            f"ORDER BY score ASC LIMIT {bind(config.RAG_TOP_K_PER_MODEL)})"
+        )
+    if text_search:
+        tsv = schema.text_search_vector('c.text')
+        parts.append(
+            f"(SELECT {bind(TEXT_LEG)}::text AS leg, d.filename, c.text, ts_rank_cd({tsv}, q)::float8 AS score, "
+            f"c.document_id, c.ordinal, NULL::text AS vec "
+            f"FROM document_chunks c JOIN documents d ON d.id = c.document_id, "
+            f"{schema.text_search_query(bind(message) + '::text')} q "
+            f"WHERE {tsv} @@ q AND d.uploader = {bind(username)}::text AND d.enabled AND d.embeddings "
+            f"ORDER BY score DESC LIMIT {bind(config.RAG_FTS_TOP_K)})"
+        )
+    return " UNION ALL ".join(parts), params
+
+
+# Count and version fingerprint of a user's enabled documents; {user} is the placeholder
+ENABLED_DOCUMENTS_SQL = """
+    SELECT count(*), md5(coalesce(string_agg(id || ':' || coalesce(embedded_at::text, ''), ',' ORDER BY id), ''))
+    FROM documents WHERE uploader = {user} AND enabled = TRUE
+"""
+
+
+def enabled_documents(conn, username: str) -> tuple:
+    """``(count, fingerprint)`` of the user's enabled documents; the fingerprint changes
+    whenever one is enabled, disabled, deleted or re-embedded."""
+    with conn.cursor() as cur:
+        cur.execute(ENABLED_DOCUMENTS_SQL.format(user='%s'), (username,))
+        count, fingerprint = cur.fetchone()
+    return count, fingerprint
+
+
+def query_embedding(flask_app, emb_model: str, message: str):
+    """Query embedding (cached like the retrieval ones) for the answer cache lookup."""
+    return _embed_for_search(flask_app, emb_model, message, time.monotonic() + config.RAG_MODEL_TIMEOUT)
+
+
+def _parse_vector(text):
+    return [float(x) for x in text.strip('[]').split(',')] if text else None
+
+
+def split_legs(rows) -> tuple:
+    """Group ``search_sql`` rows into ``merge_results`` input, each leg best first."""
+    per_leg = {}
+    for leg, fn, txt, score, document_id, ordinal, vec in rows:
+        per_leg.setdefault(leg, []).append((fn, txt, score, document_id, ordinal, _parse_vector(vec)))
+    text_rows = per_leg.pop(TEXT_LEG, None)
+    if text_rows is not None:
+        text_rows = sorted(text_rows, key=lambda r: r[2], reverse=True)[:config.RAG_FTS_TOP_K]
+    per_model = [(leg, sorted(rows, key=lambda r: r[2])) for leg, rows in per_leg.items()]
+    return per_model, text_rows
+
+
+def retrieve(flask_app, mappings: list, message: str, username: str) -> list:
+    """Embed the message for every mapped model concurrently, then search ``username``'s enabled documents in one statement.
+
+    Returns ranked chunk tuples, one per stored chunk (see ``merge_results``).
+    """
+    deadline = time.monotonic() + config.RAG_RETRIEVAL_DEADLINE
+    entries = [(entry.get('table'), entry.get('embedding_model')) for entry in mappings if entry.get('table')]
+    tables = existing_tables(flask_app, sorted({table_name for table_name, _ in entries}))
+    for table_name, emb_model in entries:
+        if table_name not in tables:
+            logger.info(f"Table {table_name} does not exist, skipping")
+    entries = [(table_name, emb_model) for table_name, emb_model in entries if table_name in tables]
+    text_search = config.RAG_HYBRID_ENABLED
+    # Without any embedding table only the full-text leg runs
+    if not entries and not text_search:
+        return []
+
+    started = time.monotonic()
+    futures = {}
+    for emb_model in sorted({emb_model for _, emb_model in entries}):
+        futures[_executor.submit(_embed_for_search, flask_app, emb_model, message, deadline)] = emb_model
+    done, not_done = wait(futures, timeout=max(0.0, deadline - time.monotonic())) if futures else (set(), set())
+    for fut in not_done:
+        fut.cancel()
+        logger.warning(f"Dropping retrieval for {futures[fut]}: missed the {config.RAG_RETRIEVAL_DEADLINE}s deadline")
+    vectors = {}
+    for fut in done:
+        emb_model = futures[fut]
+        try:
+            vectors[emb_model] = fut.result()
+        except Exception:
+            logger.exception(f'Failed to embed query with model {emb_model}')
+        if not vectors.get(emb_model):
+            logger.info(f"No embedding vector returned for model {emb_model}")
+
+    legs = [(table_name, emb_model, vectors[emb_model], tables[table_name].get('distance_metric'))
+            for table_name, emb_model in entries if vectors.get(emb_model)]
+    if not legs and not text_search:
+        return []
+    sql, params = search_sql(legs, text_search, message, username, lambda i: '%s')
+    settings_sql, settings_params = search_settings_sql(deadline, lambda i: '%s')
+    with flask_app.app_context():
+        conn = flask_app.get_db_conn()
+        try:
+            with conn.cursor() as cur:
+                # Settings and search go out as one round-trip; the last statement's rows come back
+                cur.execute(f"{settings_sql}; {sql}", settings_params + params)
+                rows = cur.fetchall()
+            conn.rollback()
+        finally:
+            conn.close()
+    logger.debug(f"Retrieval over {len(legs)} vector legs took {time.monotonic() - started:.3f}s")
+    return merge_results(*split_legs(rows))
+
+
+def _chunk_key(fn, txt, document_id, ordinal):
+    if document_id is not None and ordinal is not None:
+        return (document_id, ordinal)
+    # Legacy rows that could not be linked to a document
+    return (fn, (txt or '')[:1000])
+
+
+def merge_results(per_model: list, text_rows: list = None) -> list:
+    """Merge ``[(embedding_model, rows)]`` and the full-text rows into ranked chunks.
+
+    Each result is ``(fn, text, distance, leg, document_id, ordinal,
+    vectors)``, one per stored chunk however many legs found it. With
+    ``RAG_HYBRID_ENABLED`` they are ordered by reciprocal-rank fusion;
+    otherwise by distance. ``distance`` is the best vector distance seen for
+    the chunk (``leg`` is the model that found it), or ``None`` if only the
+    text leg found it. ``vectors`` maps each embedding model that returned
+    the chunk to its stored embedding, for ``context_packer``.
+    """
+    chunks = {}
+
+    def add(key, leg, fn, txt, value, document_id, ordinal, vec):
+        chunk = chunks.get(key)
+        if chunk is None:
+            chunk = chunks[key] = [fn, txt or '', None if leg == TEXT_LEG else value, leg, document_id, ordinal, {}]
+        elif leg != TEXT_LEG and (chunk[2] is None or value < chunk[2]):
+            chunk[2], chunk[3] = value, leg
+        if vec:
+            chunk[6][leg] = vec
+
+    if not config.RAG_HYBRID_ENABLED:
+        for emb_model, rows in per_model:
+            for fn, txt, dist, document_id, ordinal, vec in rows:
+                add(_chunk_key(fn, txt, document_id, ordinal), emb_model, fn, txt, dist, document_id, ordinal, vec)
+        return sorted((tuple(chunk) for chunk in chunks.values()), key=lambda x: x[2])
+
+    rankings = [(emb_model, config.RAG_VECTOR_WEIGHT, rows) for emb_model, rows in per_model]
+    if text_rows:
+        rankings.append((TEXT_LEG, config.RAG_TEXT_WEIGHT, text_rows))
+    scores = {}
+    for leg, weight, rows in rankings:
+        rank = 0
+        seen = set()
+        for fn, txt, value, document_id, ordinal, vec in rows:
+            key = _chunk_key(fn, txt, document_id, ordinal)
+            # Count every chunk once per leg, even if several of its tables return it
+            if key in seen:
+                continue
+            seen.add(key)
+            rank += 1
+            scores[key] = scores.get(key, 0.0) + weight / (config.RAG_RRF_K + rank)
+            add(key, leg, fn, txt, value, document_id, ordinal, vec)
+    return [tuple(chunks[key]) for key in sorted(scores, key=scores.get, reverse=True)]
@@ -1,11 +1,13 @@
-from flask import render_template, request, session, current_app as app, jsonify, redirect, url_for
+from flask import render_template, request, session, current_app as app, jsonify, redirect, url_for, Response, stream_with_context
 from . import chat_bp
-import requests
 import os
 import json
 import hashlib
 import re
 import config
+from ollama_client import get_client, OllamaError, OllamaCircuitOpen, OllamaTimeout
+from . import retrieval, admission, model_list, answer_cache, history as chat_history
+from .messages import build_messages, format_context, describe_distance, sse_event, completion_delta
 
 # Import configurations from centralized config module
 OLLAMA_URL = config.OLLAMA_URL
@@ -19,19 +21,8 @@ CHAT_MAX_HISTORY = config.CHAT_MAX_HISTORY
 CHAT_REQUEST_TIMEOUT = config.CHAT_REQUEST_TIMEOUT
 EMBEDDING_REQUEST_TIMEOUT = config.EMBEDDING_REQUEST_TIMEOUT
 MODELS_REQUEST_TIMEOUT = config.MODELS_REQUEST_TIMEOUT
-
-def is_chat_model(model_name: str) -> bool:
-    """Check if a model is suitable for chat (not an embedding-only model)."""
-    model_lower = model_name.lower()
-    # Filter out known embedding models
-    for emb in EMBEDDING_MODELS:
-        if emb in model_lower:
-            return False
-    # Additional heuristics: embedding models often have 'embed' in the name
-    if 'embed' in model_lower and 'llama' not in model_lower:
-        return False
-    return True
-
+CHAT_STREAM_ENABLED = config.CHAT_STREAM_ENABLED
+CHAT_STREAM_IDLE_TIMEOUT = config.CHAT_STREAM_IDLE_TIMEOUT
 
 @chat_bp.route('/chat')
 def chat_page():
@@ -172,41 +163,177 @@ def delete_chat_session(session_id):
         return jsonify({'error': str(e)}), 500
 
 
+@chat_bp.route('/admin/chat/query_cache', methods=['GET'])
+def query_cache_status():
+    """Query embedding cache counters for this process (admin only)."""
+    if session.get('role') != 'admin':
+        return jsonify({'success': False, 'error': 'admin access required'}), 403
+    return jsonify({'success': True, 'stats': retrieval.query_cache_stats()})
+
+
+@chat_bp.route('/admin/chat/admission', methods=['GET'])
+def admission_status():
+    """Per-model slots, queue depth and wait times for this process (admin only)."""
+    if session.get('role') != 'admin':
+        return jsonify({'success': False, 'error': 'admin access required'}), 403
+    return jsonify({'success': True, 'models': admission.stats()})
+
+
+@chat_bp.route('/admin/chat/models_cache', methods=['GET', 'POST'])
+def models_cache_status():
+    """Model list cache state for this process; POST drops it (admin only)."""
+    if session.get('role') != 'admin':
+        return jsonify({'success': False, 'error': 'admin access required'}), 403
+    if request.method == 'POST':
+        model_list.invalidate()
+        model_list.prefetch()
+    return jsonify({'success': True, 'stats': model_list.stats()})
+
+
+@chat_bp.route('/admin/chat/answer_cache', methods=['GET', 'POST'])
+def answer_cache_status():
+    """Semantic answer cache counters for this process; POST clears it (admin only)."""
+    if session.get('role') != 'admin':
+        return jsonify({'success': False, 'error': 'admin access required'}), 403
+    if request.method == 'POST':
+        answer_cache.cache.clear()
+    return jsonify({'success': True, 'stats': answer_cache.cache.stats()})
+
+
 @chat_bp.route('/chat/models')
 def chat_models():
     # production: require no dev bypass here; models endpoint is public but page requires login
     try:
-        resp = requests.get(f"{OLLAMA_URL}/v1/models", timeout=MODELS_REQUEST_TIMEOUT)
-        resp.raise_for_status()
-        try:
-            models = resp.json()
-        except ValueError:
-            models = resp.text
-        ids = None
-        try:
-            if isinstance(models, dict) and 'data' in models and isinstance(models['data'], list):
-                # Filter out embedding-only models
-                all_ids = [(m.get('id') or m.get('name')) for m in models['data']]
-                ids = [mid for mid in all_ids if mid and is_chat_model(mid)]
-        except Exception:
-            ids = None
-        result = {'models': models}
-        if ids is not None:
-            result['ids'] = ids
-        return jsonify(result)
-    except requests.exceptions.RequestException as re:
+        listing = model_list.get_listing()
+    except OllamaError as e:
         app.logger.exception('Error contacting Ollama /models')
-        resp = getattr(re, 'response', None)
-        detail = None
-        if resp is not None:
-            try:
-                detail = resp.text
-            except Exception:
-                detail = None
-        return jsonify({'error': str(re), 'detail': detail}), 502
+        return _ollama_error_response(e)
     except Exception as e:
         app.logger.exception('Unexpected error in chat_models')
         return jsonify({'error': str(e)}), 500
+    response = jsonify(listing.body)
+    response.set_etag(listing.etag)
+    response.headers['Cache-Control'] = f"private, max-age={int(config.MODELS_CACHE_TTL)}"
+    # 304 when the browser already has this listing
+    return response.make_conditional(request)
+
+
+def _ollama_error_response(e: OllamaError):
+    """502 for upstream errors, 504 for timeouts, 503 + Retry-After while the breaker is open."""
+    body = {'error': str(e), 'detail': e.detail}
+    if isinstance(e, OllamaCircuitOpen):
+        return jsonify(body), 503, {'Retry-After': str(int(config.OLLAMA_BREAKER_RESET_SECONDS))}
+    if isinstance(e, OllamaTimeout):
+        return jsonify(body), 504
+    return jsonify(body), 502
+
+
+def _save_chat_messages(session_id, username, message, model, assistant_reply, label=''):
+    """Persist the user message and assistant reply; never raises."""
+    if not session_id:
+        print(f"⚠️ No session_id provided{label} - messages NOT saved to database")
+        return
+    try:
+        print(f"💾 Saving messages to DB{label} for session: {session_id}")
+        conn = app.get_db_conn()
+        with conn.cursor() as cur:
+            # First verify the session exists and belongs to the user
+            cur.execute("""
+                SELECT username FROM chat_sessions WHERE session_id = %s
+            """, (session_id,))
+            session_row = cur.fetchone()
+
+            if not session_row:
+                print(f"⚠️ Session {session_id} not found in database - creating new session")
+                # Create the session if it doesn't exist
+                cur.execute("""
+                    INSERT INTO chat_sessions (session_id, username, title)
+                    VALUES (%s, %s, %s)
+                """, (session_id, username, 'New Chat'))
+                print(f"✅ Created missing session: {session_id}")
+            elif session_row[0] != username:
+                print(f"❌ Session {session_id} belongs to different user: {session_row[0]} != {username}")
+                raise Exception(f"Session does not belong to current user")
+
+            # Save user message
+            cur.execute("""
+                INSERT INTO chat_messages (session_id, role, content, model)
+                VALUES (%s, %s, %s, %s)
+            """, (session_id, 'user', message, model))
+            print(f"✅ Saved user message{label}")
+
+            if assistant_reply:
+                cur.execute("""
+                    INSERT INTO chat_messages (session_id, role, content, model)
+                    VALUES (%s, %s, %s, %s)
+                """, (session_id, 'assistant', assistant_reply, model))
+                print(f"✅ Saved assistant message{label}")
+
+            conn.commit()
+            print(f"✅ Database commit successful{label}")
+        conn.close()
+    except Exception as e:
+        app.logger.exception('Error saving chat messages to database')
+        print(f"❌ Error saving to database{label}: {e}")
+        # Don't fail the request if saving fails
+
+
+def _busy_response(e: admission.AdmissionRejected):
+    app.logger.warning(f'Chat admission rejected: {e}')
+    return jsonify({'error': str(e), 'retry_after': e.retry_after}), 429, {'Retry-After': str(e.retry_after)}
+
+
+def _stream_completion(model, messages, session_id, username, message, label='', ticket=None, on_reply=None):
+    """Relay Ollama's streamed completion as SSE and save the assembled reply at the end.
+
+    Events: ``data: {"delta": ...}`` per token chunk, then ``event: done``
+    with the full ``content`` (or ``event: error``). The admission ``ticket``
+    is released when the stream ends or the response is closed; ``on_reply``
+    gets the reply and whether it completed once it is saved.
+    """
+    def generate():
+        parts = []
+        complete = False
+        try:
+            lines = get_client().stream_chat_completion(model, messages, timeout=CHAT_STREAM_IDLE_TIMEOUT)
+            try:
+                for line in lines:
+                    delta = completion_delta(line)
+                    if delta is None:
+                        break
+                    if delta:
+                        parts.append(delta)
+                        yield sse_event({'delta': delta})
+            finally:
+                lines.close()
+            complete = True
+            yield sse_event({'content': ''.join(parts), 'model': model}, event='done')
+        except OllamaError as e:
+            app.logger.exception('Error streaming from Ollama /v1/chat/completions')
+            yield sse_event({'error': str(e)}, event='error')
+        finally:
+            if ticket is not None:
+                ticket.release()
+            # Runs on normal end, upstream errors and client disconnects alike
+            _save_chat_messages(session_id, username, message, model, ''.join(parts), label)
+            if on_reply is not None:
+                on_reply(''.join(parts), complete)
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    if ticket is not None:
+        # The generator's finally never runs if the client leaves before the first chunk
+        response.call_on_close(ticket.release)
+    return response
+
+
+def _cached_answer(model, answer, session_id, username, message, stream=False):
+    """Reply with an answer from the semantic answer cache, as JSON or as a one-chunk SSE stream."""
+    _save_chat_messages(session_id, username, message, model, answer, ' (answer cache)')
+    if not stream:
+        return jsonify(answer_cache.completion(model, answer))
+    body = sse_event({'delta': answer}) + sse_event({'content': answer, 'model': model, 'cached': True}, event='done')
+    return Response(body, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 
 @chat_bp.route('/chat/message', methods=['POST'])
@@ -225,8 +352,10 @@ def chat_message():
     model = body.get('model')
     message = body.get('message')
     image_b64 = body.get('image')
-    history = body.get('history', [])  # Get conversation history from client
-    session_id = body.get('session_id')  # Optional: session ID for persistence
+    session_id = body.get('session_id')  # Optional: session ID for persistence; history is loaded from it
+    # stream=true (or Accept: text/event-stream) relays tokens over SSE
+    stream = CHAT_STREAM_ENABLED and (str(body.get('stream', 'false')).lower() == 'true'
+                                      or 'text/event-stream' in request.headers.get('Accept', ''))
 
     # Debug logging
     username = session.get('nimbus_user')
@@ -235,8 +364,8 @@ def chat_message():
     print(f"Model: {model}")
     print(f"Message length: {len(message) if message else 0}")
     print(f"Session ID: {session_id}")
-    print(f"History length: {len(history)}")
     print(f"========================")
+    app.logger.debug(f"Chat message stream={stream}")
 
     if not model or not message:
         return jsonify({'error': 'model and message required'}), 400
@@ -244,284 +373,107 @@ def chat_message():
     if image_b64:
         message = f"{message}\n\n[IMAGE_BASE64]\n{image_b64}"
 
+    # Prior turns: from the stored session (trimmed to the token budget, older turns summarised),
+    # or the client-sent history for requests that are not persisted
+    summary, history, compact = None, [], False
+    if session_id:
+        try:
+            conn = app.get_db_conn()
+            try:
+                summary, history, compact = chat_history.load_history(conn, session_id, username, model)
+            finally:
+                conn.close()
+        except Exception:
+            app.logger.exception('Failed to load chat history')
+    else:
+        history = chat_history.client_history(body.get('history'), model)
+    app.logger.debug(f"History: {len(history)} turns{' + summary' if summary else ''}")
+
     # Attempt to compute message embedding and retrieve nearest document chunks
     system_context = None
+    label = ' (no docs path)'
+    cache_slot = None
     try:
         mappings = MODEL_EMBEDDING_TABLE_MAP.get(model) or []
-        
+
         # Before computing embeddings, check whether the user has any enabled documents
-        username = session.get('nimbus_user')
-        # fetch enabled filenames for this user
-        enabled_files = []
+        # (the search itself filters on documents.enabled, so no file list is needed)
+        doc_count, fingerprint = 0, None
         try:
             conn = app.get_db_conn()
-            with conn.cursor() as cur:
-                cur.execute("SELECT filename FROM documents WHERE uploader = %s AND enabled = TRUE", (username,))
-                rows = cur.fetchall()
-                enabled_files = [r[0] for r in rows]
+            doc_count, fingerprint = retrieval.enabled_documents(conn, username)
             conn.close()
         except Exception:
             app.logger.exception('Failed to query enabled documents')
 
-        print(f"Metadata: username: {username}, enabled_files={enabled_files}")
+        app.logger.debug(f"Metadata: username: {username}, enabled_documents={doc_count}")
 
-        # just proxy the chat request to Ollama normally
-        if not enabled_files:
-            print("No enabled documents; skipping retrieval and proxying chat directly")
-            url = f"{OLLAMA_URL}/v1/chat/completions"
-            # Build messages from history (exclude the last user message as we'll add current one)
-            messages = []
-            if history and len(history) > 1:
-                # Add all messages except the last one (which is the current message)
-                messages = history[:-1]
-            # Add current message
-            messages.append({'role': 'user', 'content': message})
-            payload = {'model': model, 'messages': messages}
-            headers = {'Content-Type': 'application/json'}
-            resp = requests.post(url, json=payload, headers=headers, timeout=CHAT_REQUEST_TIMEOUT)
-            resp.raise_for_status()
-            result = resp.json()
-            
-            # Save messages to database if session_id provided
-            if session_id:
-                try:
-                    username = session.get('nimbus_user')
-                    print(f"💾 Saving messages to DB for session: {session_id}")
-                    conn = app.get_db_conn()
-                    with conn.cursor() as cur:
-                        # First verify the session exists and belongs to the user
-                        cur.execute("""
-                            SELECT username FROM chat_sessions WHERE session_id = %s
-                        """, (session_id,))
-                        session_row = cur.fetchone()
-                        
-                        if not session_row:
-                            print(f"⚠️ Session {session_id} not found in database - creating new session")
-                            # Create the session if it doesn't exist
-                            cur.execute("""
-                                INSERT INTO chat_sessions (session_id, username, title)
-                                VALUES (%s, %s, %s)
-                            """, (session_id, username, 'New Chat'))
-                            print(f"✅ Created missing session: {session_id}")
-                        elif session_row[0] != username:
-                            print(f"❌ Session {session_id} belongs to different user: {session_row[0]} != {username}")
-                            raise Exception(f"Session does not belong to current user")
-                        
-                        # Save user message
-                        cur.execute("""
-                            INSERT INTO chat_messages (session_id, role, content, model)
-                            VALUES (%s, %s, %s, %s)
-                        """, (session_id, 'user', message, model))
-                        print(f"✅ Saved user message")
-                        
-                        # Extract and save assistant response
-                        assistant_reply = ''
-                        if result.get('choices') and result['choices'][0].get('message'):
-                            assistant_reply = result['choices'][0]['message'].get('content', '')
-                        
-                        if assistant_reply:
-                            cur.execute("""
-                                INSERT INTO chat_messages (session_id, role, content, model)
-                                VALUES (%s, %s, %s, %s)
-                            """, (session_id, 'assistant', assistant_reply, model))
-                            print(f"✅ Saved assistant message")
-                        
-                        conn.commit()
-                        print(f"✅ Database commit successful")
-                    conn.close()
-                except Exception as e:
-                    app.logger.exception('Error saving chat messages to database (no docs path)')
-                    print(f"❌ Error saving to database: {e}")
-                    # Don't fail the request if saving fails
-            else:
-                print(f"⚠️ No session_id provided - messages NOT saved to database")
-            
-            return jsonify(result)
-
-        print("Found enabled documents; proceeding with multi-model retrieval")
-        
-        # NEW APPROACH: Query each embedding model independently and merge results
-        all_results = []
-        seen_texts = set()
-        
-        conn = app.get_db_conn()
-        with conn.cursor() as cur:
-            for entry in mappings:
-                table_name = entry.get('table')
-                emb_model = entry.get('embedding_model')
-                
-                print(f"Querying table {table_name} with model {emb_model}")
-                
-                # Check if table exists first
-                try:
-                    cur.execute("""
-                        SELECT EXISTS (
-                            SELECT FROM information_schema.tables 
-                            WHERE table_schema = 'public' 
-                            AND table_name = %s
-                        )
-                    """, (table_name,))
-                    table_exists = cur.fetchone()[0]
-                    
-                    if not table_exists:
-                        print(f"  ⚠️ Table {table_name} does not exist, skipping")
-                        continue
-                except Exception as e:
-                    print(f"  ⚠️ Error checking table existence: {e}")
-                    continue
-                
-                # Compute embedding for this specific model
-                try:
-                    emb_ep = f"{OLLAMA_URL.rstrip('/')}/v1/embeddings"
-                    emb_payload = {'model': emb_model, 'input': message}
-                    emb_headers = {'Content-Type': 'application/json'}
-                    eresp = requests.post(emb_ep, json=emb_payload, headers=emb_headers, timeout=EMBEDDING_REQUEST_TIMEOUT)
-                    eresp.raise_for_status()
-                    edata = eresp.json()
-                    
-                    vec = None
-                    if isinstance(edata, dict) and 'data' in edata and isinstance(edata['data'], list):
-                        vec = edata['data'][0].get('embedding')
-                    
-                    if vec:
-                        vector_str = '[' + ','.join([str(float(x)) for x in vec]) + ']'
-                        # Get top K from this embedding model's table
-                        sql = f"SELECT filename, text, embedding <-> %s::vector AS distance FROM {table_name} WHERE filename = ANY(%s) ORDER BY distance ASC LIMIT %s"
-                        cur.execute(sql, (vector_str, enabled_files, RAG_TOP_K_PER_MODEL))
-                        rows = cur.fetchall()
-                        
-                        for r in rows:
-                            fn, txt, dist = r[0], r[1], r[2]
-                            # Deduplicate based on text content (first 1000 chars)
-                            key = (fn, (txt or '')[:1000])
-                            if key in seen_texts:
-                                continue
-                            seen_texts.add(key)
-                            # Track which model found this chunk
-                            all_results.append((fn, txt or '', dist, emb_model))
-                            print(f"  Found chunk from {fn} (distance: {dist:.4f}, model: {emb_model})")
-                    else:
-                        print(f"  No embedding vector returned for model {emb_model}")
-                        
-                except Exception as e:
-                    print(f"  Error querying with model {emb_model}: {e}")
-                    app.logger.exception(f'Failed to retrieve with model {emb_model}')
-                    continue
-        
-        conn.close()
+        # A standalone question this user asked before over the same document versions is answered from the cache
+        if doc_count and answer_cache.cacheable(message, history, summary, image_b64):
+            emb_model = mappings[0].get('embedding_model') if mappings else config.DEFAULT_EMBEDDING_MODEL
+            qvec = retrieval.query_embedding(app._get_current_object(), emb_model, message)
+            if qvec:
+                cache_slot = (answer_cache.bucket(username, model, emb_model, fingerprint, strict_flag), qvec)
+                hit = answer_cache.cache.lookup(*cache_slot)
+                if hit:
+                    app.logger.debug(f"Answer cache hit (similarity {hit[1]:.4f})")
+                    return _cached_answer(model, hit[0], session_id, username, message, stream)
 
-        # Sort all results by distance and take top K overall
-        if all_results:
-            all_results.sort(key=lambda x: x[2])  # Sort by distance
-            top = all_results[:RAG_TOP_K_OVERALL]
-            snippets = []
-            print(f"Selected top {len(top)} chunks from {len(all_results)} total results:")
-            for fn, txt, dist, emb_model in top:
-                snippet = txt[:RAG_SNIPPET_MAX_CHARS]
-                # Don't include model metadata in LLM context - just the content
-                snippets.append(f"[Source: {fn}]\n{snippet}")
-                # But log it for debugging
-                print(f"  - {fn} (distance: {dist:.4f}, model: {emb_model})")
-            system_context = "\n\n--- Retrieved documents:\n" + "\n\n".join(snippets)
+        if not doc_count:
+            # just proxy the chat request to Ollama normally
+            print("No enabled documents; skipping retrieval and proxying chat directly")
         else:
-            print("⚠️ No results found from any embedding model - some tables may not exist yet")
-            print("💡 Tip: Generate embeddings for your enabled documents first")
-            
+            label = ' (RAG)'
+            print("Found enabled documents; proceeding with multi-model retrieval")
+
+            # Embed and search every mapped model concurrently, then merge results
+            all_results = retrieval.retrieve(app._get_current_object(), mappings, message, username)
+            for fn, _, dist, emb_model, *_ in all_results:
+                print(f"  Found chunk from {fn} ({describe_distance(dist)}, model: {emb_model})")
+
+            system_context = format_context(all_results, model)
+            if not system_context:
+                print("⚠️ No results found from any embedding model - some tables may not exist yet")
+                print("💡 Tip: Generate embeddings for your enabled documents first")
+
     except Exception:
         # don't fail chat if retrieval fails; just continue without context
         app.logger.exception('Failed to compute embeddings or retrieve documents')
 
+    messages = build_messages(history, message, system_context, strict_flag, summary)
+
+    def after_reply(reply, complete):
+        if compact:
+            chat_history.schedule_compaction(session_id, username, model)
+        if complete and cache_slot:
+            answer_cache.cache.store(cache_slot[0], cache_slot[1], message, reply)
+
+    # Wait for a completion slot for this model (fair per-user queue) or fail fast with 429
     try:
-        url = f"{OLLAMA_URL}/v1/chat/completions"
-        messages = []
-        
-        # Add conversation history (exclude the last user message which we'll add separately)
-        if history and len(history) > 1:
-            # Add all previous messages except the last one
-            for msg in history[:-1]:
-                messages.append({'role': msg.get('role'), 'content': msg.get('content')})
-        
-        # Add system context if documents are enabled
-        if system_context:
-            # if strict flag isn't explicitly 'false', prepend a strict system instruction
-            if strict_flag != 'false':
-                messages.insert(0, {'role': 'system', 'content': STRICT_DOCS_INSTRUCTION})
-            messages.insert(1 if strict_flag != 'false' else 0, {'role': 'system', 'content': system_context})
-        
-        # Add current user message
-        messages.append({'role': 'user', 'content': message})
-        
-        payload = {'model': model, 'messages': messages}
-        headers = {'Content-Type': 'application/json'}
-        resp = requests.post(url, json=payload, headers=headers, timeout=CHAT_REQUEST_TIMEOUT)
-        resp.raise_for_status()
-        result = resp.json()
-        
-        # Save messages to database if session_id provided
-        if session_id:
-            try:
-                username = session.get('nimbus_user')
-                print(f"💾 Saving messages to DB (RAG path) for session: {session_id}")
-                conn = app.get_db_conn()
-                with conn.cursor() as cur:
-                    # First verify the session exists and belongs to the user
-                    cur.execute("""
-                        SELECT username FROM chat_sessions WHERE session_id = %s
-                    """, (session_id,))
-                    session_row = cur.fetchone()
-                    
-                    if not session_row:
-                        print(f"⚠️ Session {session_id} not found in database - creating new session")
-                        # Create the session if it doesn't exist
-                        cur.execute("""
-                            INSERT INTO chat_sessions (session_id, username, title)
-                            VALUES (%s, %s, %s)
-                        """, (session_id, username, 'New Chat'))
-                        print(f"✅ Created missing session: {session_id}")
-                    elif session_row[0] != username:
-                        print(f"❌ Session {session_id} belongs to different user: {session_row[0]} != {username}")
-                        raise Exception(f"Session does not belong to current user")
-                    
-                    # Save user message
-                    cur.execute("""
-                        INSERT INTO chat_messages (session_id, role, content, model)
-                        VALUES (%s, %s, %s, %s)
-                    """, (session_id, 'user', message, model))
-                    print(f"✅ Saved user message (RAG)")
-                    
-                    # Extract and save assistant response
-                    assistant_reply = ''
-                    if result.get('choices') and result['choices'][0].get('message'):
-                        assistant_reply = result['choices'][0]['message'].get('content', '')
-                    
-                    if assistant_reply:
-                        cur.execute("""
-                            INSERT INTO chat_messages (session_id, role, content, model)
-                            VALUES (%s, %s, %s, %s)
-                        """, (session_id, 'assistant', assistant_reply, model))
-                        print(f"✅ Saved assistant message (RAG)")
-                    
-                    conn.commit()
-                    print(f"✅ Database commit successful (RAG)")
-                conn.close()
-            except Exception as e:
-                app.logger.exception('Error saving chat messages to database')
-                print(f"❌ Error saving to database (RAG): {e}")
-                # Don't fail the request if saving fails
-        else:
-            print(f"⚠️ No session_id provided (RAG path) - messages NOT saved to database")
-        
+        ticket = admission.acquire(model, username)
+    except admission.AdmissionRejected as e:
+        return _busy_response(e)
+
+    if stream:
+        return _stream_completion(model, messages, session_id, username, message, label, ticket, after_reply)
+
+    try:
+        try:
+            result = get_client().chat_completion(model, messages, timeout=CHAT_REQUEST_TIMEOUT)
+        finally:
+            ticket.release()
+
+        # Extract and save assistant response
+        assistant_reply = ''
+        if result.get('choices') and result['choices'][0].get('message'):
+            assistant_reply = result['choices'][0]['message'].get('content', '')
+        _save_chat_messages(session_id, username, message, model, assistant_reply, label)
+        after_reply(assistant_reply, True)
+
         return jsonify(result)
-    except requests.exceptions.RequestException as re:
+    except OllamaError as e:
         app.logger.exception('Error proxying to Ollama /v1/chat/completions')
-        resp = getattr(re, 'response', None)
-        detail = None
-        if resp is not None:
-            try:
-                detail = resp.text
-            except Exception:
-                detail = None
-        return jsonify({'error': str(re), 'detail': detail}), 502
+        return _ollama_error_response(e)
     except Exception as e:
         app.logger.exception('Unexpected error in chat_message')
         return jsonify({'error': str(e)}), 500
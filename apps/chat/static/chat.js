@@ -85,6 +85,43 @@ function appendMessage(role, text, imgSrc) {
   
   w.appendChild(messageDiv);
   w.scrollTop = w.scrollHeight;
+  return bubble;
+}
+
+// Read a text/event-stream response, growing the bubble as tokens arrive.
+// Resolves with the full reply; rejects on an `error` event.
+async function readChatStream(resp, bubble) {
+  const w = document.getElementById('chatWindow');
+  const reader = resp.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let reply = '';
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let sep;
+    while ((sep = buffer.indexOf('\n\n')) !== -1) {
+      const raw = buffer.slice(0, sep);
+      buffer = buffer.slice(sep + 2);
+      let event = 'message';
+      let data = '';
+      raw.split('\n').forEach(line => {
+        if (line.startsWith('event:')) event = line.slice(6).trim();
+        else if (line.startsWith('data:')) data += line.slice(5).trim();
+      });
+      if (!data) continue;
+      const payload = JSON.parse(data);
+      if (event === 'error') throw new Error(payload.error || 'stream failed');
+      if (event === 'done') return payload.content || reply;
+      if (payload.delta) {
+        reply += payload.delta;
+        bubble.innerText = reply;
+        w.scrollTop = w.scrollHeight;
+      }
+    }
+  }
+  return reply;
 }
 
 document.addEventListener('DOMContentLoaded', () => {
@@ -369,8 +406,8 @@ document.addEventListener('DOMContentLoaded', () => {
       model, 
       message: text, 
       image: imageBase64,
-      history: conversationHistory,  // Send full conversation history
-      session_id: currentSessionId   // Include session ID for persistence
+      session_id: currentSessionId,  // Server rebuilds the history from this session
+      stream: true                   // Relay tokens as they are generated (SSE)
     };
     
     // Debug logging
@@ -388,6 +425,18 @@ document.addEventListener('DOMContentLoaded', () => {
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify(payload)
       });
+      if (resp.ok && (resp.headers.get('Content-Type') || '').includes('text/event-stream')) {
+        const bubble = appendMessage('assistant', '…');
+        try {
+          const reply = await readChatStream(resp, bubble);
+          bubble.innerText = reply;
+          conversationHistory.push({ role: 'assistant', content: reply });
+        } catch (err) {
+          bubble.innerText = 'Error: ' + err.message;
+        }
+        loadChatSessions();
+        return;
+      }
       let data;
       try {
         data = await resp.json();
@@ -0,0 +1,144 @@
+"""
+Chunks of a document in ``document_chunks``, one row per chunk.
+
+A chunk's id is ``chunk_sync.chunk_id(document_id, ordinal, content_hash)``,
+so it changes whenever the text at an ordinal changes. Embedding rows
+reference it (``chunk_id``, ``ON DELETE CASCADE``) instead of repeating the
+text: replacing or dropping a chunk removes the vectors computed from its
+old text, and retrieval reads the text through the join.
+
+Chunks are written and read in batches of ``DOCUMENT_CHUNK_BATCH_SIZE``, so
+neither side holds a whole document's chunks in one statement or result.
+"""
+import json
+from typing import Iterable, Iterator, List
+
+import psycopg2.extras
+
+import config
+from .chunk_sync import chunk_id
+from .embedding_cache import text_hash
+
+
+def _batches(items: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _locate(parsed_text: str, text: str, start: int):
+    """Character span of ``text`` in ``parsed_text`` at or after ``start``, or ``(None, None)``.
+
+    Splitters that normalise whitespace produce chunks that are not verbatim
+    substrings; those get no offsets.
+    """
+    if not parsed_text or not text:
+        return None, None
+    pos = parsed_text.find(text, start)
+    if pos == -1:
+        return None, None
+    return pos, pos + len(text)
+
+
+def _records(document_id: str, splits: Iterable, parsed_text: str = None) -> Iterator[tuple]:
+    search_from = 0
+    for ordinal, chunk in enumerate(splits):
+        if isinstance(chunk, dict):
+            text, meta = chunk.get('text') or '', chunk.get('meta') or {}
+        else:
+            text, meta = str(chunk), {}
+        h = text_hash(text)
+        start, end = _locate(parsed_text, text, search_from)
+        if start is not None:
+            # Overlapping chunks start before the previous one ends
+            search_from = start + 1
+        yield (chunk_id(document_id, ordinal, h), document_id, ordinal, text, start, end, json.dumps(meta), h)
+
+
+def write_chunks(conn, document_id: str, splits: Iterable, parsed_text: str = None, splitter_name: str = None,
+                 batch_size: int = None) -> int:
+    """Replace the document's chunks with ``splits`` (dicts with ``text`` and ``meta``, or strings).
+
+    Chunks whose text is unchanged keep their row (and the embeddings that
+    reference it); a changed one is deleted and re-inserted under its new
+    id. Runs as one transaction so readers never see a half-written split.
+    Returns the chunk count.
+    """
+    batch_size = max(1, batch_size or config.DOCUMENT_CHUNK_BATCH_SIZE)
+    count = 0
+    try:
+        with conn.cursor() as cur:
+            for batch in _batches(_records(document_id, splits, parsed_text), batch_size):
+                # Drop chunks at these ordinals whose text changed; their embeddings go with them
+                cur.execute(
+                    "DELETE FROM document_chunks WHERE document_id = %s AND ordinal = ANY(%s) AND id <> ALL(%s)",
+                    (document_id, [r[2] for r in batch], [r[0] for r in batch]),
+                )
+                psycopg2.extras.execute_values(
+                    cur,
+                    "INSERT INTO document_chunks (id, document_id, ordinal, text, start_offset, end_offset, metadata, content_hash) "
+                    "VALUES %s ON CONFLICT (id) DO UPDATE SET start_offset = EXCLUDED.start_offset, "
+                    "end_offset = EXCLUDED.end_offset, metadata = EXCLUDED.metadata",
+                    batch,
+                    template='(%s, %s, %s, %s, %s, %s, %s::jsonb, %s)',
+                    page_size=len(batch),
+                )
+                count += len(batch)
+            cur.execute("DELETE FROM document_chunks WHERE document_id = %s AND ordinal >= %s", (document_id, count))
+            if splitter_name:
+                cur.execute("UPDATE documents SET chunk_count = %s, splitter_name = %s WHERE id = %s",
+                            (count, splitter_name, document_id))
+            else:
+                cur.execute("UPDATE documents SET chunk_count = %s WHERE id = %s", (count, document_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return count
+
+
+def chunk_hashes(conn, document_id: str) -> List[str]:
+    """Content hashes of the document's chunks, indexed by ordinal."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT content_hash FROM document_chunks WHERE document_id = %s ORDER BY ordinal", (document_id,))
+        return [h for (h,) in cur.fetchall()]
+
+
+def iter_chunks(conn, document_id: str, ordinals: List[int] = None, batch_size: int = None) -> Iterator[list]:
+    """Yield the document's chunks in ordinal order as batches of ``(ordinal, chunk_id, content_hash, text)``.
+
+    Each batch is its own keyset query, so the caller may commit on ``conn``
+    between batches. ``ordinals`` restricts the read to those chunks.
+    """
+    batch_size = max(1, batch_size or config.DOCUMENT_CHUNK_BATCH_SIZE)
+    if ordinals is not None:
+        ordinals = sorted(ordinals)
+        for start in range(0, len(ordinals), batch_size):
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT ordinal, id, content_hash, text FROM document_chunks "
+                    "WHERE document_id = %s AND ordinal = ANY(%s) ORDER BY ordinal",
+                    (document_id, ordinals[start:start + batch_size]),
+                )
+                rows = cur.fetchall()
+            if rows:
+                yield rows
+        return
+    last = -1
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT ordinal, id, content_hash, text FROM document_chunks "
+                "WHERE document_id = %s AND ordinal > %s ORDER BY ordinal LIMIT %s",
+                (document_id, last, batch_size),
+            )
+            rows = cur.fetchall()
+        if not rows:
+            return
+        yield rows
+        last = rows[-1][0]
@@ -0,0 +1,82 @@
+"""
+Incremental sync of a document's chunks into an embedding table.
+
+Every embedding row is identified by ``(document_id, ordinal)`` and carries
+the SHA-256 of the text it was computed from in ``content_hash``;
+``chunk_id`` combines the three into one stable string and is the key of
+the chunk's row in ``document_chunks``, where the text lives (see
+``chunk_store``). Re-embedding a document compares the chunk hashes with
+the stored ones and only touches what changed:
+
+* same ordinal, same hash  -> left alone
+* new ordinal or new hash  -> upserted (``ON CONFLICT (document_id, ordinal)``)
+* ordinal past the new end -> deleted
+
+Rows written before chunk identity existed (NULL ``document_id``) are
+dropped the first time their document is synced.
+"""
+from typing import Dict, List, Sequence
+
+from .vector_writer import write_embeddings
+
+SYNC_COLUMNS = ('document_id', 'ordinal', 'chunk_id', 'content_hash', 'filename', 'embedding')
+
+
+def chunk_id(document_id: str, ordinal: int, content_hash: str) -> str:
+    return f"{document_id}:{ordinal}:{content_hash[:16]}"
+
+
+def load_chunk_hashes(conn, table_name: str, document_id: str) -> Dict[int, str]:
+    """``{ordinal: content_hash}`` currently stored for the document."""
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT ordinal, content_hash FROM {table_name} WHERE document_id = %s", (document_id,))
+        return {ordinal: content_hash for ordinal, content_hash in cur.fetchall()}
+
+
+def diff_chunks(existing: Dict[int, str], hashes: Sequence[str]) -> dict:
+    """Split new chunk ordinals into changed/unchanged and find stale ordinals.
+
+    A stored NULL hash (e.g. a placeholder vector) always counts as changed.
+    """
+    changed = []
+    unchanged = []
+    inserted = 0
+    for ordinal, h in enumerate(hashes):
+        stored = existing.get(ordinal)
+        if stored is not None and stored == h:
+            unchanged.append(ordinal)
+        else:
+            changed.append(ordinal)
+            if ordinal not in existing:
+                inserted += 1
+    stale = sorted(o for o in existing if o >= len(hashes))
+    return {'changed': changed, 'unchanged': unchanged, 'inserted': inserted,
+            'updated': len(changed) - inserted, 'stale': stale}
+
+
+def apply_chunk_diff(conn, table_name: str, document_id: str, filename: str, rows: List[tuple], chunk_count: int) -> dict:
+    """Upsert ``rows``, then remove chunks at or past ``chunk_count``.
+
+    ``rows`` are ``(ordinal, chunk_id, content_hash, vector)``; a ``None``
+    hash is stored as-is so the chunk is re-embedded next time. ``rows`` may
+    be a generator; it is consumed while writing. Commits per batch. Stale
+    and legacy rows are only deleted once every new vector is written, so a
+    failed embed leaves the old ones searchable.
+    """
+    records = (
+        (document_id, ordinal, chunk, h, filename, vec)
+        for ordinal, chunk, h, vec in rows
+    )
+    written = write_embeddings(
+        conn, table_name, records, columns=SYNC_COLUMNS,
+        on_conflict=("(document_id, ordinal) DO UPDATE SET chunk_id = EXCLUDED.chunk_id, content_hash = EXCLUDED.content_hash, "
+                     "filename = EXCLUDED.filename, text = NULL, embedding = EXCLUDED.embedding"),
+    )
+
+    with conn.cursor() as cur:
+        cur.execute(f"DELETE FROM {table_name} WHERE filename = %s AND document_id IS NULL", (filename,))
+        legacy = cur.rowcount
+        cur.execute(f"DELETE FROM {table_name} WHERE document_id = %s AND ordinal >= %s", (document_id, chunk_count))
+        deleted = cur.rowcount
+    conn.commit()
+    return {'written': written, 'deleted': deleted, 'legacy_deleted': legacy}
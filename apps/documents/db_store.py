@@ -1,118 +1,112 @@
 from flask import current_app
+import base64
 import uuid
 from datetime import datetime
 import json
 import psycopg2.extras
 
+import config
+import embedding_registry
 
-def ensure_table():
-    """Create documents table if it doesn't exist."""
-    conn = current_app.get_db_conn()
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS documents (
-                    id TEXT PRIMARY KEY,
-                    filename TEXT NOT NULL,
-                    uploader TEXT,
-                    created_at TIMESTAMP,
-                    enabled BOOLEAN DEFAULT FALSE,
-                    parsing_status TEXT,
-                    size INTEGER,
-                    file_path TEXT,
-                    parser_name TEXT,
-                    parsed_text TEXT,
-                    splitter_name TEXT,
-                    splits JSON,
-                    embeddings_model TEXT,
-                    embeddings BOOLEAN DEFAULT FALSE
-                )
-                """
-            )
-        conn.commit()
-    finally:
-        conn.close()
 
+# Columns the documents page shows; large ones (parsed_text) are never listed
+_LIST_COLUMNS = "id, filename, uploader, created_at, enabled, parsing_status, size, file_path, parser_name, splitter_name, embeddings_model, chunk_count, embeddings"
 
-def list_uploaded_files(username):
-    ensure_table()
-    conn = current_app.get_db_conn()
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-                "SELECT id, filename, uploader, created_at, enabled, parsing_status, size, file_path, parser_name, splitter_name, embeddings_model, splits, embeddings FROM documents WHERE uploader = %s ORDER BY created_at DESC",
-                (username,)
-            )
-            rows = cur.fetchall()
-    finally:
-        conn.close()
-    files = []
-    for r in rows:
-        id, filename, uploader, created_at, enabled, parsing_status, size, file_path, parser_name, splitter_name, embeddings_model, splits, embeddings = r
-        files.append({
-            'id': id,
-            'filename': filename,
-            'uploader': uploader,
-            'created_at': created_at.isoformat() if created_at else None,
-            'enabled': enabled,
-            'parsing_status': parsing_status,
-            'size': size,
-            'file_path': file_path,
-            'parser_name': parser_name,
-            'splitter_name': splitter_name,
-            'embeddings_model': embeddings_model,
-            'has_splits': bool(splits),
-            'has_embeddings': bool(embeddings),
-        })
-    return files
 
+def _file_dict(row):
+    id, filename, uploader, created_at, enabled, parsing_status, size, file_path, parser_name, splitter_name, embeddings_model, chunk_count, embeddings = row
+    return {
+        'id': id,
+        'filename': filename,
+        'uploader': uploader,
+        'created_at': created_at.isoformat() if created_at else None,
+        'enabled': enabled,
+        'parsing_status': parsing_status,
+        'size': size,
+        'file_path': file_path,
+        'parser_name': parser_name,
+        'splitter_name': splitter_name,
+        'embeddings_model': embeddings_model,
+        'has_splits': bool(chunk_count),
+        'chunk_count': chunk_count,
+        'has_embeddings': bool(embeddings),
+    }
 
-def set_parsed_text(filename: str, text: str, parser_name: str = None):
-    ensure_table()
+
+def encode_cursor(created_at: datetime, doc_id: str) -> str:
+    """Opaque keyset cursor for the position after ``(created_at, id)``."""
+    raw = json.dumps([created_at.isoformat(), doc_id])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """``(created_at, id)`` from ``encode_cursor``; raises ``ValueError`` for anything else."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        created_at, doc_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), str(doc_id)
+    except Exception:
+        raise ValueError('invalid cursor')
+
+
+def list_documents(username, limit: int = None, cursor: str = None) -> tuple:
+    """One page of the user's documents, newest first: ``(files, next_cursor)``.
+
+    Keyset pagination on ``(created_at, id)`` over
+    ``idx_documents_uploader_created``, so every page costs the same however
+    deep it is. ``next_cursor`` is ``None`` on the last page.
+    """
+    limit = max(1, min(limit or config.DOCUMENTS_PAGE_SIZE, config.DOCUMENTS_PAGE_MAX))
+    after = decode_cursor(cursor) if cursor else None
     conn = current_app.get_db_conn()
     try:
         with conn.cursor() as cur:
-            cur.execute("UPDATE documents SET parsing_status = %s, file_path = file_path, parser_name = %s, parsed_text = %s WHERE filename = %s RETURNING id", ('Parsed', parser_name, text, filename))
-            row = cur.fetchone()
-        conn.commit()
-        return bool(row)
+            if after:
+                cur.execute(
+                    f"SELECT {_LIST_COLUMNS} FROM documents WHERE uploader = %s AND (created_at, id) < (%s, %s) "
+                    "ORDER BY created_at DESC, id DESC LIMIT %s",
+                    (username, after[0], after[1], limit + 1)
+                )
+            else:
+                cur.execute(
+                    f"SELECT {_LIST_COLUMNS} FROM documents WHERE uploader = %s ORDER BY created_at DESC, id DESC LIMIT %s",
+                    (username, limit + 1)
+                )
+            rows = cur.fetchall()
     finally:
         conn.close()
+    next_cursor = encode_cursor(rows[limit - 1][3], rows[limit - 1][0]) if len(rows) > limit else None
+    return [_file_dict(r) for r in rows[:limit]], next_cursor
 
 
-def set_splits(filename: str, splits_json: str):
-    """Store splits (JSON string) into the splits column."""
-    ensure_table()
+def document_summary(username) -> dict:
+    """Per-user document counts by status, kept current by a trigger on ``documents``."""
     conn = current_app.get_db_conn()
     try:
         with conn.cursor() as cur:
-            cur.execute("UPDATE documents SET splits = %s WHERE filename = %s RETURNING id", (splits_json, filename))
+            cur.execute("SELECT total, parsed, split, embedded, enabled FROM document_status_counts WHERE uploader = %s",
+                        (username,))
             row = cur.fetchone()
-        conn.commit()
-        return bool(row)
     finally:
         conn.close()
+    total, parsed, split, embedded, enabled = row or (0, 0, 0, 0, 0)
+    return {'total': total, 'parsed': parsed, 'split': split, 'embedded': embedded, 'enabled': enabled,
+            'unparsed': total - parsed}
 
 
-def set_splits_with_meta(filename: str, splits_json: str, splitter_name: str = None):
-    """Store splits and optionally record which splitter was used."""
-    ensure_table()
+def set_parsed_text(filename: str, text: str, parser_name: str = None):
     conn = current_app.get_db_conn()
     try:
         with conn.cursor() as cur:
-            if splitter_name:
-                cur.execute("UPDATE documents SET splits = %s, splitter_name = %s WHERE filename = %s RETURNING id", (splits_json, splitter_name, filename))
-            else:
-                cur.execute("UPDATE documents SET splits = %s WHERE filename = %s RETURNING id", (splits_json, filename))
+            cur.execute("UPDATE documents SET parsing_status = %s, file_path = file_path, parser_name = %s, parsed_text = %s WHERE filename = %s RETURNING id", ('Parsed', parser_name, text, filename))
             row = cur.fetchone()
         conn.commit()
         return bool(row)
     finally:
         conn.close()
 
+
 def get_embeddings(filename: str):
-    ensure_table()
     conn = current_app.get_db_conn()
     try:
         with conn.cursor() as cur:
@@ -125,22 +119,7 @@ def get_embeddings(filename: str):
         conn.close()
 
 
-def get_splits(filename: str):
-    ensure_table()
-    conn = current_app.get_db_conn()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT splits FROM documents WHERE filename = %s LIMIT 1", (filename,))
-            row = cur.fetchone()
-        if not row:
-            return None
-        return row[0]
-    finally:
-        conn.close()
-
-
 def save_metadata(record: dict):
-    ensure_table()
     conn = current_app.get_db_conn()
     try:
         new_id = record.get('id') or str(uuid.uuid4())
@@ -166,40 +145,20 @@ def save_metadata(record: dict):
 
 
 def find_file(filename: str):
-    ensure_table()
     conn = current_app.get_db_conn()
     try:
         with conn.cursor() as cur:
-            cur.execute(
-                "SELECT id, filename, uploader, created_at, enabled, parsing_status, size, file_path, parser_name, splitter_name, embeddings_model, splits, embeddings FROM documents WHERE filename = %s LIMIT 1",
-                (filename,),
-            )
+            cur.execute(f"SELECT {_LIST_COLUMNS} FROM documents WHERE filename = %s LIMIT 1", (filename,))
             row = cur.fetchone()
     finally:
         conn.close()
     if not row:
         return None
-    id, filename, uploader, created_at, enabled, parsing_status, size, file_path, parser_name, splitter_name, embeddings_model, splits, embeddings = row
-    return {
-        'id': id,
-        'filename': filename,
-        'uploader': uploader,
-        'created_at': created_at.isoformat() if created_at else None,
-        'enabled': enabled,
-        'parsing_status': parsing_status,
-        'size': size,
-        'file_path': file_path,
-        'parser_name': parser_name,
-        'splitter_name': splitter_name,
-        'embeddings_model': embeddings_model,
-        'has_splits': bool(splits),
-        'has_embeddings': bool(embeddings),
-    }
+    return _file_dict(row)
 
 
 def update_metadata(filename: str, patch: dict):
-    ensure_table()
-    allowed = {'filename', 'uploader', 'enabled', 'parsing_status', 'size', 'file_path', 'embeddings', 'embeddings_model'}
+    allowed = {'filename', 'uploader', 'enabled', 'parsing_status', 'size', 'file_path', 'embeddings', 'embeddings_model', 'embedded_at'}
     sets = []
     vals = []
     for k, v in patch.items():
@@ -223,7 +182,6 @@ def update_metadata(filename: str, patch: dict):
 
 def delete_file(filename: str):
     """Delete file record, remove local file, and cascade delete embeddings from all embedding tables."""
-    ensure_table()
     conn = current_app.get_db_conn()
     try:
         with conn.cursor() as cur:
@@ -240,15 +198,9 @@ def delete_file(filename: str):
                     # ignore file removal errors
                     pass
             
-            # CASCADE DELETE: Dynamically find all embedding tables and remove embeddings
-            # This future-proofs against new embedding models being added
-            cur.execute("""
-                SELECT table_name 
-                FROM information_schema.tables 
-                WHERE table_schema = 'public' 
-                AND table_name LIKE 'document_embeddings_%'
-            """)
-            embedding_tables = [row[0] for row in cur.fetchall()]
+            # CASCADE DELETE: remove embeddings from every registered embedding table
+            # (rows written since document_chunks also go with the chunks)
+            embedding_tables = sorted(embedding_registry.tables(conn))
             
             total_deleted = 0
             for table in embedding_tables:
@@ -0,0 +1,74 @@
+"""
+Batched embedding requests for document ingestion.
+
+The OpenAI-compatible ``/v1/embeddings`` endpoint accepts a list of inputs,
+so chunks are grouped into batches of at most ``EMBEDDING_BATCH_SIZE``
+inputs and ``EMBEDDING_BATCH_MAX_CHARS`` characters (long chunks make
+smaller batches). A batch that fails is split in half and retried until
+the failing chunk is isolated; only that chunk comes back as ``None``.
+Unreachable-Ollama errors are not split since smaller batches cannot fix
+them (transient 5xx are already retried by ``ollama_client``).
+"""
+import logging
+from typing import List, Optional
+
+import config
+from ollama_client import get_client, OllamaUnavailable
+
+logger = logging.getLogger(__name__)
+
+
+def make_batches(texts: List[str], max_inputs: int = None, max_chars: int = None) -> List[List[int]]:
+    """Group text indexes into batches bounded by input count and total characters."""
+    max_inputs = max(1, max_inputs or config.EMBEDDING_BATCH_SIZE)
+    max_chars = max(1, max_chars or config.EMBEDDING_BATCH_MAX_CHARS)
+    batches = []
+    cur = []
+    cur_chars = 0
+    for i, text in enumerate(texts):
+        tlen = len(text)
+        if cur and (len(cur) >= max_inputs or cur_chars + tlen > max_chars):
+            batches.append(cur)
+            cur = []
+            cur_chars = 0
+        cur.append(i)
+        cur_chars += tlen
+    if cur:
+        batches.append(cur)
+    return batches
+
+
+def _embed_indexes(client, model, texts, indexes, out):
+    try:
+        vectors = client.embeddings(model, [texts[i] for i in indexes], timeout=config.EMBEDDING_REQUEST_TIMEOUT)
+    except OllamaUnavailable as e:
+        # Ollama is unreachable; splitting the batch would not help
+        logger.warning(f"Embedding batch of {len(indexes)} failed with {model}: {e}")
+        return
+    except Exception as e:
+        if len(indexes) == 1:
+            logger.warning(f"Embedding failed for chunk {indexes[0]} with {model}: {e}")
+            return
+        mid = len(indexes) // 2
+        logger.info(f"Embedding batch of {len(indexes)} failed ({e}); retrying as {mid} + {len(indexes) - mid}")
+        _embed_indexes(client, model, texts, indexes[:mid], out)
+        _embed_indexes(client, model, texts, indexes[mid:], out)
+        return
+    for i, vec in zip(indexes, vectors):
+        out[i] = vec
+
+
+def embed_texts(model: str, texts: List[str], progress=None) -> List[Optional[list]]:
+    """Embed ``texts`` with ``model`` in batches; failed chunks are ``None``.
+
+    ``progress(current, total, unit)`` is called after each batch.
+    """
+    client = get_client(role='embed')
+    out = [None] * len(texts)
+    done = 0
+    for batch in make_batches(texts):
+        _embed_indexes(client, model, texts, batch, out)
+        done += len(batch)
+        if progress:
+            progress(done, len(texts), 'chunks')
+    return out
@@ -0,0 +1,169 @@
+"""
+Content-addressed embedding cache.
+
+Vectors are stored in ``embedding_cache`` keyed by ``(embedding_model,
+sha256(text))``, so the same chunk text is only ever embedded once per
+model no matter which document, split run or splitter produced it.
+``embed_texts_cached`` is the entry point for ingestion: it looks up every
+chunk in one query, sends only the misses to Ollama and stores the new
+vectors in bulk. Entries unused for ``EMBEDDING_CACHE_MAX_AGE_DAYS`` or
+beyond ``EMBEDDING_CACHE_MAX_ROWS`` are removed by ``evict``.
+"""
+import hashlib
+import json
+import logging
+import threading
+from typing import Dict, List, Optional
+
+import config
+from db_pool import get_db_conn
+from .embedder import embed_texts
+from .vector_writer import write_embeddings
+
+logger = logging.getLogger(__name__)
+
+_stats_lock = threading.Lock()
+_stats = {'lookups': 0, 'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0}
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256((text or '').encode('utf-8')).hexdigest()
+
+
+def _count(**deltas):
+    with _stats_lock:
+        for key, value in deltas.items():
+            _stats[key] += value
+
+
+def stats() -> dict:
+    """Hit/miss counters for this process."""
+    with _stats_lock:
+        snapshot = dict(_stats)
+    looked_up = snapshot['hits'] + snapshot['misses']
+    snapshot['hit_rate'] = round(snapshot['hits'] / looked_up, 4) if looked_up else None
+    return snapshot
+
+
+def lookup(conn, model: str, hashes: List[str]) -> Dict[str, list]:
+    """Return ``{hash: vector}`` for the cached subset of ``hashes`` and mark them used."""
+    unique = list(set(hashes))
+    if not unique:
+        return {}
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT text_hash, embedding::text FROM embedding_cache WHERE embedding_model = %s AND text_hash = ANY(%s)",
+            (model, unique),
+        )
+        found = {h: json.loads(vec) for h, vec in cur.fetchall()}
+        if found:
+            # Only touch entries whose timestamp is stale, so hot chunks don't rewrite rows on every lookup
+            cur.execute("""
+                UPDATE embedding_cache SET last_used_at = CURRENT_TIMESTAMP
+                WHERE embedding_model = %s AND text_hash = ANY(%s)
+                AND last_used_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+            """, (model, list(found), config.EMBEDDING_CACHE_TOUCH_INTERVAL))
+    conn.commit()
+    _count(lookups=len(unique), hits=len(found), misses=len(unique) - len(found))
+    return found
+
+
+def store(conn, model: str, entries: Dict[str, list]) -> int:
+    """Insert ``{hash: vector}`` entries; existing keys are left untouched."""
+    rows = [(model, h, vec) for h, vec in entries.items() if vec]
+    if not rows:
+        return 0
+    written = write_embeddings(conn, 'embedding_cache', rows, columns=('embedding_model', 'text_hash', 'embedding'),
+                               on_conflict='(embedding_model, text_hash) DO NOTHING')
+    _count(stored=written)
+    return written
+
+
+def embed_texts_cached(model: str, texts: List[str], progress=None, conn=None) -> List[Optional[list]]:
+    """``embed_texts`` with a cache in front; failed chunks are ``None``.
+
+    Progress counts cached chunks as done up front, then advances with
+    each embedded batch.
+    """
+    if not config.EMBEDDING_CACHE_ENABLED:
+        return embed_texts(model, texts, progress=progress)
+
+    own_conn = conn is None
+    conn = conn or get_db_conn()
+    try:
+        hashes = [text_hash(t) for t in texts]
+        try:
+            cached = lookup(conn, model, hashes)
+        except Exception:
+            logger.exception(f'Embedding cache lookup failed for {model}; embedding everything')
+            conn.rollback()
+            cached = {}
+
+        out = [cached.get(h) for h in hashes]
+        miss_indexes = []
+        seen = set()
+        for i, h in enumerate(hashes):
+            if out[i] is None and h not in seen:
+                seen.add(h)
+                miss_indexes.append(i)
+        hits = len(texts) - sum(1 for v in out if v is None)
+        logger.info(f"Embedding cache for {model}: {hits}/{len(texts)} chunks cached, {len(miss_indexes)} to embed")
+        if progress:
+            progress(hits, len(texts), 'chunks')
+
+        if miss_indexes:
+            batch_progress = None
+            if progress:
+                batch_progress = lambda current, total=None, unit=None: progress(hits + current, len(texts), 'chunks')
+            vectors = embed_texts(model, [texts[i] for i in miss_indexes], progress=batch_progress)
+            fresh = {hashes[i]: vec for i, vec in zip(miss_indexes, vectors) if vec is not None}
+            for i, h in enumerate(hashes):
+                if out[i] is None:
+                    out[i] = fresh.get(h)
+            try:
+                store(conn, model, fresh)
+            except Exception:
+                logger.exception(f'Failed to store {len(fresh)} embeddings in the cache for {model}')
+                conn.rollback()
+        return out
+    finally:
+        if own_conn:
+            conn.close()
+
+
+def evict(conn, max_age_days: int = None, max_rows: int = None) -> int:
+    """Delete entries unused for ``max_age_days`` and trim to ``max_rows`` (LRU). 0 disables a limit."""
+    max_age_days = config.EMBEDDING_CACHE_MAX_AGE_DAYS if max_age_days is None else max_age_days
+    max_rows = config.EMBEDDING_CACHE_MAX_ROWS if max_rows is None else max_rows
+    removed = 0
+    with conn.cursor() as cur:
+        if max_age_days > 0:
+            cur.execute("DELETE FROM embedding_cache WHERE last_used_at < CURRENT_TIMESTAMP - make_interval(days => %s)",
+                        (max_age_days,))
+            removed += cur.rowcount
+        if max_rows > 0:
+            cur.execute("""
+                DELETE FROM embedding_cache
+                WHERE (embedding_model, text_hash) IN (
+                    SELECT embedding_model, text_hash FROM embedding_cache
+                    ORDER BY last_used_at DESC
+                    OFFSET %s
+                )
+            """, (max_rows,))
+            removed += cur.rowcount
+    conn.commit()
+    _count(evicted=removed)
+    if removed:
+        logger.info(f'Evicted {removed} embedding cache entries')
+    return removed
+
+
+def table_stats(conn) -> dict:
+    """Entry counts per model and the table's on-disk size."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT embedding_model, COUNT(*), MAX(last_used_at) FROM embedding_cache GROUP BY embedding_model ORDER BY embedding_model")
+        models = [{'embedding_model': m, 'entries': n, 'last_used_at': last.isoformat() if last else None}
+                  for m, n, last in cur.fetchall()]
+        cur.execute("SELECT pg_total_relation_size('embedding_cache')")
+        size = cur.fetchone()[0]
+    return {'models': models, 'total_bytes': size}
@@ -0,0 +1,201 @@
+"""
+Postgres-backed job queue for document ingestion stages.
+
+Jobs live in ``ingestion_jobs``. Workers claim one at a time with
+``SELECT ... FOR UPDATE SKIP LOCKED`` so any number of processes can share
+the queue without double-processing. A failed job is re-queued with
+exponential backoff until ``max_attempts``; a running job whose worker
+stopped updating it for ``INGEST_JOB_STALE_SECONDS`` is reclaimed, or marked
+failed if that was its last attempt.
+"""
+import logging
+import time
+
+from psycopg2.extras import Json
+
+import config
+from db_pool import get_standalone_conn
+
+logger = logging.getLogger(__name__)
+
+JOB_COLUMNS = ('id', 'filename', 'uploader', 'stage', 'params', 'status', 'attempts', 'max_attempts',
+               'progress_current', 'progress_total', 'progress_unit', 'result', 'error',
+               'created_at', 'started_at', 'finished_at', 'updated_at')
+_SELECT_COLUMNS = ', '.join(JOB_COLUMNS)
+
+
+def _row_to_job(row) -> dict:
+    job = dict(zip(JOB_COLUMNS, row))
+    for key in ('created_at', 'started_at', 'finished_at', 'updated_at'):
+        if job[key]:
+            job[key] = job[key].isoformat()
+    return job
+
+
+def enqueue(conn, filename: str, uploader: str, stage: str, params: dict = None) -> int:
+    """Queue a stage for a document and return the job id. Caller commits."""
+    with conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO ingestion_jobs (filename, uploader, stage, params, max_attempts) VALUES (%s, %s, %s, %s, %s) RETURNING id",
+            (filename, uploader, stage, Json(params or {}), config.INGEST_JOB_MAX_ATTEMPTS),
+        )
+        return cur.fetchone()[0]
+
+
+def fail_exhausted(conn) -> int:
+    """Mark stale running jobs that have used up their attempts as failed; returns how many.
+
+    A job that keeps killing its worker (crash, OOM) would otherwise be
+    reclaimed forever.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE ingestion_jobs
+            SET status = 'failed', finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP,
+                error = COALESCE(error, 'worker stopped responding') || ' (gave up after ' || attempts || ' attempts)'
+            WHERE status = 'running' AND attempts >= max_attempts
+              AND updated_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+            RETURNING id, stage, filename
+        """, (config.INGEST_JOB_STALE_SECONDS,))
+        rows = cur.fetchall()
+    conn.commit()
+    for job_id, stage, filename in rows:
+        logger.error(f"Job {job_id} ({stage} {filename}) failed permanently: worker stopped responding on its last attempt")
+    return len(rows)
+
+
+def claim(conn, worker_id: str):
+    """Claim the next runnable job (or a stale running one with attempts left); None if the queue is empty."""
+    fail_exhausted(conn)
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            UPDATE ingestion_jobs
+            SET status = 'running', attempts = attempts + 1, worker = %s, error = NULL,
+                started_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+            WHERE id = (
+                SELECT id FROM ingestion_jobs
+                WHERE (status = 'queued' AND run_after <= CURRENT_TIMESTAMP)
+                   OR (status = 'running' AND attempts < max_attempts
+                       AND updated_at < CURRENT_TIMESTAMP - make_interval(secs => %s))
+                ORDER BY run_after, id
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING {_SELECT_COLUMNS}
+        """, (worker_id, config.INGEST_JOB_STALE_SECONDS))
+        row = cur.fetchone()
+    conn.commit()
+    return _row_to_job(row) if row else None
+
+
+def complete(conn, job_id: int, result: dict = None):
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE ingestion_jobs
+            SET status = 'succeeded', result = %s, finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP,
+                progress_current = COALESCE(progress_total, progress_current)
+            WHERE id = %s
+        """, (Json(result or {}), job_id))
+    conn.commit()
+
+
+def retry_delay(attempts: int) -> float:
+    """Exponential backoff: base * 2^(attempts-1), capped."""
+    delay = config.INGEST_JOB_BACKOFF_SECONDS * (2 ** max(0, attempts - 1))
+    return min(delay, config.INGEST_JOB_BACKOFF_MAX_SECONDS)
+
+
+def fail(conn, job: dict, error: str, retryable: bool = True):
+    """Re-queue the job with backoff, or mark it failed once attempts run out."""
+    attempts = job['attempts']
+    with conn.cursor() as cur:
+        if retryable and attempts < job['max_attempts']:
+            delay = retry_delay(attempts)
+            cur.execute("""
+                UPDATE ingestion_jobs
+                SET status = 'queued', error = %s, run_after = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s
+            """, (error, delay, job['id']))
+            logger.warning(f"Job {job['id']} ({job['stage']} {job['filename']}) failed attempt {attempts}; retrying in {delay:.0f}s: {error}")
+        else:
+            cur.execute("""
+                UPDATE ingestion_jobs
+                SET status = 'failed', error = %s, finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s
+            """, (error, job['id']))
+            logger.error(f"Job {job['id']} ({job['stage']} {job['filename']}) failed permanently: {error}")
+    conn.commit()
+
+
+class ProgressReporter:
+    """``progress(current, total, unit)`` callback that writes to the job row.
+
+    Uses its own pooled connection so updates commit independently of the
+    stage's transaction, and throttles writes to one per
+    ``INGEST_PROGRESS_INTERVAL`` seconds (the final update always lands).
+    """
+
+    def __init__(self, job_id: int):
+        self.job_id = job_id
+        self._last_write = 0.0
+
+    def __call__(self, current, total=None, unit=None):
+        now = time.monotonic()
+        final = total is not None and current >= total
+        if not final and now - self._last_write < config.INGEST_PROGRESS_INTERVAL:
+            return
+        self._last_write = now
+        conn = get_standalone_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE ingestion_jobs
+                    SET progress_current = %s, progress_total = %s, progress_unit = COALESCE(%s, progress_unit),
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE id = %s
+                """, (current, total, unit, self.job_id))
+            conn.commit()
+        except Exception:
+            logger.exception(f'Failed to record progress for job {self.job_id}')
+        finally:
+            conn.close()
+
+
+def heartbeat(job_id: int):
+    """Refresh ``updated_at`` so a long stage without progress isn't reclaimed as stale."""
+    conn = get_standalone_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("UPDATE ingestion_jobs SET updated_at = CURRENT_TIMESTAMP WHERE id = %s AND status = 'running'", (job_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def get_job(conn, job_id: int, uploader: str = None):
+    with conn.cursor() as cur:
+        if uploader is None:
+            cur.execute(f"SELECT {_SELECT_COLUMNS} FROM ingestion_jobs WHERE id = %s", (job_id,))
+        else:
+            cur.execute(f"SELECT {_SELECT_COLUMNS} FROM ingestion_jobs WHERE id = %s AND uploader = %s", (job_id, uploader))
+        row = cur.fetchone()
+    return _row_to_job(row) if row else None
+
+
+def list_jobs(conn, uploader: str, filename: str = None, active_only: bool = False, limit: int = 50) -> list:
+    clauses = ["uploader = %s"]
+    vals = [uploader]
+    if filename:
+        clauses.append("filename = %s")
+        vals.append(filename)
+    if active_only:
+        clauses.append("status IN ('queued', 'running')")
+    vals.append(limit)
+    with conn.cursor() as cur:
+        cur.execute(
+            f"SELECT {_SELECT_COLUMNS} FROM ingestion_jobs WHERE {' AND '.join(clauses)} ORDER BY created_at DESC, id DESC LIMIT %s",
+            tuple(vals),
+        )
+        rows = cur.fetchall()
+    return [_row_to_job(r) for r in rows]
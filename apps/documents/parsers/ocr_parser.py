@@ -9,13 +9,14 @@ from typing import List, Dict
 import pytesseract
 from pdf2image import convert_from_path
 from PIL import Image
-import requests
 import json
 
+from ollama_client import get_client, OllamaError, OllamaHTTPError
+
 logger = logging.getLogger(__name__)
 
 
-def parse_with_ocr(file_path: str | Path) -> str:
+def parse_with_ocr(file_path: str | Path, progress=None) -> str:
     """
     Parse a document using OCR (Optical Character Recognition).
     
@@ -27,6 +28,7 @@ def parse_with_ocr(file_path: str | Path) -> str:
     
     Args:
         file_path: Path to the document file
+        progress: Optional callback(current, total, unit) called per page
         
     Returns:
         Extracted text from images using OCR
@@ -38,7 +40,7 @@ def parse_with_ocr(file_path: str | Path) -> str:
         file_ext = file_path.suffix.lower()
         
         if file_ext == '.pdf':
-            return _parse_pdf_with_ocr(file_path)
+            return _parse_pdf_with_ocr(file_path, progress=progress)
         elif file_ext in ['.png', '.jpg', '.jpeg', '.tiff', '.bmp']:
             return _parse_image_with_ocr(file_path)
         else:
@@ -49,12 +51,13 @@ def parse_with_ocr(file_path: str | Path) -> str:
         raise
 
 
-def _parse_pdf_with_ocr(pdf_path: Path) -> str:
+def _parse_pdf_with_ocr(pdf_path: Path, progress=None) -> str:
     """
     Convert PDF pages to images and extract text using OCR.
     
     Args:
         pdf_path: Path to PDF file
+        progress: Optional callback(current, total, unit) called per page
         
     Returns:
         OCR-extracted text from all pages
@@ -85,6 +88,8 @@ def _parse_pdf_with_ocr(pdf_path: Path) -> str:
             
             if text.strip():
                 all_text.append(f"=== Page {page_num} ===\n{text.strip()}")
+            if progress:
+                progress(page_num, len(images), 'pages')
         
         full_text = "\n\n".join(all_text)
         logger.info(f"OCR extracted {len(full_text)} characters from {len(images)} pages")
@@ -184,12 +189,13 @@ def _describe_images_with_vision(file_path: Path, ollama_url: str) -> List[str]:
     """
     try:
         # Check if vision model is available
-        response = requests.get(f"{ollama_url}/api/tags", timeout=5)
-        if response.status_code != 200:
-            logger.warning("Cannot connect to Ollama, skipping vision descriptions")
+        client = get_client(ollama_url)
+        try:
+            models = client.tags(timeout=5).get('models', [])
+        except OllamaError as e:
+            logger.warning(f"Cannot connect to Ollama, skipping vision descriptions: {e}")
             return []
         
-        models = response.json().get('models', [])
         vision_models = [m for m in models if 'llava' in m.get('name', '').lower() or 'bakllava' in m.get('name', '').lower()]
         
         if not vision_models:
@@ -255,20 +261,15 @@ def _get_image_description(image: Image.Image, model: str, ollama_url: str, imag
             "stream": False
         }
         
-        response = requests.post(
-            f"{ollama_url}/api/generate",
-            json=payload,
-            timeout=60
-        )
-        
-        if response.status_code == 200:
-            result = response.json()
-            description = result.get('response', '').strip()
-            logger.info(f"Generated description for {image_label}: {len(description)} chars")
-            return f"[{image_label}] {description}"
-        else:
-            logger.warning(f"Failed to get description for {image_label}: {response.status_code}")
+        try:
+            result = get_client(ollama_url).generate(payload, timeout=60)
+        except OllamaHTTPError as e:
+            logger.warning(f"Failed to get description for {image_label}: {e.status_code}")
             return ""
+
+        description = result.get('response', '').strip()
+        logger.info(f"Generated description for {image_label}: {len(description)} chars")
+        return f"[{image_label}] {description}"
             
     except Exception as e:
         logger.error(f"Error getting image description: {e}")
@@ -276,9 +277,9 @@ def _get_image_description(image: Image.Image, model: str, ollama_url: str, imag
 
 
 # Alias for main parsing function
-def parse(file_path: str) -> str:
+def parse(file_path: str, progress=None) -> str:
     """
     Main entry point for OCR parser.
     Uses OCR only (no vision model) for faster processing.
     """
-    return parse_with_ocr(file_path)
+    return parse_with_ocr(file_path, progress=progress)
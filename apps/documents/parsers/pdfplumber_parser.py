@@ -1,5 +1,5 @@
 """Extract text from PDF using pdfplumber."""
-def parse(file_path: str) -> str:
+def parse(file_path: str, progress=None) -> str:
     try:
         import pdfplumber
     except Exception as e:
@@ -7,6 +7,8 @@ def parse(file_path: str) -> str:
 
     texts = []
     with pdfplumber.open(file_path) as pdf:
-        for page in pdf.pages:
+        for page_num, page in enumerate(pdf.pages, start=1):
             texts.append(page.extract_text() or '')
+            if progress:
+                progress(page_num, len(pdf.pages), 'pages')
     return '\n\n'.join(texts)
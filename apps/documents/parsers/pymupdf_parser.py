@@ -1,5 +1,5 @@
 """Extract text from PDF using PyMuPDF (fitz)."""
-def parse(file_path: str) -> str:
+def parse(file_path: str, progress=None) -> str:
     try:
         import fitz  # PyMuPDF
     except Exception as e:
@@ -7,6 +7,8 @@ def parse(file_path: str) -> str:
 
     doc = fitz.open(file_path)
     texts = []
-    for page in doc:
+    for page_num, page in enumerate(doc, start=1):
         texts.append(page.get_text())
+        if progress:
+            progress(page_num, doc.page_count, 'pages')
     return '\n\n'.join(texts)
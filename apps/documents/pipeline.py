@@ -0,0 +1,219 @@
+"""
+Ingestion stages: parse, split and embed a document.
+
+These run either inline from the documents routes or from the background
+worker (``apps/documents/worker.py``); both call them inside an app
+context. Each stage takes an optional ``progress(current, total, unit)``
+callback and raises ``StageError`` when its input is missing.
+"""
+import hashlib
+from datetime import datetime
+
+from flask import current_app
+
+import config
+import embedding_registry
+import vector_index
+from schema import EMBEDDING_TABLE_PREFIX, embedding_table_name, ensure_embedding_table
+from .db_store import find_file, set_parsed_text, update_metadata
+from . import chunk_store, chunk_sync
+from .embedding_cache import embed_texts_cached
+
+STAGES = ('parse', 'split', 'embed')
+
+
+class StageError(Exception):
+    """A stage cannot run (missing file, no parsed text, no splits...)."""
+
+
+def _noop_progress(current, total=None, unit=None):
+    pass
+
+
+def _mock_embedding(text: str, dimension: int) -> list:
+    """Deterministic stand-in vector used when Ollama is unreachable."""
+    h = hashlib.sha256(text.encode()).hexdigest()
+    base = [(int(h[i:i+8], 16) % 1000) / 1000.0 for i in range(0, 64, 8)]
+    return [base[i % len(base)] for i in range(dimension)]
+
+
+def run_parse(filename: str, parser_choice: str = 'pymupdf', progress=None) -> dict:
+    """Parse the uploaded file and store its text. Reports pages parsed."""
+    progress = progress or _noop_progress
+    rec = find_file(filename)
+    if not rec or not rec.get('file_path'):
+        raise StageError(f'No uploaded file found for {filename}')
+    file_path = rec.get('file_path')
+    current_app.logger.info(f'File path from DB: {file_path}')
+
+    if parser_choice == 'pymupdf':
+        from .parsers.pymupdf_parser import parse as parser_fn
+        current_app.logger.info('Using PyMuPDF parser')
+    elif parser_choice == 'unstructured':
+        from .parsers.unstructured_parser import parse_document_unstructured
+        parser_fn = lambda path, progress=None: parse_document_unstructured(path)
+        current_app.logger.info('Using Unstructured parser')
+    elif parser_choice == 'ocr':
+        from .parsers.ocr_parser import parse as parser_fn
+        current_app.logger.info('Using OCR parser for image-heavy documents')
+    else:
+        from .parsers.pdfplumber_parser import parse as parser_fn
+        current_app.logger.info('Using pdfplumber parser')
+
+    text = parser_fn(file_path, progress=progress)
+    current_app.logger.info(f'Parsed text length: {len(text) if text else 0}')
+    set_parsed_text(filename, text, parser_choice)
+    return {'chars': len(text) if text else 0}
+
+
+def run_split(filename: str, splitter_choice: str = 'recursive', max_chars: int = None, overlap: int = None, progress=None) -> dict:
+    """Split the parsed text and store the chunks."""
+    progress = progress or _noop_progress
+    max_chars = config.DEFAULT_CHUNK_SIZE if max_chars is None else max_chars
+    overlap = config.DEFAULT_CHUNK_OVERLAP if overlap is None else overlap
+
+    conn = current_app.get_db_conn()
+    with conn.cursor() as cur:
+        cur.execute("SELECT id, parsed_text FROM documents WHERE filename = %s LIMIT 1", (filename,))
+        row = cur.fetchone()
+    conn.close()
+    document_id, parsed_text = row if row else (None, None)
+    if not parsed_text:
+        raise StageError('No parsed text found for file. Parse first.')
+
+    progress(0, 1, 'documents')
+    if splitter_choice == 'token':
+        from .splitters.token_text_splitter import split as splitter_fn
+        splits = splitter_fn(parsed_text, chunk_size=max_chars if max_chars else 200, chunk_overlap=overlap)
+    elif splitter_choice == 'semantic':
+        from .splitters.semantic_splitter import split_text_semantically
+        # Semantic splitter doesn't use max_chars/overlap - it finds natural boundaries
+        chunks = split_text_semantically(parsed_text, ollama_base_url=config.OLLAMA_URL, embedding_model=config.DEFAULT_EMBEDDING_MODEL)
+        # Convert to expected format
+        splits = [{'text': chunk} for chunk in chunks]
+    else:
+        from .splitters.recursive_splitter import split as splitter_fn
+        splits = splitter_fn(parsed_text, max_chunk_chars=max_chars, overlap_chars=overlap)
+
+    # store the chunks and record which splitter was used; the embedding tables holding the
+    # document are looked up first, since replaced chunks take their vectors with them
+    conn = current_app.get_db_conn()
+    try:
+        embedded_models = _embedded_models(conn, document_id)
+        count = chunk_store.write_chunks(conn, document_id, splits, parsed_text=parsed_text, splitter_name=splitter_choice)
+    finally:
+        conn.close()
+    progress(1, 1, 'documents')
+    result = {'chunks': count}
+
+    # Already embedded: bring every embedding table in line with the new chunks
+    # (only chunks whose text moved or changed get embedded again)
+    rec = find_file(filename)
+    if rec and rec.get('has_embeddings'):
+        primary = rec.get('embeddings_model')
+        if primary and primary not in embedded_models:
+            embedded_models.append(primary)
+        # The recorded model runs last so it stays the document's embeddings_model
+        embedded_models.sort(key=lambda m: m == primary)
+        result['embeddings'] = {m: run_embed(filename, m, progress=progress) for m in embedded_models}
+    return result
+
+
+def _embedded_models(conn, document_id: str) -> list:
+    """Embedding models of the registered tables that hold rows for the document."""
+    registry = embedding_registry.tables(conn)
+    if not registry:
+        return []
+    names = sorted(registry)
+    sql = " UNION ALL ".join(
+        f"SELECT %s WHERE EXISTS (SELECT 1 FROM {table_name} WHERE document_id = %s)" for table_name in names)
+    with conn.cursor() as cur:
+        cur.execute(sql, [value for table_name in names for value in (table_name, document_id)])
+        found = [table_name for (table_name,) in cur.fetchall()]
+    conn.rollback()
+    models = []
+    for table_name in found:
+        model = registry[table_name].get('embedding_model')
+        if not model or embedding_table_name(model) != table_name:
+            # Tables registered without a model are named after it
+            model = table_name[len(EMBEDDING_TABLE_PREFIX):]
+        models.append(model)
+    return models
+
+
+def run_embed(filename: str, model_name: str = 'mxbai_embed_large', progress=None) -> dict:
+    """Sync the stored chunks into the ``model_name`` embedding table.
+
+    Only chunks whose ordinal or text changed since the last run are
+    embedded and upserted; chunks past the new end are deleted (see
+    ``chunk_sync``). Reports chunks embedded.
+    """
+    progress = progress or _noop_progress
+    table_name = embedding_table_name(model_name)
+    current_app.logger.info(f'Generating embeddings for {filename} using {model_name} into {table_name}')
+
+    rec = find_file(filename)
+    if not rec:
+        raise StageError(f'No document found for {filename}')
+    document_id = rec['id']
+    dimension = vector_index.model_dimension(model_name)
+
+    conn = current_app.get_db_conn()
+    try:
+        hashes = chunk_store.chunk_hashes(conn, document_id)
+        if not hashes:
+            raise StageError('no_splits')
+        ensure_embedding_table(table_name, dimension=dimension, embedding_model=model_name)
+        diff = chunk_sync.diff_chunks(chunk_sync.load_chunk_hashes(conn, table_name, document_id), hashes)
+        changed = diff['changed']
+        current_app.logger.info(f"{filename}: {len(changed)} changed, {len(diff['unchanged'])} unchanged, {len(diff['stale'])} stale chunks in {table_name}")
+        if not dimension:
+            with conn.cursor() as cur:
+                dimension = vector_index.column_dimension(cur, table_name)
+        embedded = {'done': 0, 'failed': 0, 'dimension': dimension}
+
+        def rows():
+            # Chunks are read, embedded and written one batch at a time
+            for batch in chunk_store.iter_chunks(conn, document_id, ordinals=changed):
+                done = embedded['done']
+                batch_progress = lambda current, total=None, unit=None: progress(done + current, len(changed), 'chunks')
+                vectors = embed_texts_cached(model_name.replace("_", "-"), [text for _, _, _, text in batch], progress=batch_progress)
+                embedded['dimension'] = embedded['dimension'] or next((len(v) for v in vectors if v), None)
+                for (ordinal, chunk, h, text), vec in zip(batch, vectors):
+                    if vec is None:
+                        # fallback: deterministic mock sized to the table; no hash so the next run retries it
+                        embedded['failed'] += 1
+                        yield (ordinal, chunk, None, _mock_embedding(text, embedded['dimension'] or 8))
+                    else:
+                        yield (ordinal, chunk, h, vec)
+                embedded['done'] += len(batch)
+
+        result = chunk_sync.apply_chunk_diff(conn, table_name, document_id, filename, rows(), len(hashes))
+        failed = embedded['failed']
+        if failed:
+            current_app.logger.warning(f"Ollama failed to embed {failed}/{len(changed)} chunks of {filename}")
+        current_app.logger.info(f"Wrote {result['written']} embeddings to {table_name}, deleted {result['deleted'] + result['legacy_deleted']}")
+        with conn.cursor() as cur:
+            # IVFFlat indexes are only built once the table has enough rows
+            vector_index.ensure_index(cur, table_name)
+        conn.commit()
+    finally:
+        conn.close()
+    progress(len(changed), len(changed), 'chunks')
+
+    # update metadata (mark embeddings True and store model name); embedded_at invalidates cached answers
+    update_metadata(filename, {'embeddings': True, 'embeddings_model': model_name, 'embedded_at': datetime.utcnow()})
+    return {'chunks': len(hashes), 'inserted': diff['inserted'], 'updated': diff['updated'],
+            'unchanged': len(diff['unchanged']), 'deleted': result['deleted'] + result['legacy_deleted'], 'failed': failed}
+
+
+def run_stage(stage: str, filename: str, params: dict, progress=None) -> dict:
+    """Dispatch a queued job to its stage function."""
+    params = params or {}
+    if stage == 'parse':
+        return run_parse(filename, params.get('parser', 'pymupdf'), progress=progress)
+    if stage == 'split':
+        return run_split(filename, params.get('splitter', 'recursive'), params.get('max_chars'), params.get('overlap'), progress=progress)
+    if stage == 'embed':
+        return run_embed(filename, params.get('model', 'mxbai_embed_large'), progress=progress)
+    raise StageError(f'Unknown stage: {stage}')
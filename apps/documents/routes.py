@@ -3,11 +3,13 @@ from werkzeug.utils import secure_filename
 from . import documents_bp
 from .file_store import delete_file as fs_delete
 from flask import current_app
-from .db_store import save_metadata as db_save_metadata, list_uploaded_files as db_list_uploaded_files, update_metadata as db_update_metadata, find_file as db_find_file
+from . import jobs, embedding_cache
+from .pipeline import run_stage, StageError
+from .db_store import save_metadata as db_save_metadata, list_documents as db_list_documents, document_summary as db_document_summary, update_metadata as db_update_metadata, find_file as db_find_file
 import os
-import requests
-import hashlib
 import config
+import embedding_registry
+import vector_index
 
 # Import configurations from centralized config module
 UPLOADS_DIR = config.UPLOADS_DIR
@@ -17,6 +19,7 @@ DEFAULT_CHUNK_SIZE = config.DEFAULT_CHUNK_SIZE
 DEFAULT_CHUNK_OVERLAP = config.DEFAULT_CHUNK_OVERLAP
 DEFAULT_EMBEDDING_MODEL = config.DEFAULT_EMBEDDING_MODEL
 EMBEDDING_REQUEST_TIMEOUT = config.EMBEDDING_REQUEST_TIMEOUT
+INGEST_ASYNC = config.INGEST_ASYNC
 
 
 def allowed_file(filename: str) -> bool:
@@ -29,8 +32,41 @@ def documents_page():
     username = session.get('nimbus_user')
     if not username:
         return redirect(url_for('login_get'))
-    files = db_list_uploaded_files(username)
-    return render_template('documents.html', username=username, files=files)
+    cursor = request.args.get('cursor')
+    try:
+        files, next_cursor = db_list_documents(username, cursor=cursor)
+    except ValueError:
+        return redirect(url_for('documents.documents_page'))
+    summary = db_document_summary(username)
+    return render_template('documents.html', username=username, files=files, next_cursor=next_cursor,
+                           paged=bool(cursor), summary=summary)
+
+
+@documents_bp.route('/documents/api/list', methods=['GET'])
+def api_list_documents():
+    """One page of the user's documents, newest first (?limit=..., ?cursor=... from ``next_cursor``)."""
+    username = session.get('nimbus_user')
+    if not username:
+        return jsonify({'success': False, 'error': 'unauthenticated'}), 401
+
+    try:
+        limit = int(request.args.get('limit', config.DOCUMENTS_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'limit must be an integer'}), 400
+    try:
+        files, next_cursor = db_list_documents(username, limit=limit, cursor=request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, 'files': files, 'next_cursor': next_cursor})
+
+
+@documents_bp.route('/documents/api/summary', methods=['GET'])
+def api_document_summary():
+    """Counts of the user's documents by parse, split, embed and enabled status."""
+    username = session.get('nimbus_user')
+    if not username:
+        return jsonify({'success': False, 'error': 'unauthenticated'}), 401
+    return jsonify({'success': True, 'summary': db_document_summary(username)})
 
 
 @documents_bp.route('/documents/upload', methods=['POST'])
@@ -114,6 +150,30 @@ def toggle_enable(filename):
     return redirect(url_for('documents.documents_page'))
 
 
+def _run_or_enqueue(filename: str, username: str, stage: str, params: dict):
+    """Queue an ingestion stage for the worker pool, or run it inline when INGEST_ASYNC is off."""
+    wants_json = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+    if INGEST_ASYNC:
+        conn = current_app.get_db_conn()
+        job_id = jobs.enqueue(conn, filename, username, stage, params)
+        conn.commit()
+        current_app.logger.info(f'Queued {stage} job {job_id} for {filename}')
+        if wants_json:
+            return jsonify({'success': True, 'job_id': job_id, 'status_url': url_for('documents.job_status', job_id=job_id)}), 202
+        return redirect(url_for('documents.documents_page'))
+
+    try:
+        result = run_stage(stage, filename, params)
+    except StageError as e:
+        current_app.logger.warning(f'{stage} failed for {filename}: {e}')
+        if wants_json:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        return redirect(url_for('documents.documents_page'))
+    if wants_json:
+        return jsonify({'success': True, 'result': result})
+    return redirect(url_for('documents.documents_page'))
+
+
 @documents_bp.route('/documents/parse/<filename>', methods=['POST'])
 def parse_document(filename):
     username = session.get('nimbus_user')
@@ -122,41 +182,8 @@ def parse_document(filename):
 
     # Accept parser selection from form data (default to pymupdf)
     parser_choice = request.form.get('parser', 'pymupdf')
-    current_app.logger.info(f'=== PARSE REQUEST ===')
-    current_app.logger.info(f'Filename: {filename}')
-    current_app.logger.info(f'Parser choice from form: {parser_choice}')
-    current_app.logger.info(f'All form data: {request.form}')
-    current_app.logger.info(f'Request headers: {dict(request.headers)}')
-
-    # Find file path
-    file_path = None
-    rec = db_find_file(filename)
-    file_path = rec.get('file_path')
-    current_app.logger.info(f'File path from DB: {file_path}')
-
-    if parser_choice == 'pymupdf':
-        from .parsers.pymupdf_parser import parse as parser_fn
-        current_app.logger.info('Using PyMuPDF parser')
-    elif parser_choice == 'unstructured':
-        from .parsers.unstructured_parser import parse_document_unstructured
-        parser_fn = lambda path: parse_document_unstructured(path)
-        current_app.logger.info('Using Unstructured parser')
-    elif parser_choice == 'ocr':
-        from .parsers.ocr_parser import parse as ocr_parse
-        parser_fn = ocr_parse
-        current_app.logger.info('Using OCR parser for image-heavy documents')
-    else:
-        from .parsers.pdfplumber_parser import parse as parser_fn
-        current_app.logger.info(f'Using pdfplumber parser')
-        
-    text = parser_fn(file_path)
-    current_app.logger.info(f'Parsed text length: {len(text) if text else 0}')
-    from .db_store import set_parsed_text
-    saved = set_parsed_text(filename, text, parser_choice)
-    import time
-    time.sleep(1)  # simulate delay
-    return redirect(url_for('documents.documents_page'))
-
+    current_app.logger.info(f'Parse request for {filename} with parser {parser_choice}')
+    return _run_or_enqueue(filename, username, 'parse', {'parser': parser_choice})
 
 
 @documents_bp.route('/documents/split/<filename>', methods=['POST'])
@@ -178,118 +205,129 @@ def split_document(filename):
     except Exception:
         overlap = DEFAULT_CHUNK_OVERLAP
 
-    # Fetch parsed text
-    parsed_text = None
-    rec = db_find_file(filename)
-    from .db_store import get_splits
+    return _run_or_enqueue(filename, username, 'split', {'splitter': splitter_choice, 'max_chars': max_chars, 'overlap': overlap})
 
-    conn = current_app.get_db_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT parsed_text FROM documents WHERE filename = %s LIMIT 1", (filename,))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
-    parsed_text = row[0] if row else None
 
-    if not parsed_text:
-        print('No parsed text found for file. Parse first.', 'error')
-        return redirect(url_for('documents.documents_page'))
+@documents_bp.route('/documents/embeddings/<filename>', methods=['POST'])
+def embeddings_document(filename):
+    username = session.get('nimbus_user')
+    if not username:
+        return jsonify({'success': False, 'error': 'unauthenticated'}), 401
 
-    # choose splitter
-    if splitter_choice == 'token':
-        from .splitters.token_text_splitter import split as splitter_fn
-        splits = splitter_fn(parsed_text, chunk_size=max_chars if max_chars else 200, chunk_overlap=overlap)
-    elif splitter_choice == 'semantic':
-        from .splitters.semantic_splitter import split_text_semantically
-        # Semantic splitter doesn't use max_chars/overlap - it finds natural boundaries
-        chunks = split_text_semantically(parsed_text, ollama_base_url=OLLAMA_URL, embedding_model=DEFAULT_EMBEDDING_MODEL)
-        # Convert to expected format
-        splits = [{'text': chunk} for chunk in chunks]
-    else:
-        from .splitters.recursive_splitter import split as splitter_fn
-        splits = splitter_fn(parsed_text, max_chunk_chars=max_chars, overlap_chars=overlap)
+    model_name = request.form.get('model', 'mxbai_embed_large')
+    print(f'Generating embeddings using model: {model_name}')
+    return _run_or_enqueue(filename, username, 'embed', {'model': model_name})
 
-    # store splits and record which splitter was used
-    import json as _json
-    from .db_store import set_splits_with_meta
-    ok = set_splits_with_meta(filename, _json.dumps(splits), splitter_name=splitter_choice)
 
-    if ok:
-        print(f'Splits stored for {filename} using {splitter_choice}', 'success')
-    else:
-        print('Failed to store splits', 'error')
-    return redirect(url_for('documents.documents_page'))
+@documents_bp.route('/documents/jobs/<int:job_id>', methods=['GET'])
+def job_status(job_id):
+    """Status and progress of one ingestion job, for the documents page to poll."""
+    username = session.get('nimbus_user')
+    if not username:
+        return jsonify({'success': False, 'error': 'unauthenticated'}), 401
 
+    conn = current_app.get_db_conn()
+    job = jobs.get_job(conn, job_id, uploader=username)
+    conn.close()
+    if not job:
+        return jsonify({'success': False, 'error': 'job not found'}), 404
+    return jsonify({'success': True, 'job': job})
 
 
-@documents_bp.route('/documents/embeddings/<filename>', methods=['POST'])
-def embeddings_document(filename):
+@documents_bp.route('/documents/jobs', methods=['GET'])
+def list_jobs():
+    """Recent ingestion jobs for the current user (?filename=..., ?active=1)."""
     username = session.get('nimbus_user')
     if not username:
         return jsonify({'success': False, 'error': 'unauthenticated'}), 401
 
-    model_name = request.form.get('model', 'mxbai_embed_large')
-    print(f'Generating embeddings using model: {model_name}')
-    safe_model_name = model_name.lower().replace("-", "_")
-    table_name = f"document_embeddings_{safe_model_name}"
-    print(f'Using table: {table_name}')
-
-    # get file splits from DB (adjust helper)
-    from .db_store import get_splits
-    splits = get_splits(filename)
-    if not splits:
-        return jsonify({'success': False, 'error': 'no_splits'}), 400
-
-    # prepare Ollama endpoint
-    ep = f"{OLLAMA_URL.rstrip('/')}/v1/embeddings"
-    headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
-
-    embeddings = []
-    for chunk in splits:
-        text = chunk.get('text') if isinstance(chunk, dict) else str(chunk)
-        vec = None
-
-        payload = {'model': model_name.replace("_", "-"), 'input': text}
-        try:
-            resp = requests.post(ep, json=payload, timeout=EMBEDDING_REQUEST_TIMEOUT, headers=headers)
-            if resp.ok:
-                data = resp.json()
-                # assume OpenAI-style
-                vec = data['data'][0]['embedding']
-        except Exception as e:
-            current_app.logger.warning(f"Ollama failed: {e}")
-
-        # fallback: deterministic mock
-        if vec is None:
-            h = hashlib.sha256(text.encode()).hexdigest()
-            vec = [(int(h[i:i+8], 16) % 1000) / 1000.0 for i in range(0, 64, 8)]
-
-        embeddings.append((filename, text, vec))
-
-    # persist into document_embeddings_<model_name>
+    filename = request.args.get('filename')
+    active_only = request.args.get('active', 'false').lower() in ('1', 'true')
     conn = current_app.get_db_conn()
+    job_list = jobs.list_jobs(conn, username, filename=filename, active_only=active_only)
+    conn.close()
+    return jsonify({'success': True, 'jobs': job_list})
+
+
+@documents_bp.route('/admin/vector_index', methods=['GET'])
+def vector_index_status():
+    """ANN index status for every embedding table (admin only)."""
+    if session.get('role') != 'admin':
+        return jsonify({'success': False, 'error': 'admin access required'}), 403
+
+    conn = current_app.get_db_conn()
+    registry = embedding_registry.tables(conn)
     with conn.cursor() as cur:
-        cur.execute(f"""
-            CREATE TABLE IF NOT EXISTS {table_name} (
-                id SERIAL PRIMARY KEY,
-                filename TEXT,
-                text TEXT,
-                embedding VECTOR
-            )
-        """)
-        for fn, txt, vec in embeddings:
-            cur.execute(
-                f"INSERT INTO {table_name} (filename, text, embedding) VALUES (%s, %s, %s)",
-                (fn, txt, vec)
-            )
-    conn.commit()
-
-    # update metadata (mark embeddings True and store model name)
-    result = db_update_metadata(filename, {'embeddings': True, 'embeddings_model': model_name})
-    print(f'Update metadata result: {result}')
-    print(f'Embeddings stored for {filename} using {model_name}', 'success')    
+        status = [dict(vector_index.index_status(cur, table), registry=registry[table]) for table in sorted(registry)]
+    conn.close()
+    return jsonify({'success': True, 'tables': status})
+
+
+@documents_bp.route('/admin/vector_index/rebuild', methods=['POST'])
+def vector_index_rebuild():
+    """Reindex or rebuild the ANN index of an embedding table (admin only).
+
+    Params: table, mode ('reindex' or 'rebuild'), optional dimension and
+    drop_mismatched to type an untyped embedding column during a rebuild.
+    """
+    if session.get('role') != 'admin':
+        return jsonify({'success': False, 'error': 'admin access required'}), 403
+
+    body = request.get_json(silent=True) or request.form.to_dict()
+    table_name = body.get('table') or ''
+    mode = body.get('mode', 'reindex')
+    if not table_name.startswith('document_embeddings_') or not table_name.replace('_', '').isalnum():
+        return jsonify({'success': False, 'error': 'invalid table'}), 400
+    try:
+        dimension = int(body['dimension']) if body.get('dimension') else None
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'invalid dimension'}), 400
+    if dimension is None and mode == 'rebuild':
+        dimension = vector_index.model_dimension(table_name[len('document_embeddings_'):])
+    drop_mismatched = str(body.get('drop_mismatched', 'false')).lower() == 'true'
+
+    conn = current_app.get_db_conn()
+    try:
+        status = vector_index.rebuild_index(conn, table_name, mode=mode, dimension=dimension, drop_mismatched=drop_mismatched)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        current_app.logger.exception(f'Vector index {mode} failed for {table_name}')
+        return jsonify({'success': False, 'error': str(e)}), 500
+    current_app.logger.info(f'Vector index {mode} finished for {table_name}')
+    return jsonify({'success': True, 'status': status})
+
+
+@documents_bp.route('/admin/embedding_cache', methods=['GET'])
+def embedding_cache_status():
+    """Embedding cache hit rate (this process) and table size (admin only)."""
+    if session.get('role') != 'admin':
+        return jsonify({'success': False, 'error': 'admin access required'}), 403
+
+    conn = current_app.get_db_conn()
+    table = embedding_cache.table_stats(conn)
+    conn.close()
+    return jsonify({'success': True, 'stats': embedding_cache.stats(), 'table': table})
+
+
+@documents_bp.route('/admin/embedding_cache/evict', methods=['POST'])
+def embedding_cache_evict():
+    """Run cache eviction now; optional max_age_days / max_rows override config (admin only)."""
+    if session.get('role') != 'admin':
+        return jsonify({'success': False, 'error': 'admin access required'}), 403
+
+    body = request.get_json(silent=True) or request.form.to_dict()
+    try:
+        max_age_days = int(body['max_age_days']) if body.get('max_age_days') is not None else None
+        max_rows = int(body['max_rows']) if body.get('max_rows') is not None else None
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'invalid limits'}), 400
+
+    conn = current_app.get_db_conn()
+    removed = embedding_cache.evict(conn, max_age_days=max_age_days, max_rows=max_rows)
+    conn.close()
+    return jsonify({'success': True, 'evicted': removed})
 
-    return redirect(url_for('documents.documents_page'))
 
 @documents_bp.route('/documents/api/delete/<filename>', methods=['POST'])
 def api_delete_document(filename):
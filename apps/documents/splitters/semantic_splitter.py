@@ -4,12 +4,35 @@ Uses embeddings to find natural breakpoints between semantically different secti
 """
 
 from langchain_experimental.text_splitter import SemanticChunker
-from langchain_community.embeddings import OllamaEmbeddings
+from langchain_core.embeddings import Embeddings
 import logging
 
+from ..embedding_cache import embed_texts_cached
+
 logger = logging.getLogger(__name__)
 
 
+class CachedOllamaEmbeddings(Embeddings):
+    """LangChain embeddings backed by the batched Ollama client and the embedding cache.
+
+    SemanticChunker embeds every sentence window; going through the cache
+    means re-splitting a document only embeds windows it has not seen.
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        vectors = embed_texts_cached(self.model, texts)
+        failed = sum(1 for v in vectors if v is None)
+        if failed:
+            raise RuntimeError(f"Failed to embed {failed}/{len(texts)} sentences with {self.model}")
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
 def split_text_semantically(text: str, ollama_base_url: str = "http://localhost:11434", embedding_model: str = "nomic-embed-text") -> list[str]:
     """
     Split text based on semantic similarity using embeddings.
@@ -29,11 +52,9 @@ def split_text_semantically(text: str, ollama_base_url: str = "http://localhost:
     try:
         logger.info(f"Using SemanticChunker with model: {embedding_model}")
         
-        # Initialize Ollama embeddings
-        embeddings = OllamaEmbeddings(
-            base_url=ollama_base_url,
-            model=embedding_model
-        )
+        # Ollama embeddings through the shared embedding cache
+        # (requests go to config.OLLAMA_URL, which is what callers pass as ollama_base_url)
+        embeddings = CachedOllamaEmbeddings(model=embedding_model)
         
         # Create semantic chunker
         # breakpoint_threshold_type can be:
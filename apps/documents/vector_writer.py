@@ -0,0 +1,96 @@
+"""
+Bulk writer for embedding rows.
+
+Rows are streamed into an embedding table with ``COPY ... FROM STDIN``
+(CSV, vectors in pgvector's ``[x,y,...]`` text form) or, with
+``EMBEDDING_WRITE_METHOD=values``, with multi-row ``INSERT`` pages via
+``execute_values``. Either way the writer commits every
+``EMBEDDING_WRITE_BATCH_SIZE`` rows. Anything that stores embeddings should
+go through ``write_embeddings`` rather than issuing per-row INSERTs.
+"""
+import functools
+import io
+from typing import Iterable, Sequence
+
+import psycopg2.extras
+
+import config
+
+WRITE_METHODS = ('copy', 'values')
+
+
+def vector_literal(vec) -> str:
+    """Render a vector in pgvector's text input format."""
+    return '[' + ','.join(repr(float(x)) for x in vec) + ']'
+
+
+def _csv_field(value) -> str:
+    # Quoted values are never read as NULL, so '' and None stay distinct
+    if value is None:
+        return '\\N'
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def _copy_batch(cur, table_name: str, columns: Sequence[str], batch: list, vector_col: int):
+    buf = io.StringIO()
+    for row in batch:
+        row = list(row)
+        if row[vector_col] is not None:
+            row[vector_col] = vector_literal(row[vector_col])
+        buf.write(','.join(_csv_field(v) for v in row))
+        buf.write('\n')
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table_name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buf)
+
+
+def _values_batch(cur, table_name: str, columns: Sequence[str], batch: list, vector_col: int, on_conflict: str = None):
+    rows = []
+    for row in batch:
+        row = list(row)
+        if row[vector_col] is not None:
+            row[vector_col] = vector_literal(row[vector_col])
+        rows.append(row)
+    template = '(' + ','.join('%s::vector' if i == vector_col else '%s' for i in range(len(columns))) + ')'
+    suffix = f" ON CONFLICT {on_conflict}" if on_conflict else ''
+    psycopg2.extras.execute_values(
+        cur,
+        f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES %s{suffix}",
+        rows,
+        template=template,
+        page_size=len(rows),
+    )
+
+
+def write_embeddings(conn, table_name: str, rows: Iterable[Sequence], columns: Sequence[str] = ('filename', 'text', 'embedding'),
+                     vector_column: str = 'embedding', batch_size: int = None, method: str = None,
+                     on_conflict: str = None) -> int:
+    """Bulk-write ``rows`` (tuples ordered like ``columns``) and commit per batch.
+
+    ``on_conflict`` (e.g. ``"(embedding_model, text_hash) DO NOTHING"``) is
+    appended as an ``ON CONFLICT`` clause; COPY cannot take one, so it
+    implies the ``values`` method. Returns the number of rows written.
+    """
+    batch_size = max(1, batch_size or config.EMBEDDING_WRITE_BATCH_SIZE)
+    method = method or config.EMBEDDING_WRITE_METHOD
+    if method not in WRITE_METHODS:
+        raise ValueError(f"Unsupported EMBEDDING_WRITE_METHOD: {method}")
+    if on_conflict:
+        method = 'values'
+    write_batch = _copy_batch if method == 'copy' else functools.partial(_values_batch, on_conflict=on_conflict)
+    vector_col = list(columns).index(vector_column)
+
+    written = 0
+    batch = []
+    with conn.cursor() as cur:
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                write_batch(cur, table_name, columns, batch, vector_col)
+                conn.commit()
+                written += len(batch)
+                batch = []
+        if batch:
+            write_batch(cur, table_name, columns, batch, vector_col)
+            conn.commit()
+            written += len(batch)
+    return written
@@ -0,0 +1,123 @@
+"""
+Background ingestion worker.
+
+Runs ``INGEST_WORKER_PROCESSES`` processes that claim jobs from
+``ingestion_jobs`` and execute the parse/split/embed stages:
+
+    python -m apps.documents.worker [--processes N]
+
+Each process handles one job at a time inside its own app context, so it
+has its own connection pool and Ollama sessions. SIGTERM/SIGINT finish
+the current job and then exit.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+import config
+
+logger = logging.getLogger(__name__)
+
+_stopping = False
+
+
+def _request_stop(signum, frame):
+    global _stopping
+    _stopping = True
+
+
+def _heartbeat_loop(job_id: int, done: threading.Event):
+    from . import jobs
+    while not done.wait(config.INGEST_JOB_HEARTBEAT_SECONDS):
+        try:
+            jobs.heartbeat(job_id)
+        except Exception:
+            logger.exception(f'Heartbeat failed for job {job_id}')
+
+
+def run_worker(worker_index: int = 0):
+    """Claim and run jobs until asked to stop."""
+    signal.signal(signal.SIGTERM, _request_stop)
+    signal.signal(signal.SIGINT, _request_stop)
+    logging.basicConfig(level=config.LOG_LEVEL)
+
+    from app import app as flask_app
+    from . import jobs, embedding_cache
+    from .pipeline import run_stage, StageError
+
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    logger.info(f"Ingestion worker {worker_index} started as {worker_id}")
+    last_evict = time.monotonic()
+    while not _stopping:
+        with flask_app.app_context():
+            conn = flask_app.get_db_conn()
+            try:
+                job = jobs.claim(conn, worker_id)
+            except Exception:
+                logger.exception('Failed to claim a job')
+                job = None
+            if job is None:
+                # Idle: trim the embedding cache now and then
+                if config.EMBEDDING_CACHE_ENABLED and time.monotonic() - last_evict >= config.EMBEDDING_CACHE_EVICT_INTERVAL:
+                    last_evict = time.monotonic()
+                    try:
+                        embedding_cache.evict(conn)
+                    except Exception:
+                        logger.exception('Embedding cache eviction failed')
+                        conn.rollback()
+                conn.close()
+            else:
+                logger.info(f"Running job {job['id']}: {job['stage']} {job['filename']} (attempt {job['attempts']})")
+                done = threading.Event()
+                threading.Thread(target=_heartbeat_loop, args=(job['id'], done), daemon=True).start()
+                try:
+                    result = run_stage(job['stage'], job['filename'], job['params'], progress=jobs.ProgressReporter(job['id']))
+                    jobs.complete(conn, job['id'], result)
+                except StageError as e:
+                    conn.rollback()
+                    jobs.fail(conn, job, str(e), retryable=False)
+                except Exception as e:
+                    logger.exception(f"Job {job['id']} raised")
+                    conn.rollback()
+                    jobs.fail(conn, job, f"{type(e).__name__}: {e}")
+                finally:
+                    done.set()
+                continue
+        time.sleep(config.INGEST_POLL_INTERVAL)
+    logger.info(f"Ingestion worker {worker_id} stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Nimbus ingestion worker pool')
+    parser.add_argument('--processes', type=int, default=config.INGEST_WORKER_PROCESSES,
+                        help='number of worker processes (default: INGEST_WORKER_PROCESSES)')
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        run_worker(0)
+        return
+
+    signal.signal(signal.SIGTERM, _request_stop)
+    signal.signal(signal.SIGINT, _request_stop)
+    ctx = multiprocessing.get_context('spawn')
+    procs = [ctx.Process(target=run_worker, args=(i,), name=f'nimbus-ingest-{i}') for i in range(args.processes)]
+    for p in procs:
+        p.start()
+    try:
+        while not _stopping and any(p.is_alive() for p in procs):
+            time.sleep(1)
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+        for p in procs:
+            p.join()
+
+
+if __name__ == '__main__':
+    main()
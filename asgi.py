@@ -0,0 +1,39 @@
+"""
+ASGI entry point: async chat in front of the Flask app.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8000 --workers 2
+
+``POST /chat/message`` is served by ``apps.chat.async_chat`` on the event
+loop; every other route falls through to the unchanged Flask application,
+which runs on a thread pool of ``ASGI_WSGI_THREADS`` threads. ``python
+app.py`` / any WSGI server keeps working without this file.
+"""
+import contextlib
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.routing import Mount, Route
+
+import config
+from app import app as flask_app
+from apps.chat import async_chat
+
+async_chat.init_sessions(flask_app)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(_app):
+    await async_chat.startup()
+    try:
+        yield
+    finally:
+        await async_chat.shutdown()
+
+
+app = Starlette(
+    routes=[
+        Route('/chat/message', async_chat.chat_message, methods=['POST']),
+        Mount('/', app=WSGIMiddleware(flask_app, workers=config.ASGI_WSGI_THREADS)),
+    ],
+    lifespan=lifespan,
+)
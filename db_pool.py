@@ -0,0 +1,308 @@
+"""
+PostgreSQL connection pooling for Nimbus.
+
+A bounded, thread-safe pool of psycopg2 connections. Inside a Flask request
+every call to ``get_db_conn()`` returns the same checked-out connection; it is
+handed back to the pool once every caller has closed it (or, at the latest,
+when the app context tears down), so a request does not hold a connection
+while it waits on Ollama. Outside a request (background threads, workers,
+CLI) each call checks out its own connection and ``close()`` returns it to
+the pool.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+import psycopg2
+import psycopg2.extensions
+from flask import g, has_app_context
+
+import config
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the pool timeout."""
+
+
+class ConnectionPool:
+    """Bounded pool of psycopg2 connections with wait/saturation counters."""
+
+    def __init__(self, dsn, min_size=1, max_size=10, timeout=10.0, healthcheck_interval=30.0):
+        self.dsn = dsn
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self._idle = deque()  # (conn, last_used_monotonic)
+        self._in_use = 0
+        self._saturated_since = None  # monotonic time every connection became checked out
+        self._cond = threading.Condition()
+        self._pid = os.getpid()
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'timeouts': 0,
+            'saturated': 0,  # times every connection became checked out, waiters or not
+            'saturated_time_total': 0.0,  # seconds spent with every connection checked out
+            'connections_opened': 0,
+            'connections_discarded': 0,
+            'healthcheck_failures': 0,
+        }
+
+    def _open(self):
+        conn = psycopg2.connect(self.dsn)
+        self._stats['connections_opened'] += 1
+        return conn
+
+    def _discard(self, conn):
+        self._stats['connections_discarded'] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if time.monotonic() - last_used < self.healthcheck_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except Exception:
+            self._stats['healthcheck_failures'] += 1
+            return False
+
+    def _adjust_in_use(self, delta):
+        # Caller holds self._cond
+        self._in_use += delta
+        now = time.monotonic()
+        if self._in_use >= self.max_size and self._saturated_since is None:
+            self._saturated_since = now
+            self._stats['saturated'] += 1
+        elif self._in_use < self.max_size and self._saturated_since is not None:
+            self._stats['saturated_time_total'] += now - self._saturated_since
+            self._saturated_since = None
+
+    def getconn(self):
+        """Check out a healthy connection, waiting up to ``timeout`` seconds."""
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        wait_start = None
+        with self._cond:
+            while not self._idle and self._in_use >= self.max_size:
+                if not waited:
+                    waited = True
+                    wait_start = time.monotonic()
+                    self._stats['waits'] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(f'No database connection available after {self.timeout}s (max_size={self.max_size})')
+                self._cond.wait(remaining)
+            if waited:
+                waited_for = time.monotonic() - wait_start
+                self._stats['wait_time_total'] += waited_for
+                self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited_for)
+            self._stats['checkouts'] += 1
+            self._adjust_in_use(1)
+            candidate = self._idle.pop() if self._idle else None
+
+        # Health checks and connects happen outside the lock
+        try:
+            while candidate is not None:
+                conn, last_used = candidate
+                if self._is_healthy(conn, last_used):
+                    return conn
+                self._discard(conn)
+                with self._cond:
+                    candidate = self._idle.pop() if self._idle else None
+            return self._open()
+        except Exception:
+            with self._cond:
+                self._adjust_in_use(-1)
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn, discard=False):
+        """Return a connection to the pool, rolling back any open transaction."""
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+        with self._cond:
+            self._adjust_in_use(-1)
+            if discard or conn.closed or len(self._idle) >= self.max_size:
+                keep = False
+            else:
+                keep = True
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+        if not keep:
+            self._discard(conn)
+
+    def warm(self):
+        """Open ``min_size`` idle connections up front."""
+        with self._cond:
+            missing = self.min_size - len(self._idle) - self._in_use
+        for _ in range(max(0, missing)):
+            conn = self._open()
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            if self._saturated_since is not None:
+                stats['saturated_time_total'] += time.monotonic() - self._saturated_since
+            stats['saturated_time_total'] = round(stats['saturated_time_total'], 3)
+            stats.update({
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'saturation': round(self._in_use / self.max_size, 3),
+            })
+        stats['wait_time_avg'] = round(stats['wait_time_total'] / stats['waits'], 4) if stats['waits'] else 0.0
+        return stats
+
+
+class PooledConnection:
+    """Proxy around a pooled connection.
+
+    ``close()`` keeps the historical "discard uncommitted work" semantics by
+    rolling back. A request-scoped connection is shared by every
+    ``get_db_conn()`` call in the request: closing it only rolls back and
+    returns it to the pool when the last of them closes it, so a nested
+    helper never discards the outer caller's open transaction. Any other
+    connection goes back immediately.
+    """
+
+    def __init__(self, pool, conn, request_scoped=False):
+        self._pool = pool
+        self._conn = conn
+        self._request_scoped = request_scoped
+        self._released = False
+        self._refs = 1
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        # Connection attributes such as ``autocommit`` belong to the real connection
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._conn, name, value)
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._conn.__exit__(exc_type, exc, tb)
+
+    @property
+    def raw(self):
+        return self._conn
+
+    def close(self):
+        if self._released:
+            return
+        if self._request_scoped:
+            self._refs -= 1
+            if self._refs > 0:
+                # Still in use by an outer caller in this request; its transaction is left alone
+                return
+        self.release()
+
+    def release(self, discard=False):
+        if self._released:
+            return
+        self._released = True
+        self._pool.putconn(self._conn, discard=discard or bool(self._conn.closed))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+# Pools inherited across a fork are kept referenced so their sockets (shared
+# with the parent) are never finalized from the child.
+_inherited_pools = []
+
+
+def get_pool():
+    """Return the process-wide pool, recreating it after a fork."""
+    global _pool
+    pool = _pool
+    if pool is not None and pool._pid == os.getpid():
+        return pool
+    with _pool_lock:
+        if _pool is None or _pool._pid != os.getpid():
+            if _pool is not None:
+                _inherited_pools.append(_pool)
+            _pool = ConnectionPool(
+                config.DATABASE_URL,
+                min_size=config.DB_POOL_MIN_SIZE,
+                max_size=config.DB_POOL_MAX_SIZE,
+                timeout=config.DB_POOL_TIMEOUT,
+                healthcheck_interval=config.DB_POOL_HEALTHCHECK_INTERVAL,
+            )
+            try:
+                _pool.warm()
+            except Exception:
+                # Database may not be up yet; connections are opened lazily
+                pass
+        return _pool
+
+
+def get_db_conn():
+    """Return a pooled connection; one per request when inside an app context."""
+    pool = get_pool()
+    if has_app_context():
+        pooled = g.get('_nimbus_db_conn')
+        if pooled is not None and not pooled._released and not pooled.raw.closed:
+            pooled._refs += 1
+            return pooled
+        pooled = PooledConnection(pool, pool.getconn(), request_scoped=True)
+        g._nimbus_db_conn = pooled
+        return pooled
+    return PooledConnection(pool, pool.getconn())
+
+
+def get_standalone_conn():
+    """Check out a connection that is independent of the request's connection.
+
+    Use it for writes that must commit on their own (e.g. job progress)
+    while the request connection holds an open transaction. ``close()``
+    returns it to the pool.
+    """
+    pool = get_pool()
+    return PooledConnection(pool, pool.getconn())
+
+
+def release_request_conn(exc=None):
+    """Teardown hook: return the request's connection to the pool if a caller left it open."""
+    pooled = g.pop('_nimbus_db_conn', None)
+    if pooled is not None:
+        pooled.release(discard=exc is not None and isinstance(exc, psycopg2.OperationalError))
+
+
+def pool_stats():
+    return get_pool().stats()
@@ -0,0 +1,140 @@
+"""
+Registry of the document_embeddings_* tables (``embedding_tables``).
+
+``schema.ensure_embedding_table`` records every table it creates or
+upgrades with its embedding model, dimension, distance metric and index
+type, and ``vector_index.rebuild_index`` updates the row after a rebuild.
+Deletes and chat retrieval read the registry instead of scanning
+``information_schema``.
+
+Every process keeps the registry in memory. A write that changes a row
+sends ``NOTIFY embedding_tables`` and a listener thread in each process
+(``EMBEDDING_REGISTRY_LISTEN``) drops its copy when one arrives, so other
+workers see a new table on their next request. ``RAG_TABLE_REGISTRY_TTL``
+bounds how stale a copy can get if the listener is down.
+"""
+import logging
+import os
+import select
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+import config
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'embedding_tables'
+COLUMNS = ('table_name', 'embedding_model', 'dimension', 'distance_metric', 'index_type')
+REGISTRY_SQL = f"SELECT {', '.join(COLUMNS)} FROM embedding_tables"
+
+_lock = threading.Lock()
+_tables = None
+_loaded_at = 0.0
+_generation = 0
+_listener_pid = None
+
+
+def register(cur, table_name: str, embedding_model: str = None, dimension: int = None,
+             distance_metric: str = None, index_type: str = None) -> bool:
+    """Record a table; ``None`` keeps the stored value. Returns True if the row changed.
+
+    Other processes are notified when the transaction commits.
+    """
+    cur.execute("""
+        INSERT INTO embedding_tables AS r (table_name, embedding_model, dimension, distance_metric, index_type)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (table_name) DO UPDATE SET
+            embedding_model = coalesce(EXCLUDED.embedding_model, r.embedding_model),
+            dimension = coalesce(EXCLUDED.dimension, r.dimension),
+            distance_metric = coalesce(EXCLUDED.distance_metric, r.distance_metric),
+            index_type = coalesce(EXCLUDED.index_type, r.index_type),
+            updated_at = CURRENT_TIMESTAMP
+        WHERE (r.embedding_model, r.dimension, r.distance_metric, r.index_type) IS DISTINCT FROM
+              (coalesce(EXCLUDED.embedding_model, r.embedding_model), coalesce(EXCLUDED.dimension, r.dimension),
+               coalesce(EXCLUDED.distance_metric, r.distance_metric), coalesce(EXCLUDED.index_type, r.index_type))
+        RETURNING table_name
+    """, (table_name, embedding_model, dimension, distance_metric, index_type))
+    if cur.fetchone() is None:
+        return False
+    cur.execute("SELECT pg_notify(%s, %s)", (CHANNEL, table_name))
+    return True
+
+
+def invalidate():
+    """Drop this process's copy; the next reader reloads it."""
+    global _tables, _generation
+    with _lock:
+        _tables = None
+        _generation += 1
+
+
+def snapshot() -> tuple:
+    """``(tables, generation)``; ``tables`` is ``{table_name: row}`` or ``None`` when it must be reloaded."""
+    _ensure_listener()
+    with _lock:
+        if _tables is not None and time.monotonic() - _loaded_at < config.RAG_TABLE_REGISTRY_TTL:
+            return _tables, _generation
+        return None, _generation
+
+
+def fill(rows, generation: int) -> dict:
+    """Cache registry ``rows`` (``REGISTRY_SQL`` order) unless it was invalidated since ``generation``."""
+    global _tables, _loaded_at
+    tables = {row[0]: dict(zip(COLUMNS, row)) for row in rows}
+    with _lock:
+        if generation == _generation:
+            _tables, _loaded_at = tables, time.monotonic()
+    return tables
+
+
+def tables(conn) -> dict:
+    """``{table_name: row}`` for every registered embedding table, loaded through ``conn`` if needed."""
+    registry, generation = snapshot()
+    if registry is None:
+        with conn.cursor() as cur:
+            cur.execute(REGISTRY_SQL)
+            registry = fill(cur.fetchall(), generation)
+    return registry
+
+
+def _listen():
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(config.DATABASE_URL)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {CHANNEL}")
+            # Changes made while we were not listening
+            invalidate()
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                if conn.notifies:
+                    conn.notifies.clear()
+                    invalidate()
+        except Exception as e:
+            logger.warning(f"Embedding table registry listener failed: {e}; retrying in 5s")
+            time.sleep(5)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+
+def _ensure_listener():
+    """Start the listener thread once per process (threads do not survive a fork)."""
+    global _listener_pid
+    if not config.EMBEDDING_REGISTRY_LISTEN or _listener_pid == os.getpid():
+        return
+    with _lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+    threading.Thread(target=_listen, name='embedding-registry-listener', daemon=True).start()
@@ -0,0 +1,556 @@
+"""
+Shared HTTP client for every call Nimbus makes to Ollama.
+
+One ``requests.Session`` per process and base URL, mounted with a bounded
+keep-alive pool (``OLLAMA_POOL_MAXSIZE``), so embeddings, completions and
+vision calls reuse TCP connections instead of opening one per request.
+On top of that:
+
+* timeouts: ``(OLLAMA_CONNECT_TIMEOUT, read timeout)``, with the read timeout
+  given by the caller (chat, embedding and model-list calls differ);
+* typed errors: everything raised is an ``OllamaError`` subclass;
+* retries: 5xx responses and connection failures are retried up to
+  ``OLLAMA_MAX_RETRIES`` times with full-jitter exponential backoff
+  (read timeouts are not retried; the request may still be running);
+* circuit breaker: after ``OLLAMA_BREAKER_FAILURES`` consecutive failures
+  calls fail fast with ``OllamaCircuitOpen`` for
+  ``OLLAMA_BREAKER_RESET_SECONDS``, then one probe request is let through.
+
+With several nodes in ``OLLAMA_BACKENDS`` each gets its own client and
+breaker, and ``OllamaRouter`` picks one per call (see below). Ingestion
+asks for ``role='embed'`` so it can use different nodes than interactive
+chat (``role='chat'``).
+
+Use ``get_client()`` rather than constructing clients directly.
+"""
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {500, 502, 503, 504}
+
+
+class OllamaError(Exception):
+    """Base class for Ollama client failures."""
+
+    def __init__(self, message, status_code=None, detail=None, url=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.detail = detail
+        self.url = url
+
+
+class OllamaUnavailable(OllamaError):
+    """Ollama could not be reached (connection refused, DNS, reset)."""
+
+
+class OllamaCircuitOpen(OllamaUnavailable):
+    """Too many recent failures; calls fail fast until the breaker resets."""
+
+
+class OllamaTimeout(OllamaError):
+    """Ollama did not answer within the timeout."""
+
+
+class OllamaHTTPError(OllamaError):
+    """Ollama answered with an error status."""
+
+
+class OllamaResponseError(OllamaError):
+    """Ollama answered 2xx but the body was not what we expected."""
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: closed -> open -> half-open -> closed."""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self) -> bool:
+        """True if a call may proceed; in half-open only one probe at a time."""
+        with self._lock:
+            state = self._state()
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._probing:
+                    self.trips += 1
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'state': self._state(), 'consecutive_failures': self._failures, 'trips': self.trips}
+
+
+class OllamaClient:
+    def __init__(self, base_url: str, pool_maxsize: int = None, connect_timeout: float = None,
+                 max_retries: int = None, backoff: float = None, backoff_max: float = None,
+                 breaker: CircuitBreaker = None):
+        self.base_url = base_url.rstrip('/')
+        self.connect_timeout = config.OLLAMA_CONNECT_TIMEOUT if connect_timeout is None else connect_timeout
+        self.max_retries = config.OLLAMA_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff = config.OLLAMA_RETRY_BACKOFF if backoff is None else backoff
+        self.backoff_max = config.OLLAMA_RETRY_BACKOFF_MAX if backoff_max is None else backoff_max
+        self.breaker = breaker or CircuitBreaker(config.OLLAMA_BREAKER_FAILURES, config.OLLAMA_BREAKER_RESET_SECONDS)
+        pool_maxsize = pool_maxsize or config.OLLAMA_POOL_MAXSIZE
+        self.session = requests.Session()
+        # pool_block: callers wait for a free connection instead of opening extra ones
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, pool_block=True, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._stats_lock = threading.Lock()
+        self._stats = {'requests': 0, 'retries': 0, 'failures': 0, 'rejected': 0}
+
+    def _count(self, key: str):
+        with self._stats_lock:
+            self._stats[key] += 1
+
+    def _sleep_before_retry(self, attempt: int):
+        # Full jitter: uniform(0, min(cap, base * 2^attempt))
+        time.sleep(random.uniform(0, min(self.backoff_max, self.backoff * (2 ** attempt))))
+
+    def request(self, method: str, path: str, json=None, timeout: float = None, stream: bool = False,
+                retries: int = None) -> requests.Response:
+        """Send a request and return the 2xx response, or raise an ``OllamaError``."""
+        url = f"{self.base_url}{path}"
+        retries = self.max_retries if retries is None else retries
+        timeout = (self.connect_timeout, timeout or config.CHAT_REQUEST_TIMEOUT)
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self._count('rejected')
+                raise OllamaCircuitOpen(f"Ollama circuit open for {self.base_url}", url=url)
+            self._count('requests')
+            try:
+                resp = self.session.request(method, url, json=json, timeout=timeout, stream=stream)
+            except requests.exceptions.ConnectionError as e:
+                # ConnectTimeout is a ConnectionError too: nothing was sent, safe to retry
+                error = OllamaUnavailable(f"Cannot reach Ollama at {self.base_url}: {e}", url=url)
+            except requests.exceptions.Timeout as e:
+                self.breaker.record_failure()
+                self._count('failures')
+                raise OllamaTimeout(f"Ollama timed out after {timeout[1]}s: {e}", url=url) from e
+            except requests.exceptions.RequestException as e:
+                self.breaker.record_failure()
+                self._count('failures')
+                raise OllamaError(str(e), url=url) from e
+            else:
+                if resp.status_code < 400:
+                    self.breaker.record_success()
+                    return resp
+                detail = resp.text
+                resp.close()
+                error = OllamaHTTPError(f"Ollama returned {resp.status_code} for {path}", status_code=resp.status_code,
+                                        detail=detail, url=url)
+                if resp.status_code not in RETRY_STATUSES:
+                    # 4xx is the caller's fault, not a sign Ollama is unhealthy
+                    self.breaker.record_success()
+                    raise error
+
+            self.breaker.record_failure()
+            if attempt >= retries:
+                self._count('failures')
+                raise error
+            attempt += 1
+            self._count('retries')
+            logger.info(f"Retrying {method} {path} (attempt {attempt + 1}/{retries + 1}): {error}")
+            self._sleep_before_retry(attempt)
+
+    def request_json(self, method: str, path: str, json=None, timeout: float = None, retries: int = None):
+        resp = self.request(method, path, json=json, timeout=timeout, retries=retries)
+        try:
+            return resp.json()
+        except ValueError as e:
+            raise OllamaResponseError(f"Invalid JSON from Ollama {path}", status_code=resp.status_code,
+                                      detail=resp.text, url=resp.url) from e
+
+    def stream_lines(self, path: str, json=None, timeout: float = None):
+        """POST and yield decoded response lines; read errors become ``OllamaError``."""
+        resp = self.request('POST', path, json=json, timeout=timeout, stream=True)
+        try:
+            for line in resp.iter_lines(decode_unicode=True):
+                yield line
+        except requests.exceptions.Timeout as e:
+            # A reply stalling mid-stream is the usual sign of an overloaded node
+            self.breaker.record_failure()
+            self._count('failures')
+            raise OllamaTimeout(f"Ollama stream stalled for {timeout}s: {e}", url=resp.url) from e
+        except requests.exceptions.RequestException as e:
+            self.breaker.record_failure()
+            self._count('failures')
+            raise OllamaError(f"Ollama stream failed: {e}", url=resp.url) from e
+        finally:
+            resp.close()
+
+    # OpenAI-compatible endpoints
+
+    def list_models(self, timeout: float = None):
+        resp = self.request('GET', '/v1/models', timeout=timeout or config.MODELS_REQUEST_TIMEOUT)
+        try:
+            return resp.json()
+        except ValueError:
+            return resp.text
+
+    def embeddings(self, model: str, inputs, timeout: float = None, retries: int = None) -> list:
+        """Embed a string or list of strings; returns vectors in input order."""
+        data = self.request_json('POST', '/v1/embeddings', json={'model': model, 'input': inputs},
+                                 timeout=timeout or config.EMBEDDING_REQUEST_TIMEOUT, retries=retries)
+        items = data.get('data') if isinstance(data, dict) else None
+        expected = 1 if isinstance(inputs, str) else len(inputs)
+        if not isinstance(items, list) or len(items) != expected:
+            raise OllamaResponseError(f"expected {expected} embeddings, got {len(items) if isinstance(items, list) else 0}")
+        items = sorted(items, key=lambda d: d.get('index', 0))
+        return [d.get('embedding') for d in items]
+
+    def chat_completion(self, model: str, messages: list, timeout: float = None) -> dict:
+        return self.request_json('POST', '/v1/chat/completions', json={'model': model, 'messages': messages},
+                                 timeout=timeout or config.CHAT_REQUEST_TIMEOUT)
+
+    def stream_chat_completion(self, model: str, messages: list, timeout: float = None):
+        """Yield the raw SSE lines of a streamed completion."""
+        return self.stream_lines('/v1/chat/completions', json={'model': model, 'messages': messages, 'stream': True},
+                                 timeout=timeout or config.CHAT_STREAM_IDLE_TIMEOUT)
+
+    # Native Ollama endpoints
+
+    def tags(self, timeout: float = None) -> dict:
+        return self.request_json('GET', '/api/tags', timeout=timeout or config.MODELS_REQUEST_TIMEOUT)
+
+    def generate(self, payload: dict, timeout: float = None) -> dict:
+        return self.request_json('POST', '/api/generate', json=payload, timeout=timeout or config.CHAT_REQUEST_TIMEOUT)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            data = dict(self._stats)
+        data['base_url'] = self.base_url
+        data['breaker'] = self.breaker.stats()
+        return data
+
+    def close(self):
+        self.session.close()
+
+
+def _base_name(model: str) -> str:
+    return model[:-len(':latest')] if model and model.endswith(':latest') else model
+
+
+class Backend:
+    """One Ollama node: its client, the roles it serves and the models it holds."""
+
+    def __init__(self, url: str, roles=None, models=None):
+        self.url = url.rstrip('/')
+        self.roles = set(roles or ['all'])
+        self.models = {_base_name(m) for m in (models or [])}
+        self.loaded_models = set()
+        self.client = OllamaClient(self.url)
+        self.outstanding = 0
+        self.healthy = True
+        self.last_check = None
+        self.last_error = None
+
+    def serves(self, role: str) -> bool:
+        return 'all' in self.roles or role in self.roles
+
+    def has_model(self, model: str) -> bool:
+        model = _base_name(model)
+        return model in self.models or model in self.loaded_models
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and self.client.breaker.state != 'open'
+
+    def stats(self) -> dict:
+        data = self.client.stats()
+        data.update({
+            'roles': sorted(self.roles),
+            'models': sorted(self.models),
+            'loaded_models': sorted(self.loaded_models),
+            'outstanding': self.outstanding,
+            'healthy': self.healthy,
+            'available': self.available,
+            'last_check': self.last_check,
+            'last_error': self.last_error,
+        })
+        return data
+
+
+class OllamaRouter:
+    """Least-outstanding-requests routing with role and model affinity.
+
+    Only backends serving the role are used, ranked by fewest in-flight
+    requests with a bonus for already having the model (configured or seen
+    loaded by the health check). Backends that failed their last health check
+    or whose circuit is open are skipped (ejected) while any other backend
+    for the role is available. A call that cannot reach its backend
+    (connection failure, open circuit, 5xx after retries) fails over to the
+    next one; with ``OLLAMA_ROLE_FALLBACK`` it may then fail over to backends
+    of other roles.
+    """
+
+    def __init__(self, backends):
+        self.backends = backends
+        self._lock = threading.Lock()
+        self._rr = 0
+        self._health_thread = None
+
+    def _rank(self, backends: list, model: str, rr: int) -> list:
+        pool = [b for b in backends if b.available] or list(backends)
+        if not pool:
+            return []
+        n = len(pool)
+        # rotate before sorting so ties spread across backends
+        pool = pool[rr % n:] + pool[:rr % n]
+        # affinity is worth OLLAMA_AFFINITY_WEIGHT in-flight requests: a busy node that has the
+        # model still wins over an idle one that would have to load it, up to that point
+        weight = config.OLLAMA_AFFINITY_WEIGHT
+        return sorted(pool, key=lambda b: b.outstanding - (weight if model and b.has_model(model) else 0))
+
+    def ordered(self, model: str, role: str) -> list:
+        """Backends serving ``role``, best first; other roles follow only with ``OLLAMA_ROLE_FALLBACK``."""
+        with self._lock:
+            self._rr += 1
+            rr = self._rr
+            ranked = self._rank([b for b in self.backends if b.serves(role)], model, rr)
+            if config.OLLAMA_ROLE_FALLBACK:
+                ranked += self._rank([b for b in self.backends if not b.serves(role)], model, rr)
+        if not ranked:
+            raise OllamaUnavailable(f"No Ollama backend serves the {role} role")
+        return ranked
+
+    def enter(self, backend):
+        with self._lock:
+            backend.outstanding += 1
+
+    def leave(self, backend):
+        with self._lock:
+            backend.outstanding -= 1
+
+    @staticmethod
+    def _failover_error(e: OllamaError) -> bool:
+        return isinstance(e, OllamaUnavailable) or (isinstance(e, OllamaHTTPError) and (e.status_code or 0) >= 500)
+
+    def call(self, model: str, role: str, fn):
+        """Run ``fn(client)`` on the best backend, failing over on unreachable/5xx backends."""
+        last_error = None
+        for backend in self.ordered(model, role):
+            self.enter(backend)
+            try:
+                return fn(backend.client)
+            except OllamaError as e:
+                if not self._failover_error(e):
+                    raise
+                logger.warning(f"Ollama backend {backend.url} failed for {model or role}: {e}")
+                last_error = e
+            finally:
+                self.leave(backend)
+        raise last_error
+
+    def stream(self, model: str, role: str, fn):
+        """Like ``call`` for line generators; fails over only before the first line arrives."""
+        last_error = None
+        for backend in self.ordered(model, role):
+            self.enter(backend)
+            started = False
+            try:
+                for line in fn(backend.client):
+                    started = True
+                    yield line
+                return
+            except OllamaError as e:
+                if started or not self._failover_error(e):
+                    raise
+                logger.warning(f"Ollama backend {backend.url} failed for {model}: {e}")
+                last_error = e
+            finally:
+                self.leave(backend)
+        raise last_error
+
+    def check_health(self):
+        for backend in self.backends:
+            try:
+                tags = backend.client.request_json('GET', '/api/tags', timeout=config.OLLAMA_HEALTHCHECK_TIMEOUT, retries=0)
+                backend.loaded_models = {_base_name(m.get('name') or m.get('model') or '') for m in tags.get('models', [])}
+                if not backend.healthy:
+                    logger.info(f"Ollama backend {backend.url} is healthy again")
+                backend.healthy = True
+                backend.last_error = None
+            except OllamaCircuitOpen:
+                # Still cooling down; the breaker lets a probe through once it half-opens
+                backend.healthy = False
+            except OllamaError as e:
+                if backend.healthy:
+                    logger.warning(f"Ejecting Ollama backend {backend.url}: {e}")
+                backend.healthy = False
+                backend.last_error = str(e)
+            backend.last_check = time.time()
+
+    def start_health_checks(self):
+        if self._health_thread is not None or config.OLLAMA_HEALTHCHECK_INTERVAL <= 0:
+            return
+
+        def loop():
+            while True:
+                try:
+                    self.check_health()
+                except Exception:
+                    logger.exception('Ollama health check failed')
+                time.sleep(config.OLLAMA_HEALTHCHECK_INTERVAL)
+
+        self._health_thread = threading.Thread(target=loop, name='ollama-health', daemon=True)
+        self._health_thread.start()
+
+    def stats(self) -> list:
+        return [b.stats() for b in self.backends]
+
+
+class RoutedClient:
+    """``OllamaClient``-style API whose calls are routed for one traffic role."""
+
+    def __init__(self, router: OllamaRouter, role: str):
+        self.router = router
+        self.role = role
+
+    def embeddings(self, model: str, inputs, timeout: float = None, retries: int = None) -> list:
+        return self.router.call(model, self.role, lambda c: c.embeddings(model, inputs, timeout=timeout, retries=retries))
+
+    def chat_completion(self, model: str, messages: list, timeout: float = None) -> dict:
+        return self.router.call(model, self.role, lambda c: c.chat_completion(model, messages, timeout=timeout))
+
+    def stream_chat_completion(self, model: str, messages: list, timeout: float = None):
+        return self.router.stream(model, self.role, lambda c: c.stream_chat_completion(model, messages, timeout=timeout))
+
+    def generate(self, payload: dict, timeout: float = None) -> dict:
+        return self.router.call(payload.get('model'), self.role, lambda c: c.generate(payload, timeout=timeout))
+
+    def tags(self, timeout: float = None) -> dict:
+        """Models across every backend serving this role."""
+        return {'models': self._merge('models', 'name', lambda c: c.tags(timeout=timeout))}
+
+    def list_models(self, timeout: float = None):
+        """``/v1/models`` merged across every backend serving this role."""
+        return {'object': 'list', 'data': self._merge('data', 'id', lambda c: c.list_models(timeout=timeout))}
+
+    def _merge(self, key: str, id_field: str, fn) -> list:
+        merged = {}
+        last_error = None
+        reached = False
+        for backend in self.router.backends:
+            if not backend.serves(self.role):
+                continue
+            try:
+                data = fn(backend.client)
+            except OllamaError as e:
+                last_error = e
+                continue
+            reached = True
+            for item in (data.get(key) or []) if isinstance(data, dict) else []:
+                merged.setdefault(item.get(id_field), item)
+        if not reached and last_error is not None:
+            raise last_error
+        return list(merged.values())
+
+
+def parse_backends(spec: str) -> list:
+    """``url|roles|models;...`` -> Backend list. Roles: chat, embed or all (joined with '+')."""
+    backends = []
+    for entry in (spec or '').split(';'):
+        parts = [p.strip() for p in entry.split('|')]
+        if not parts[0]:
+            continue
+        roles = [r for r in (parts[1] if len(parts) > 1 else 'all').split('+') if r] or ['all']
+        models = [m.strip() for m in (parts[2] if len(parts) > 2 else '').split(',') if m.strip()]
+        backends.append(Backend(parts[0], roles, models))
+    return backends
+
+
+_clients = {}
+_router = None
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    global _clients_pid, _router
+    if _clients_pid != os.getpid():
+        # Sockets and health threads from the parent must not be shared
+        _clients.clear()
+        _router = None
+        _clients_pid = os.getpid()
+
+
+def get_router() -> OllamaRouter:
+    global _router
+    with _clients_lock:
+        _reset_after_fork()
+        if _router is None:
+            backends = parse_backends(config.OLLAMA_BACKENDS) or [Backend(config.OLLAMA_URL)]
+            _router = OllamaRouter(backends)
+            if len(backends) > 1:
+                _router.start_health_checks()
+        return _router
+
+
+def get_client(base_url: str = None, role: str = 'chat'):
+    """Client for ``role`` traffic routed across ``OLLAMA_BACKENDS``.
+
+    With an explicit ``base_url`` that is not one of the configured
+    backends, returns a plain process-wide client for that URL instead.
+    Both are rebuilt after fork.
+    """
+    router = get_router()
+    if base_url and base_url.rstrip('/') not in {b.url for b in router.backends}:
+        base_url = base_url.rstrip('/')
+        with _clients_lock:
+            client = _clients.get(base_url)
+            if client is None:
+                client = _clients[base_url] = OllamaClient(base_url)
+            return client
+    return RoutedClient(router, role)
+
+
+def client_stats() -> dict:
+    with _clients_lock:
+        extra = [c.stats() for c in _clients.values()]
+    return {'backends': get_router().stats(), 'other': extra}
@@ -0,0 +1,495 @@
+"""
+Schema bootstrap and versioned migrations for Nimbus.
+
+``bootstrap_schema()`` runs once at startup: it applies every migration in
+``MIGRATIONS`` that is not yet recorded in ``schema_migrations`` and creates
+the embedding tables (with their ANN indexes, see ``vector_index``) for the
+configured models. Request handlers no longer issue DDL; the only runtime DDL left is ``ensure_embedding_table()`` for an
+embedding model seen for the first time, and that runs once per process.
+Every embedding table is recorded in ``embedding_tables`` (see
+``embedding_registry``).
+"""
+import logging
+import re
+import threading
+
+import config
+import embedding_registry
+import vector_index
+from db_pool import get_db_conn, get_standalone_conn
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary key so concurrent workers don't run migrations at the same time
+MIGRATION_LOCK_KEY = 7316482
+
+EMBEDDING_TABLE_PREFIX = 'document_embeddings_'
+_TABLE_NAME_RE = re.compile(r'^[a-z_][a-z0-9_]*$')
+
+
+def embedding_table_name(model_name: str) -> str:
+    """Return the embedding table name used for an embedding model."""
+    safe = model_name.lower().replace('-', '_').replace(':', '_').replace('.', '_')
+    return f"{EMBEDDING_TABLE_PREFIX}{safe}"
+
+
+def _m001_documents(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS documents (
+            id TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            uploader TEXT,
+            created_at TIMESTAMP,
+            enabled BOOLEAN DEFAULT FALSE,
+            parsing_status TEXT,
+            size INTEGER,
+            file_path TEXT,
+            parser_name TEXT,
+            parsed_text TEXT,
+            splitter_name TEXT,
+            splits JSON,
+            embeddings_model TEXT,
+            embeddings BOOLEAN DEFAULT FALSE
+        )
+        """
+    )
+
+
+def _m002_documents_lookup_indexes(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_documents_filename ON documents(filename)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_documents_uploader_enabled ON documents(uploader, enabled)")
+
+
+def _m003_ingestion_jobs(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS ingestion_jobs (
+            id BIGSERIAL PRIMARY KEY,
+            filename TEXT NOT NULL,
+            uploader TEXT,
+            stage TEXT NOT NULL CHECK (stage IN ('parse', 'split', 'embed')),
+            params JSONB NOT NULL DEFAULT '{}'::jsonb,
+            status TEXT NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'succeeded', 'failed')),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            run_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            progress_current INTEGER NOT NULL DEFAULT 0,
+            progress_total INTEGER,
+            progress_unit TEXT,
+            result JSONB,
+            error TEXT,
+            worker TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_ingestion_jobs_claim ON ingestion_jobs(run_after, id) WHERE status = 'queued'")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_ingestion_jobs_running ON ingestion_jobs(updated_at) WHERE status = 'running'")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_ingestion_jobs_filename ON ingestion_jobs(filename, created_at DESC)")
+
+
+def _m004_embedding_cache(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            embedding_model TEXT NOT NULL,
+            text_hash TEXT NOT NULL,
+            embedding VECTOR NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            last_used_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (embedding_model, text_hash)
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_embedding_cache_last_used ON embedding_cache(last_used_at)")
+
+
+def _m005_chat_history_summary(cur):
+    # chat_sessions / chat_messages come from db/init/02_chat_tables.sql
+    cur.execute("""
+        ALTER TABLE chat_sessions
+            ADD COLUMN IF NOT EXISTS summary TEXT,
+            ADD COLUMN IF NOT EXISTS summary_through_id INTEGER,
+            ADD COLUMN IF NOT EXISTS summary_updated_at TIMESTAMP
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_chat_messages_session_id_id ON chat_messages(session_id, id)")
+
+
+def _m006_embedding_document_keys(cur):
+    # Embedding tables created before chunk identity get their columns (and this backfill) in ensure_embedding_table
+    cur.execute("""
+        SELECT table_name FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name LIKE %s AND column_name = 'document_id'
+    """, (EMBEDDING_TABLE_PREFIX.replace('_', r'\_') + '%',))
+    for (table_name,) in cur.fetchall():
+        if _TABLE_NAME_RE.match(table_name):
+            _backfill_document_keys(cur, table_name)
+
+
+def _m007_documents_embedded_at(cur):
+    # Bumped by every embed run; part of the answer cache's documents fingerprint
+    cur.execute("ALTER TABLE documents ADD COLUMN IF NOT EXISTS embedded_at TIMESTAMP")
+
+
+def _m008_document_chunks(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS document_chunks (
+            id TEXT PRIMARY KEY,
+            document_id TEXT NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+            ordinal INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            start_offset INTEGER,
+            end_offset INTEGER,
+            metadata JSONB NOT NULL DEFAULT '{}'::jsonb,
+            content_hash TEXT NOT NULL,
+            UNIQUE (document_id, ordinal)
+        )
+    """)
+    cur.execute("ALTER TABLE documents ADD COLUMN IF NOT EXISTS chunk_count INTEGER NOT NULL DEFAULT 0")
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = 'documents' AND column_name = 'splits'
+    """)
+    if cur.fetchone():
+        # Chunk ids and hashes match chunk_sync.chunk_id / embedding_cache.text_hash
+        cur.execute("""
+            INSERT INTO document_chunks (id, document_id, ordinal, text, metadata, content_hash)
+            SELECT d.id || ':' || (s.n - 1) || ':' || left(h.hash, 16), d.id, s.n - 1, t.text,
+                   coalesce((s.value -> 'meta')::jsonb, '{}'::jsonb), h.hash
+            FROM documents d
+            CROSS JOIN LATERAL json_array_elements(CASE WHEN json_typeof(d.splits) = 'array' THEN d.splits ELSE '[]'::json END)
+                WITH ORDINALITY AS s(value, n)
+            CROSS JOIN LATERAL (SELECT coalesce(CASE WHEN json_typeof(s.value) = 'object' THEN s.value ->> 'text'
+                                                     ELSE s.value #>> '{}' END, '') AS text) t
+            CROSS JOIN LATERAL (SELECT encode(sha256(convert_to(t.text, 'UTF8')), 'hex') AS hash) h
+            ON CONFLICT DO NOTHING
+        """)
+        logger.info(f"Moved {cur.rowcount} chunks from documents.splits to document_chunks")
+        cur.execute("""
+            UPDATE documents d SET chunk_count = c.n
+            FROM (SELECT document_id, count(*) AS n FROM document_chunks GROUP BY document_id) c
+            WHERE c.document_id = d.id
+        """)
+        cur.execute("ALTER TABLE documents DROP COLUMN splits")
+    # The full-text index moves to document_chunks (see bootstrap_schema)
+    cur.execute("""
+        SELECT indexname FROM pg_indexes
+        WHERE schemaname = 'public' AND tablename LIKE %s AND indexname LIKE %s
+    """, (EMBEDDING_TABLE_PREFIX.replace('_', r'\_') + '%', r'%\_fts\_%'))
+    for (index,) in cur.fetchall():
+        if _TABLE_NAME_RE.match(index):
+            cur.execute(f"DROP INDEX IF EXISTS {index}")
+    cur.execute("""
+        SELECT table_name FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name LIKE %s AND column_name = 'chunk_id'
+    """, (EMBEDDING_TABLE_PREFIX.replace('_', r'\_') + '%',))
+    for (table_name,) in cur.fetchall():
+        if _TABLE_NAME_RE.match(table_name):
+            _ensure_chunk_reference(cur, table_name)
+
+
+def _m009_document_listing(cur):
+    # Keyset pagination of the documents page needs a total order on (created_at, id)
+    cur.execute("UPDATE documents SET created_at = TIMESTAMP 'epoch' WHERE created_at IS NULL")
+    cur.execute("ALTER TABLE documents ALTER COLUMN created_at SET DEFAULT CURRENT_TIMESTAMP, ALTER COLUMN created_at SET NOT NULL")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_documents_uploader_created ON documents(uploader, created_at, id)")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS document_status_counts (
+            uploader TEXT PRIMARY KEY,
+            total INTEGER NOT NULL DEFAULT 0,
+            parsed INTEGER NOT NULL DEFAULT 0,
+            split INTEGER NOT NULL DEFAULT 0,
+            embedded INTEGER NOT NULL DEFAULT 0,
+            enabled INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    # Each row change moves its old status out of the counts and its new status in
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION document_status_counts_apply() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE'
+               AND (OLD.uploader, OLD.parsing_status, OLD.chunk_count > 0, OLD.embeddings, OLD.enabled)
+                   IS NOT DISTINCT FROM (NEW.uploader, NEW.parsing_status, NEW.chunk_count > 0, NEW.embeddings, NEW.enabled) THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                INSERT INTO document_status_counts AS c (uploader, total, parsed, split, embedded, enabled)
+                VALUES (coalesce(OLD.uploader, ''), -1,
+                        -(coalesce(OLD.parsing_status = 'Parsed', false))::int, -(OLD.chunk_count > 0)::int,
+                        -(coalesce(OLD.embeddings, false))::int, -(coalesce(OLD.enabled, false))::int)
+                ON CONFLICT (uploader) DO UPDATE SET
+                    total = c.total + EXCLUDED.total, parsed = c.parsed + EXCLUDED.parsed, split = c.split + EXCLUDED.split,
+                    embedded = c.embedded + EXCLUDED.embedded, enabled = c.enabled + EXCLUDED.enabled;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO document_status_counts AS c (uploader, total, parsed, split, embedded, enabled)
+                VALUES (coalesce(NEW.uploader, ''), 1,
+                        (coalesce(NEW.parsing_status = 'Parsed', false))::int, (NEW.chunk_count > 0)::int,
+                        (coalesce(NEW.embeddings, false))::int, (coalesce(NEW.enabled, false))::int)
+                ON CONFLICT (uploader) DO UPDATE SET
+                    total = c.total + EXCLUDED.total, parsed = c.parsed + EXCLUDED.parsed, split = c.split + EXCLUDED.split,
+                    embedded = c.embedded + EXCLUDED.embedded, enabled = c.enabled + EXCLUDED.enabled;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS trg_document_status_counts ON documents")
+    cur.execute("""
+        CREATE TRIGGER trg_document_status_counts
+        AFTER INSERT OR UPDATE OR DELETE ON documents
+        FOR EACH ROW EXECUTE FUNCTION document_status_counts_apply()
+    """)
+    cur.execute("DELETE FROM document_status_counts")
+    cur.execute("""
+        INSERT INTO document_status_counts (uploader, total, parsed, split, embedded, enabled)
+        SELECT coalesce(uploader, ''), count(*),
+               count(*) FILTER (WHERE parsing_status = 'Parsed'), count(*) FILTER (WHERE chunk_count > 0),
+               count(*) FILTER (WHERE embeddings), count(*) FILTER (WHERE enabled)
+        FROM documents GROUP BY coalesce(uploader, '')
+    """)
+
+
+def _m010_embedding_tables(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS embedding_tables (
+            table_name TEXT PRIMARY KEY,
+            embedding_model TEXT,
+            dimension INTEGER,
+            distance_metric TEXT,
+            index_type TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # Last catalog scan: register the tables that already exist
+    cur.execute("""
+        SELECT table_name FROM information_schema.tables
+        WHERE table_schema = 'public' AND table_name LIKE %s
+    """, (EMBEDDING_TABLE_PREFIX.replace('_', r'\_') + '%',))
+    models = dict(configured_embedding_tables())
+    for (table_name,) in cur.fetchall():
+        if _TABLE_NAME_RE.match(table_name):
+            itype, metric = vector_index.index_settings(cur, table_name)
+            embedding_registry.register(cur, table_name, models.get(table_name),
+                                        vector_index.column_dimension(cur, table_name), metric, itype)
+
+
+# (version, name, step). Append new steps; never edit or reorder applied ones.
+MIGRATIONS = [
+    (1, 'documents table', _m001_documents),
+    (2, 'documents lookup indexes', _m002_documents_lookup_indexes),
+    (3, 'ingestion job queue', _m003_ingestion_jobs),
+    (4, 'embedding cache', _m004_embedding_cache),
+    (5, 'chat history summary', _m005_chat_history_summary),
+    (6, 'embedding rows keyed to documents', _m006_embedding_document_keys),
+    (7, 'documents embedded_at', _m007_documents_embedded_at),
+    (8, 'document chunks table', _m008_document_chunks),
+    (9, 'documents listing index and status counts', _m009_document_listing),
+    (10, 'embedding table registry', _m010_embedding_tables),
+]
+
+
+def _create_embedding_table(cur, table_name: str, dimension: int = None):
+    column_type = f"vector({int(dimension)})" if dimension else "VECTOR"
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            id SERIAL PRIMARY KEY,
+            filename TEXT,
+            text TEXT,
+            embedding {column_type},
+            document_id TEXT,
+            ordinal INTEGER,
+            content_hash TEXT,
+            chunk_id TEXT
+        )
+    """)
+    cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_filename ON {table_name}(filename)")
+    cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS uq_{table_name}_chunk ON {table_name}(document_id, ordinal)")
+    _ensure_chunk_reference(cur, table_name)
+
+
+def _ensure_chunk_reference(cur, table_name: str):
+    """Reference ``document_chunks(id)`` from ``chunk_id``, cascading deletes.
+
+    Rows keep the text only if they were written before ``document_chunks``
+    existed. The constraint is ``NOT VALID`` so those rows (and placeholder
+    ids of legacy chunks) are not checked; new rows are.
+    """
+    cur.execute("SELECT 1 FROM pg_constraint WHERE conname = %s", (f"fk_{table_name}_chunk",))
+    if cur.fetchone():
+        return
+    cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_chunk_id ON {table_name}(chunk_id)")
+    cur.execute(f"""
+        ALTER TABLE {table_name} ADD CONSTRAINT fk_{table_name}_chunk
+        FOREIGN KEY (chunk_id) REFERENCES document_chunks(id) ON DELETE CASCADE NOT VALID
+    """)
+
+
+def _upgrade_embedding_table(cur, table_name: str):
+    """Add the chunk identity columns to a table created before they existed.
+
+    Legacy rows keep NULL ``document_id`` and are replaced the next time
+    their document is embedded.
+    """
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = %s AND column_name = 'chunk_id'
+    """, (table_name,))
+    if cur.fetchone():
+        _ensure_chunk_reference(cur, table_name)
+        return
+    logger.info(f"Adding chunk identity columns to {table_name}")
+    cur.execute(f"""
+        ALTER TABLE {table_name}
+            ADD COLUMN IF NOT EXISTS document_id TEXT,
+            ADD COLUMN IF NOT EXISTS ordinal INTEGER,
+            ADD COLUMN IF NOT EXISTS content_hash TEXT,
+            ADD COLUMN IF NOT EXISTS chunk_id TEXT
+    """)
+    cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS uq_{table_name}_chunk ON {table_name}(document_id, ordinal)")
+    _backfill_document_keys(cur, table_name)
+    _ensure_chunk_reference(cur, table_name)
+
+
+def _backfill_document_keys(cur, table_name: str):
+    """Point legacy rows (NULL ``document_id``) at their document so retrieval can join on ``documents.id``.
+
+    Ordinals follow insertion order; the NULL ``content_hash`` makes the
+    next embed run rewrite these rows with proper chunk identity.
+    """
+    cur.execute(f"""
+        UPDATE {table_name} e
+        SET document_id = n.document_id, ordinal = n.ordinal
+        FROM (
+            SELECT e2.id, d.id AS document_id,
+                   row_number() OVER (PARTITION BY e2.filename ORDER BY e2.id) - 1 AS ordinal
+            FROM {table_name} e2
+            JOIN (SELECT DISTINCT ON (filename) id, filename FROM documents ORDER BY filename, created_at DESC) d
+              ON d.filename = e2.filename
+            WHERE e2.document_id IS NULL
+        ) n
+        WHERE e.id = n.id
+    """)
+    if cur.rowcount:
+        logger.info(f"Linked {cur.rowcount} legacy rows of {table_name} to their documents")
+
+
+def text_search_vector(column: str = 'text') -> str:
+    """tsvector expression behind the full-text index; queries must use it verbatim to hit the index."""
+    fts_config = config.RAG_FTS_CONFIG
+    if not _TABLE_NAME_RE.match(fts_config):
+        raise ValueError(f"Invalid text search configuration: {fts_config}")
+    return f"to_tsvector('{fts_config}'::regconfig, coalesce({column}, ''))"
+
+
+def text_search_query(param: str) -> str:
+    """tsquery for a user question bound to ``param``; same configuration as ``text_search_vector``."""
+    text_search_vector()  # validates the configuration
+    return f"websearch_to_tsquery('{config.RAG_FTS_CONFIG}'::regconfig, {param})"
+
+
+def ensure_text_search_index(cur, table_name: str = 'document_chunks'):
+    """GIN index over the chunk text for the full-text retrieval leg (one per text search config)."""
+    cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_fts_{config.RAG_FTS_CONFIG} "
+                f"ON {table_name} USING gin ({text_search_vector()})")
+
+
+_known_embedding_tables = set()
+_known_lock = threading.Lock()
+
+
+def ensure_embedding_table(table_name: str, dimension: int = None, embedding_model: str = None):
+    """Create an embedding table (and its ANN index) the first time this process needs it, and register it.
+
+    The column is typed ``vector(dimension)``; the dimension comes from the
+    argument or the configured dimension of ``embedding_model``. The DDL
+    runs and commits on a connection of its own, so the caller's open
+    transaction is left alone and the in-process cache never points at a
+    table that a later rollback removed.
+    """
+    if not _TABLE_NAME_RE.match(table_name):
+        raise ValueError(f"Invalid embedding table name: {table_name}")
+    if table_name in _known_embedding_tables:
+        return
+    dimension = dimension or vector_index.model_dimension(embedding_model)
+    conn = get_standalone_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass(%s)", (table_name,))
+            if cur.fetchone()[0] is None:
+                _create_embedding_table(cur, table_name, dimension)
+            else:
+                _upgrade_embedding_table(cur, table_name)
+            if dimension and vector_index.column_dimension(cur, table_name) is None:
+                logger.warning(f"{table_name} has an untyped embedding column; rebuild it from /admin/vector_index to type it as vector({dimension}) and index it")
+            vector_index.ensure_index(cur, table_name)
+            itype, metric = vector_index.index_settings(cur, table_name)
+            embedding_registry.register(cur, table_name, embedding_model, vector_index.column_dimension(cur, table_name), metric, itype)
+        conn.commit()
+    finally:
+        conn.close()
+    with _known_lock:
+        _known_embedding_tables.add(table_name)
+
+
+def configured_embedding_tables():
+    """(table, embedding model) pairs referenced by the configuration."""
+    tables = {embedding_table_name(config.DEFAULT_EMBEDDING_MODEL): config.DEFAULT_EMBEDDING_MODEL}
+    for entries in config.MODEL_EMBEDDING_TABLE_MAP.values():
+        for entry in entries:
+            tables.setdefault(entry['table'], entry['embedding_model'])
+    return sorted(tables.items())
+
+
+def apply_migrations(conn):
+    """Apply pending migrations inside one transaction. Returns versions applied."""
+    applied_now = []
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_KEY,))
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cur.execute("SELECT version FROM schema_migrations")
+        applied = {r[0] for r in cur.fetchall()}
+        for version, name, step in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info(f"Applying migration {version}: {name}")
+            step(cur)
+            cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+            applied_now.append(version)
+    conn.commit()
+    return applied_now
+
+
+def bootstrap_schema():
+    """Run pending migrations once at startup."""
+    conn = get_db_conn()
+    try:
+        # Session-level lock: ensure_embedding_table commits on its own connection
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+        try:
+            applied = apply_migrations(conn)
+            if applied:
+                logger.info(f"Applied migrations: {applied}")
+            if config.RAG_HYBRID_ENABLED:
+                with conn.cursor() as cur:
+                    ensure_text_search_index(cur)
+                # Committed first: the chunk_id foreign keys below lock document_chunks from another connection
+                conn.commit()
+            for table_name, embedding_model in configured_embedding_tables():
+                ensure_embedding_table(table_name, embedding_model=embedding_model)
+        finally:
+            conn.rollback()
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+            conn.commit()
+        return applied
+    finally:
+        conn.close()
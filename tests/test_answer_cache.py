@@ -0,0 +1,21 @@
+from apps.chat import answer_cache
+from apps.chat.answer_cache import SemanticAnswerCache
+
+
+def test_users_never_share_a_bucket():
+    # Same model, embedding model, strict flag and the fingerprint of an empty document set
+    fingerprint = 'd41d8cd98f00b204e9800998ecf8427e'
+    alice = answer_cache.bucket('alice', 'llama3', 'nomic-embed-text', fingerprint, 'true')
+    bob = answer_cache.bucket('bob', 'llama3', 'nomic-embed-text', fingerprint, 'true')
+    assert alice != bob
+
+
+def test_answer_is_not_served_to_another_user():
+    cache = SemanticAnswerCache(maxsize=10, ttl=60, threshold=0.95, bucket_size=4)
+    vector = [0.1, 0.2, 0.3]
+    alice = answer_cache.bucket('alice', 'llama3', 'nomic-embed-text', 'abc', 'true')
+    bob = answer_cache.bucket('bob', 'llama3', 'nomic-embed-text', 'abc', 'true')
+    cache.store(alice, vector, 'my account number?', 'It is 12345.')
+
+    assert cache.lookup(alice, vector)[0] == 'It is 12345.'
+    assert cache.lookup(bob, vector) is None
@@ -0,0 +1,260 @@
+"""
+ANN index management for the document_embeddings_* tables.
+
+Each embedding table gets a fixed ``vector(n)`` column (the dimension comes
+from ``EMBEDDING_MODEL_DIMENSIONS`` or from the first vector the model
+returns) and one HNSW or IVFFlat index named ``idx_<table>_ann``. The index
+type, its build parameters and the distance operator class come from
+config; queries must use ``distance_operator()`` with the table's
+registered metric (a table keeps the metric it was indexed with until it
+is rebuilt) so the planner can pick the index, and ``apply_search_params()`` sets ``hnsw.ef_search`` /
+``ivfflat.probes`` (and iterative scans, for filtered searches) for the
+current transaction.
+"""
+import logging
+
+import config
+import embedding_registry
+
+logger = logging.getLogger(__name__)
+
+# metric -> (operator, operator class suffix)
+DISTANCE_METRICS = {
+    'l2': ('<->', 'l2_ops'),
+    'cosine': ('<=>', 'cosine_ops'),
+    'ip': ('<#>', 'ip_ops'),
+}
+INDEX_TYPES = ('hnsw', 'ivfflat', 'none')
+
+# pgvector cannot index vector columns wider than this
+MAX_INDEXED_DIMENSIONS = 2000
+
+
+def distance_metric() -> str:
+    metric = config.VECTOR_DISTANCE_METRIC
+    if metric not in DISTANCE_METRICS:
+        raise ValueError(f"Unsupported VECTOR_DISTANCE_METRIC: {metric}")
+    return metric
+
+
+def distance_operator(metric: str = None) -> str:
+    """SQL operator matching the index operator class of ``metric`` (default: the configured metric)."""
+    if metric not in DISTANCE_METRICS:
+        metric = distance_metric()
+    return DISTANCE_METRICS[metric][0]
+
+
+def index_type() -> str:
+    itype = config.VECTOR_INDEX_TYPE
+    if itype not in INDEX_TYPES:
+        raise ValueError(f"Unsupported VECTOR_INDEX_TYPE: {itype}")
+    return itype
+
+
+def index_name(table_name: str) -> str:
+    return f"idx_{table_name}_ann"[:63]
+
+
+def model_dimension(embedding_model: str):
+    """Configured dimension for an embedding model, or None if unknown."""
+    if not embedding_model:
+        return None
+    name = embedding_model.replace('_', '-')
+    return config.EMBEDDING_MODEL_DIMENSIONS.get(name) or config.EMBEDDING_MODEL_DIMENSIONS.get(name.split(':')[0])
+
+
+def column_dimension(cur, table_name: str):
+    """Dimension of the table's ``embedding`` column; None when untyped."""
+    cur.execute("""
+        SELECT a.atttypmod
+        FROM pg_attribute a
+        WHERE a.attrelid = to_regclass(%s) AND a.attname = 'embedding' AND NOT a.attisdropped
+    """, (table_name,))
+    row = cur.fetchone()
+    if not row or row[0] is None or row[0] < 0:
+        return None
+    return row[0]
+
+
+def _index_definition(cur, table_name: str):
+    cur.execute("SELECT indexdef FROM pg_indexes WHERE schemaname = 'public' AND indexname = %s", (index_name(table_name),))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def index_settings(cur, table_name: str) -> tuple:
+    """``(index type, distance metric)`` of the table's ANN index as built, or as configured before it exists."""
+    definition = _index_definition(cur, table_name)
+    if not definition:
+        return index_type(), distance_metric()
+    itype = next((t for t in INDEX_TYPES if f"USING {t} " in definition), None)
+    metric = next((m for m, (_, suffix) in DISTANCE_METRICS.items() if f"vector_{suffix}" in definition), None)
+    return itype, metric
+
+
+def _index_sql(table_name: str, concurrently: bool = False, row_count: int = 0) -> str:
+    itype = index_type()
+    opclass = f"vector_{DISTANCE_METRICS[distance_metric()][1]}"
+    conc = ' CONCURRENTLY' if concurrently else ''
+    if itype == 'hnsw':
+        params = f"m = {int(config.HNSW_M)}, ef_construction = {int(config.HNSW_EF_CONSTRUCTION)}"
+    else:
+        lists = int(config.IVFFLAT_LISTS) or max(1, row_count // 1000)
+        params = f"lists = {lists}"
+    return (f"CREATE INDEX{conc} IF NOT EXISTS {index_name(table_name)} "
+            f"ON {table_name} USING {itype} (embedding {opclass}) WITH ({params})")
+
+
+def _row_count(cur, table_name: str) -> int:
+    cur.execute(f"SELECT count(*) FROM {table_name}")
+    return cur.fetchone()[0]
+
+
+def set_column_dimension(cur, table_name: str, dimension: int, drop_mismatched: bool = False):
+    """Convert an untyped ``embedding`` column to ``vector(dimension)``.
+
+    Rows whose vectors have another length make the ALTER fail unless
+    ``drop_mismatched`` is set, in which case they are deleted first.
+    """
+    if drop_mismatched:
+        cur.execute(f"DELETE FROM {table_name} WHERE vector_dims(embedding) <> %s", (dimension,))
+        if cur.rowcount:
+            logger.warning(f"Deleted {cur.rowcount} rows with mismatched dimensions from {table_name}")
+    cur.execute(f"ALTER TABLE {table_name} ALTER COLUMN embedding TYPE vector({int(dimension)})")
+
+
+def ensure_index(cur, table_name: str):
+    """Create the ANN index for a table if it is missing.
+
+    Returns True when an index exists (or was created). HNSW indexes are
+    created immediately and maintained by Postgres on insert; IVFFlat needs
+    training data so it waits until the table has IVFFLAT_MIN_ROWS rows.
+    """
+    itype = index_type()
+    if itype == 'none':
+        return False
+    if _index_definition(cur, table_name):
+        return True
+    dimension = column_dimension(cur, table_name)
+    if dimension is None:
+        logger.info(f"{table_name} has an untyped embedding column; skipping ANN index (rebuild from admin to fix)")
+        return False
+    if dimension > MAX_INDEXED_DIMENSIONS:
+        logger.warning(f"{table_name} has {dimension} dimensions; pgvector indexes support at most {MAX_INDEXED_DIMENSIONS}")
+        return False
+    row_count = 0
+    if itype == 'ivfflat':
+        row_count = _row_count(cur, table_name)
+        if row_count < config.IVFFLAT_MIN_ROWS:
+            return False
+    if config.VECTOR_INDEX_MAINTENANCE_WORK_MEM:
+        cur.execute("SELECT set_config('maintenance_work_mem', %s, true)", (config.VECTOR_INDEX_MAINTENANCE_WORK_MEM,))
+    logger.info(f"Building {itype} index on {table_name}")
+    cur.execute(_index_sql(table_name, row_count=row_count))
+    return True
+
+
+ITERATIVE_SCAN_MODES = ('off', 'relaxed_order', 'strict_order')
+
+
+def iterative_scan() -> str:
+    mode = config.VECTOR_ITERATIVE_SCAN
+    if mode not in ITERATIVE_SCAN_MODES:
+        raise ValueError(f"Unsupported VECTOR_ITERATIVE_SCAN: {mode}")
+    return mode
+
+
+def search_params(ef_search: int = None, probes: int = None) -> list:
+    """(setting, value) pairs that tune ANN search breadth for the configured index type.
+
+    With iterative scans enabled, a filtered search keeps walking the index
+    until ``LIMIT`` rows pass the filter instead of stopping after
+    ``ef_search`` / ``probes`` candidates.
+    """
+    itype = index_type()
+    mode = iterative_scan()
+    if itype == 'hnsw':
+        params = [('hnsw.ef_search', str(int(ef_search or config.HNSW_EF_SEARCH)))]
+        if mode != 'off':
+            params.append(('hnsw.iterative_scan', mode))
+        return params
+    if itype == 'ivfflat':
+        params = [('ivfflat.probes', str(int(probes or config.IVFFLAT_PROBES)))]
+        if mode != 'off':
+            # IVFFlat only supports relaxed ordering
+            params.append(('ivfflat.iterative_scan', 'relaxed_order'))
+        return params
+    return []
+
+
+def apply_search_params(cur, ef_search: int = None, probes: int = None):
+    """Set per-query ANN search parameters for the current transaction."""
+    for name, value in search_params(ef_search, probes):
+        cur.execute("SELECT set_config(%s, %s, true)", (name, value))
+
+
+def index_status(cur, table_name: str) -> dict:
+    definition = _index_definition(cur, table_name)
+    size = None
+    if definition:
+        cur.execute("SELECT pg_size_pretty(pg_relation_size(to_regclass(%s)))", (index_name(table_name),))
+        size = cur.fetchone()[0]
+    return {
+        'table': table_name,
+        'dimension': column_dimension(cur, table_name),
+        'rows': _row_count(cur, table_name),
+        'index': index_name(table_name) if definition else None,
+        'definition': definition,
+        'index_size': size,
+        'configured_type': index_type(),
+        'configured_metric': distance_metric(),
+    }
+
+
+def rebuild_index(conn, table_name: str, mode: str = 'reindex', dimension: int = None, drop_mismatched: bool = False) -> dict:
+    """Rebuild or reindex a table's ANN index from an admin request.
+
+    ``reindex`` runs REINDEX CONCURRENTLY on the existing index (e.g. after
+    heavy deletes). ``rebuild`` drops and recreates it with the current
+    config, first typing the column when ``dimension`` is given; use it
+    after changing index type, metric or build parameters.
+    Uses autocommit because the CONCURRENTLY forms cannot run in a
+    transaction block.
+    """
+    conn.rollback()
+    previous = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            if mode == 'reindex':
+                if not _index_definition(cur, table_name):
+                    raise ValueError(f"{table_name} has no ANN index to reindex; use mode=rebuild")
+                cur.execute(f"REINDEX INDEX CONCURRENTLY {index_name(table_name)}")
+            elif mode == 'rebuild':
+                if dimension and column_dimension(cur, table_name) != dimension:
+                    conn.autocommit = False
+                    cur.execute(f"DROP INDEX IF EXISTS {index_name(table_name)}")
+                    set_column_dimension(cur, table_name, dimension, drop_mismatched=drop_mismatched)
+                    conn.commit()
+                    conn.autocommit = True
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name(table_name)}")
+                if index_type() != 'none':
+                    if column_dimension(cur, table_name) is None:
+                        raise ValueError(f"{table_name} has an untyped embedding column; pass a dimension")
+                    if config.VECTOR_INDEX_MAINTENANCE_WORK_MEM:
+                        cur.execute("SELECT set_config('maintenance_work_mem', %s, false)", (config.VECTOR_INDEX_MAINTENANCE_WORK_MEM,))
+                    cur.execute(_index_sql(table_name, concurrently=True, row_count=_row_count(cur, table_name)))
+                    if config.VECTOR_INDEX_MAINTENANCE_WORK_MEM:
+                        cur.execute("RESET maintenance_work_mem")
+            else:
+                raise ValueError(f"Unknown mode: {mode}")
+            itype, metric = index_settings(cur, table_name)
+            embedding_registry.register(cur, table_name, dimension=column_dimension(cur, table_name),
+                                        distance_metric=metric, index_type=itype)
+            return index_status(cur, table_name)
+    except Exception:
+        if not conn.autocommit:
+            conn.rollback()
+        raise
+    finally:
+        conn.autocommit = previous